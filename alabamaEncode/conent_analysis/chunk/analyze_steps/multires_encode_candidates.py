@@ -1,4 +1,5 @@
 import os
+from typing import List, Tuple
 
 from alabamaEncode.conent_analysis.chunk.chunk_analyse_step import (
     ChunkAnalyzePipelineItem,
@@ -7,94 +8,119 @@ from alabamaEncode.conent_analysis.opinionated_vmaf import (
     convexhull_get_resolutions,
     convexhull_get_crf_range,
 )
+from alabamaEncode.conent_analysis.rd_sampler import AdaptiveRdSampler
 from alabamaEncode.encoder.encoder import Encoder
+from alabamaEncode.encoder.ladder import LadderEncoder
 from alabamaEncode.encoder.stats import EncodeStats
 from alabamaEncode.metrics.calculate import get_metric_from_stats
 from alabamaEncode.metrics.metric import Metric
 from alabamaEncode.scene.chunk import ChunkObject
 
 
-class EncodeMultiResCandidates(ChunkAnalyzePipelineItem):
-    def run(self, ctx, chunk: ChunkObject, enc: Encoder) -> Encoder:
-        crf_low, crf_high = convexhull_get_crf_range(enc.get_codec())
-        crf_range = list(range(crf_low, crf_high, 2))
-        resolutions = convexhull_get_resolutions(enc.get_codec())
-        crf_range.reverse()  # encode the probes fast to slow, not necessary but why not
-        resolutions.reverse()
-
-        ctx.vmaf_reference_display = "FHD"
-        vmaf_options = ctx.get_vmaf_options()
-
-        probe_folder_path = (
-            os.path.join(os.path.dirname(chunk.chunk_path), f"{chunk.chunk_index}")
-            + os.path.sep
+def get_candidate_key(chunk: ChunkObject, res: str, crf) -> str:
+    return f"{chunk.chunk_index}_{res.split(':')[0]}_{crf}"
+
+
+def encode_candidates(
+    ctx, chunk: ChunkObject, enc: Encoder, candidates: List[Tuple[str, float]]
+) -> list:
+    """
+    encode & measure (res, crf) pairs of a chunk off one decode, store them where MutliResTrellis looks for them
+    :return: (res, crf, vmaf, bitrate) of each
+    """
+    probe_folder_path = (
+        os.path.join(os.path.dirname(chunk.chunk_path), f"{chunk.chunk_index}")
+        + os.path.sep
+    )
+    os.makedirs(probe_folder_path, exist_ok=True)
+
+    ctx.vmaf_reference_display = "FHD"
+    vmaf_options = ctx.get_vmaf_options()
+
+    ogspeed = enc.speed
+    enc.speed = 13
+
+    jobs = [
+        (
+            res,
+            crf,
+            os.path.join(
+                probe_folder_path,
+                f"{chunk.chunk_index}.{res.split(':')[0]}.{crf}{enc.get_chunk_file_extension()}",
+            ),
+        )
+        for res, crf in candidates
+    ]
+    # one decode of the chunk, split and scaled to every resolution at once
+    all_stats: List[EncodeStats] = LadderEncoder(
+        enc, video_filters=ctx.prototype_encoder.video_filters
+    ).run(
+        jobs=jobs,
+        metric_params=vmaf_options,
+        # psnr & luma ssim for the table come out of the vmaf pass
+        metric_to_calculate=[Metric.VMAF, Metric.PSNR, Metric.SSIM],
+        max_parallel=ctx.probe_batch_size,
+    )
+    enc.speed = ogspeed
+
+    results = []
+    for (res, crf, output_path), stats in zip(jobs, all_stats):
+        vmaf = get_metric_from_stats(
+            stats, statistical_representation=ctx.vmaf_target_representation
         )
-        os.makedirs(probe_folder_path, exist_ok=True)
-
-        ogspeed = enc.speed
-        enc.speed = 13
-
-        def log(_str):  # macro
-            ctx.log(
-                f"{chunk.log_prefix()}{_str}",
-                category="multi_res",
-            )
-
-        for res in resolutions:
-            vf = ctx.prototype_encoder.video_filters.split(",")
-            scale_str = f"scale={res}:flags=lanczos"
-
-            # replace the first scale filter if it exists
-            for i in range(len(vf)):
-                if ":flags=lanczos" in vf[i]:
-                    vf[i] = scale_str
-                    break
-
-            # if there is no scale filter, add it to the end
-            if scale_str not in ",".join(vf):
-                vf.append(scale_str)
-
-            vf = [f for f in vf if f != ""]
-
-            enc.video_filters = ",".join(vf)
-
-            for crf in crf_range:
-                enc.crf = crf
 
-                res_name_short = res.split(":")[0]
+        ctx.log(
+            f"{chunk.log_prefix()}Res: {res} VMAF: {vmaf} CRF: {crf} Bitrate: {stats.bitrate}",
+            category="multi_res",
+        )
 
-                enc.output_path = os.path.join(
-                    probe_folder_path,
-                    f"{chunk.chunk_index}.{res_name_short}.{crf}{enc.get_chunk_file_extension()}",
-                )
+        ctx.get_kv().set(
+            "multi_res_candidates",
+            get_candidate_key(chunk, res, crf),
+            {
+                "vmaf": vmaf,
+                "crf": crf,
+                "bitrate": stats.bitrate,
+                "file": output_path,
+                "res": res,
+                "psnr": stats.metrics[Metric.PSNR].mean,
+                "ssim_y": stats.metrics[Metric.SSIM].mean,
+            },
+        )
+        results.append((res, crf, vmaf, stats.bitrate))
+    return results
 
-                if ctx.get_kv().exists(
-                    "multi_res_candidates",
-                    f"{chunk.chunk_index}_{res_name_short}_{crf}",
-                ):
-                    continue
 
-                stats: EncodeStats = enc.run(
-                    metric_params=vmaf_options, metric_to_calculate=Metric.VMAF
-                )
+class EncodeMultiResCandidates(ChunkAnalyzePipelineItem):
+    def run(self, ctx, chunk: ChunkObject, enc: Encoder) -> Encoder:
+        if ctx.get_kv().get("multires_final_paths", "final_paths") is not None:
+            # the trellis is settled, the chunk is only here for its finals
+            return enc
 
-                vmaf = get_metric_from_stats(
-                    stats, statistical_representation=ctx.vmaf_target_representation
-                )
+        crf_low, crf_high = convexhull_get_crf_range(enc.get_codec())
+        crf_range = list(range(crf_low, crf_high, 2))
+        resolutions = convexhull_get_resolutions(enc.get_codec())
 
-                log(f"Res: {res} VMAF: {vmaf} CRF: {crf} Bitrate: {stats.bitrate}")
-
-                ctx.get_kv().set(
-                    "multi_res_candidates",
-                    f"{chunk.chunk_index}_{res_name_short}_{crf}",
-                    {
-                        "vmaf": vmaf,
-                        "crf": crf,
-                        "bitrate": stats.bitrate,
-                        "file": enc.output_path,
-                        "res": res,
-                    },
+        if ctx.multires_adaptive_sampling:
+            # the rest gets refined by MutliResTrellis around what the title picks
+            candidates = AdaptiveRdSampler(
+                grid=crf_range, resolutions=resolutions
+            ).get_coarse()
+        else:
+            candidates = [(res, crf) for res in resolutions for crf in crf_range]
+
+        # encode the probes fast to slow, not necessary but why not
+        candidates.reverse()
+        encode_candidates(
+            ctx,
+            chunk,
+            enc,
+            [
+                (res, crf)
+                for res, crf in candidates
+                if not ctx.get_kv().exists(
+                    "multi_res_candidates", get_candidate_key(chunk, res, crf)
                 )
-
-        enc.speed = ogspeed
+            ],
+        )
         return enc
@@ -13,7 +13,11 @@ from alabamaEncode.conent_analysis.opinionated_vmaf import (
 from alabamaEncode.core.alabama import AlabamaContext
 from alabamaEncode.encoder.encoder import Encoder
 from alabamaEncode.encoder.stats import EncodeStats
-from alabamaEncode.metrics.calculate import get_metric_from_stats
+from alabamaEncode.metrics.calculate import (
+    get_metric_from_stats,
+    refine_close_probe,
+    rescore_stats,
+)
 from alabamaEncode.metrics.metric import Metric
 from alabamaEncode.scene.chunk import ChunkObject
 
@@ -36,26 +40,28 @@ class TargetVmaf(ChunkAnalyzePipelineItem):
 
         probe_file_base = ctx.get_probe_file_base(chunk.chunk_path)
 
-        def get_score(_crf):
-            kv_key = f"{chunk.chunk_index}_{_crf}"
-            result_from_kv = kv.get(bucket="target_vmaf_probes", key=kv_key)
-            if result_from_kv is not None:
-                return float(result_from_kv)
+        enc_copy.speed = max(get_vmaf_probe_speed(enc_copy), enc.speed)
+        enc_copy.override_flags = None
 
-            enc_copy.crf = _crf
-            enc_copy.output_path = os.path.join(
+        probe_options = ctx.get_vmaf_options(probe=True)
+        # save_score puts the probe offset on top of the measured score, so compare without it
+        probe_target = target_metric
+        if metric == Metric.VMAF:
+            probe_target -= get_vmaf_probe_offset(enc_copy)
+
+        def get_probe_path(_crf):
+            return os.path.join(
                 probe_file_base,
                 f"probe.{_crf}{enc_copy.get_chunk_file_extension()}",
             )
-            enc_copy.speed = max(get_vmaf_probe_speed(enc_copy), enc.speed)
-            enc_copy.override_flags = None
-            # TODO: calculate metrics outside enc.run to add the flexibility to calc other ones
-            stats: EncodeStats = enc_copy.run(
-                metric_to_calculate=metric,
-                metric_params=ctx.get_vmaf_options(),
-                override_if_exists=False,
+
+        def get_score_from_kv(_crf):
+            result_from_kv = kv.get(
+                bucket="target_vmaf_probes", key=f"{chunk.chunk_index}_{_crf}"
             )
+            return float(result_from_kv) if result_from_kv is not None else None
 
+        def save_score(_crf, stats: EncodeStats):
             # TODO: offset the faster preset by metric amount
             result = get_metric_from_stats(
                 stats=stats,
@@ -64,9 +70,64 @@ class TargetVmaf(ChunkAnalyzePipelineItem):
             if metric == Metric.VMAF:
                 result += get_vmaf_probe_offset(enc_copy)
 
-            kv.set(bucket="target_vmaf_probes", key=kv_key, value=result)
+            kv.set(
+                bucket="target_vmaf_probes",
+                key=f"{chunk.chunk_index}_{_crf}",
+                value=result,
+            )
             return result
 
+        def measure(_crf, options) -> EncodeStats:
+            enc_copy.crf = _crf
+            enc_copy.output_path = get_probe_path(_crf)
+            return enc_copy.encode_and_measure(
+                metric_to_calculate=metric,
+                metric_params=options,
+                override_if_exists=False,
+            )
+
+        def refine(_crf, stats: EncodeStats) -> EncodeStats:
+            return refine_close_probe(
+                stats,
+                target=probe_target,
+                options=probe_options,
+                measure=lambda options: rescore_stats(
+                    stats,
+                    chunk=enc_copy.chunk,
+                    distorted_path=get_probe_path(_crf),
+                    options=options,
+                    metric=metric,
+                    video_filters=enc_copy.video_filters,
+                ),
+                statistical_representation=ctx.vmaf_target_representation,
+            )
+
+        def get_score(_crf):
+            result_from_kv = get_score_from_kv(_crf)
+            if result_from_kv is not None:
+                return result_from_kv
+
+            # TODO: calculate metrics outside enc.run to add the flexibility to calc other ones
+            stats = measure(_crf, probe_options)
+            return save_score(_crf, refine(_crf, stats))
+
+        def get_scores(_crfs):
+            """
+            Probe a whole bracket of crfs in one batch, the chunk gets decoded once for all of them
+            """
+            todo = [c for c in _crfs if get_score_from_kv(c) is None]
+            all_stats = enc_copy.run_batch(
+                crfs=todo,
+                output_paths=[get_probe_path(c) for c in todo],
+                metric_to_calculate=metric,
+                metric_params=probe_options,
+                override_if_exists=False,
+                max_parallel=ctx.probe_batch_size,
+            )
+            for c, stats in zip(todo, all_stats):
+                save_score(c, refine(c, stats))
+            return [get_score_from_kv(c) for c in _crfs]
+
         probes = ctx.probe_count
         if probes > 3:
             ctx.log(
@@ -78,6 +139,25 @@ class TargetVmaf(ChunkAnalyzePipelineItem):
         low_crf, high_crf = get_crf_limits(enc_copy)
         depth = 0
         mid_crf = 0
+
+        if ctx.probe_batch_size > 1 and probes > 1:
+            # a binary search has to wait on each probe, instead spread the probes evenly over the crf range,
+            # run them all at once and let the interpolation below pick the bracket around the target
+            bracket = sorted(
+                {
+                    round(low_crf + (high_crf - low_crf) * (i + 1) / (probes + 1))
+                    for i in range(probes)
+                }
+            )
+            mid_crf = bracket[len(bracket) // 2]
+            for _crf, score in zip(bracket, get_scores(bracket)):
+                ctx.log(
+                    f"{chunk.log_prefix()} crf: {_crf} {metric.name}: {score} (batched)",
+                    category="probe",
+                )
+                trys.append((_crf, score))
+            depth = probes
+
         while low_crf <= high_crf and depth < probes:
             mid_crf = (low_crf + high_crf) // 2
 
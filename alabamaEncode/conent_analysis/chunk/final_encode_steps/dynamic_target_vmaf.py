@@ -11,7 +11,11 @@ from alabamaEncode.encoder.codec import Codec
 from alabamaEncode.encoder.encoder import Encoder
 from alabamaEncode.encoder.rate_dist import EncoderRateDistribution
 from alabamaEncode.encoder.stats import EncodeStats
-from alabamaEncode.metrics.calculate import get_metric_from_stats
+from alabamaEncode.metrics.calculate import (
+    get_metric_from_stats,
+    refine_close_probe,
+    rescore_stats,
+)
 from alabamaEncode.metrics.metric import Metric
 from alabamaEncode.scene.chunk import ChunkObject
 
@@ -94,9 +98,22 @@ class DynamicTargetVmaf(FinalEncodeStep):
         trys = []
         stats = None
 
+        probe_options = ctx.get_vmaf_options(probe=True)
+
         def finish(_stats, crf):
+            # keep the probe of crf, not whichever one ran last
+            _, _stats, _, _, crf = min(trys, key=lambda _x: abs(_x[4] - crf))
+            if _stats.metric_results.confidence_interval > 0:
+                # the probes were subsampled, what gets reported is scored on every frame
+                _stats = rescore_stats(
+                    _stats,
+                    chunk=enc.chunk,
+                    distorted_path=get_probe_path(crf),
+                    options=ctx.get_vmaf_options(),
+                    video_filters=enc.video_filters,
+                )
             score_err = get_weighed_vmaf_score(
-                stats,
+                _stats,
                 codec=enc.get_codec(),
                 statistical_representation=ctx.vmaf_target_representation,
                 metric_target=metric_target,
@@ -107,7 +124,7 @@ class DynamicTargetVmaf(FinalEncodeStep):
                 f" score_error: {score_err}; bitrate: {_stats.bitrate} kb/s"
             )
             ctx.get_kv().set("best_crfs", chunk.chunk_index, crf)
-            os.rename(enc.output_path, original_output_path)
+            os.rename(get_probe_path(crf), original_output_path)
             if os.path.exists(probe_file_base):
                 shutil.rmtree(probe_file_base)
             return _stats
@@ -119,21 +136,42 @@ class DynamicTargetVmaf(FinalEncodeStep):
 
         recent_scores = []
 
-        def run_probe(crf) -> Tuple[float, EncodeStats, float, float, bool]:
+        def get_probe_path(crf):
+            return os.path.join(
+                probe_file_base,
+                f"{chunk.chunk_index}_{crf}{enc.get_chunk_file_extension()}",
+            )
+
+        def run_probe(
+            crf, batched_stats: EncodeStats = None
+        ) -> Tuple[float, EncodeStats, float, float, bool]:
             """
             :param crf: crf to try
-            :param run_faster_speed: to run at faster speed for initial search probes
+            :param batched_stats: stats of an encode `run_batch` already did for this crf
             :return: [vmaf error, stats, vmaf]
             """
             enc.crf = crf
-            enc.output_path = os.path.join(
-                probe_file_base,
-                f"{chunk.chunk_index}_{enc.crf}{enc.get_chunk_file_extension()}",
-            )
+            enc.output_path = get_probe_path(crf)
             nonlocal stats
-            stats = enc.run(
-                metric_to_calculate=Metric.VMAF,
-                metric_params=ctx.get_vmaf_options(),
+            if batched_stats is not None:
+                stats = batched_stats
+            else:
+                stats = enc.encode_and_measure(
+                    metric_to_calculate=Metric.VMAF,
+                    metric_params=probe_options,
+                )
+            stats = refine_close_probe(
+                stats,
+                target=metric_target,
+                options=probe_options,
+                measure=lambda options: rescore_stats(
+                    stats,
+                    chunk=enc.chunk,
+                    distorted_path=get_probe_path(crf),
+                    options=options,
+                    video_filters=enc.video_filters,
+                ),
+                statistical_representation=ctx.vmaf_target_representation,
             )
             _metric = get_metric_from_stats(
                 stats, statistical_representation=ctx.vmaf_target_representation
@@ -195,12 +233,27 @@ class DynamicTargetVmaf(FinalEncodeStep):
         a = round(a) if not enc.supports_float_crfs() else a
         b = round(b) if not enc.supports_float_crfs() else b
 
-        current_metric_error_a, stats_a, metric_a, score_a, quit_early = run_probe(a)
+        batched_a, batched_b = None, None
+        if ctx.probe_batch_size > 1 and a != b:
+            # the first two golden section points don't depend on each other, encode them side by side
+            batched_a, batched_b = enc.run_batch(
+                crfs=[a, b],
+                output_paths=[get_probe_path(a), get_probe_path(b)],
+                metric_to_calculate=Metric.VMAF,
+                metric_params=probe_options,
+                max_parallel=ctx.probe_batch_size,
+            )
+
+        current_metric_error_a, stats_a, metric_a, score_a, quit_early = run_probe(
+            a, batched_a
+        )
 
         if score_a < max_score_error or quit_early:
             return finish(stats_a, a)
 
-        current_metric_error_b, stats_b, metric_b, score_b, quit_early = run_probe(b)
+        current_metric_error_b, stats_b, metric_b, score_b, quit_early = run_probe(
+            b, batched_b
+        )
 
         if score_b < max_score_error or quit_early:
             return finish(stats_b, b)
@@ -279,7 +332,7 @@ class DynamicTargetVmaf(FinalEncodeStep):
             log(f"crf {last_crf_try} already tried, quiting")
             return finish(stats_a, last_crf_try)
 
-        current_metric_error, stats, metric, score = run_probe(last_crf_try)
+        current_metric_error, stats, metric, score, _ = run_probe(last_crf_try)
         log(
             f"crf: {last_crf_try} {metric_name}: {metric} score_error: {score} "
             f"attempt {tries}/{max_tries}"
@@ -0,0 +1,238 @@
+"""
+Per-title convex hull optimizer for the multi-res ladder, picks one crf per chunk for every
+(resolution, rung) pair with a Lagrangian sweep over the whole candidate table at once
+"""
+
+import math
+from typing import List, Dict, Tuple
+
+import numpy as np
+
+__all__ = [
+    "CandidateTable",
+    "solve_min_bits",
+    "get_best_resolutions",
+    "interpolate_rd",
+]
+
+# lambdas are searched on a log scale between these, in kbit per (vmaf point * second)
+LAMBDA_MIN = 1e-6
+LAMBDA_MAX = 1e9
+BISECT_STEPS = 64
+
+
+def _monotone_cubic(x: List[float], y: List[float], at: float) -> float:
+    """
+    Fritsch-Carlson monotone cubic interpolation, follows the bend of the curve without overshooting the samples
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if len(x) < 3:
+        return float(np.interp(at, x, y))
+    h = np.diff(x)
+    delta = np.diff(y) / h
+    slopes = np.zeros_like(y)
+    slopes[0], slopes[-1] = delta[0], delta[-1]
+    for k in range(1, len(x) - 1):
+        if delta[k - 1] * delta[k] > 0:
+            w1, w2 = 2 * h[k] + h[k - 1], h[k] + 2 * h[k - 1]
+            slopes[k] = (w1 + w2) / (w1 / delta[k - 1] + w2 / delta[k])
+
+    k = int(np.clip(np.searchsorted(x, at) - 1, 0, len(x) - 2))
+    t = (at - x[k]) / h[k]
+    return float(
+        (2 * t**3 - 3 * t**2 + 1) * y[k]
+        + (t**3 - 2 * t**2 + t) * h[k] * slopes[k]
+        + (-2 * t**3 + 3 * t**2) * y[k + 1]
+        + (t**3 - t**2) * h[k] * slopes[k + 1]
+    )
+
+
+def interpolate_rd(
+    crfs: List[float], points: List[Tuple[float, float]], crf: float
+) -> Tuple[float, float]:
+    """
+    Estimate the (vmaf, bitrate) of an unencoded crf between encoded ones, bitrate is close to exponential in crf
+    so it's interpolated on a log scale
+    :param crfs: the encoded crfs, ascending
+    :param points: (vmaf, bitrate) of each
+    """
+    vmaf = _monotone_cubic(crfs, [vmaf for vmaf, _ in points], crf)
+    log_bitrate = _monotone_cubic(
+        crfs, [math.log(max(bitrate, 1e-6)) for _, bitrate in points], crf
+    )
+    return vmaf, math.exp(log_bitrate)
+
+
+class CandidateTable:
+    """
+    The multi_res_candidates kv bucket as arrays indexed [resolution, chunk, crf],
+    missing candidates are nan in `vmaf` and `bits`
+    """
+
+    def __init__(
+        self,
+        candidates: dict,
+        chunk_indexes: List[int],
+        lengths: List[float],
+        resolutions: List[str],
+        crfs: List[int],
+    ):
+        """
+        :param candidates: the bucket, "{chunk index}_{res}_{crf}" -> {vmaf, bitrate, crf, file, res}
+        :param lengths: seconds of every chunk, in the order of `chunk_indexes`
+        :param resolutions: short resolution names as used in the keys, e.g. "1280"
+        """
+        self.chunk_indexes = chunk_indexes
+        self.resolutions = resolutions
+        self.crfs = crfs
+        self.lengths = np.asarray(lengths, dtype=np.float64)
+
+        shape = (len(resolutions), len(chunk_indexes), len(crfs))
+        self.vmaf = np.full(shape, np.nan)
+        self.bitrate = np.full(shape, np.nan)
+        self.entries: Dict[tuple, dict] = {}
+        for r, res in enumerate(resolutions):
+            for c, chunk_index in enumerate(chunk_indexes):
+                for k, crf in enumerate(crfs):
+                    data = candidates.get(f"{chunk_index}_{res}_{crf}")
+                    if data is None:
+                        continue
+                    self.vmaf[r, c, k] = data["vmaf"]
+                    self.bitrate[r, c, k] = data["bitrate"]
+                    self.entries[(r, c, k)] = data
+
+        # True where a candidate is interpolated instead of encoded, see `fill_gaps`
+        self.estimated = np.zeros(shape, dtype=bool)
+
+        # kbit each candidate costs
+        self.bits = self.bitrate * self.lengths[None, :, None]
+
+    def fill_gaps(self):
+        """
+        Estimate the crfs an adaptive sampler skipped between two encoded ones of the same chunk and resolution,
+        the finals get encoded at the picked crf anyway, so a pick doesn't need its own probe.
+        Nothing is extrapolated past a chunk's lowest or highest encoded crf
+        """
+        for r in range(len(self.resolutions)):
+            for c in range(len(self.chunk_indexes)):
+                known = np.where(~np.isnan(self.vmaf[r, c]))[0]
+                if len(known) < 2:
+                    continue
+                crfs = [self.crfs[k] for k in known]
+                points = [(self.vmaf[r, c, k], self.bitrate[r, c, k]) for k in known]
+                for k in range(known[0] + 1, known[-1]):
+                    if not np.isnan(self.vmaf[r, c, k]):
+                        continue
+                    vmaf, bitrate = interpolate_rd(crfs, points, self.crfs[k])
+                    self.vmaf[r, c, k] = vmaf
+                    self.bitrate[r, c, k] = bitrate
+                    self.estimated[r, c, k] = True
+                    self.entries[(r, c, k)] = {
+                        **self.entries[(r, c, known[0])],
+                        "vmaf": vmaf,
+                        "bitrate": bitrate,
+                        "crf": self.crfs[k],
+                        "file": None,
+                        "estimated": True,
+                    }
+        self.bits = self.bitrate * self.lengths[None, :, None]
+
+    @property
+    def duration(self) -> float:
+        return float(self.lengths.sum())
+
+    def get_missing(self) -> np.ndarray:
+        """
+        :return: [resolution, chunk] True where a chunk has no candidate at all for a resolution
+        """
+        return np.all(np.isnan(self.vmaf), axis=2)
+
+    def _pick(self, lambdas: np.ndarray) -> np.ndarray:
+        """
+        For every lambda of shape [..., resolution] pick the crf per chunk minimising bits - lambda * seconds * vmaf
+        :return: crf indexes of shape [..., resolution, chunk]
+        """
+        cost = (
+            self.bits
+            - lambdas[..., None, None] * self.lengths[None, :, None] * self.vmaf
+        )
+        cost = np.where(np.isnan(cost), np.inf, cost)
+        return np.argmin(cost, axis=-1)
+
+    def _gather(self, values: np.ndarray, picks: np.ndarray) -> np.ndarray:
+        """
+        :return: values[resolution, chunk, picks[..., resolution, chunk]] of shape [..., resolution, chunk]
+        """
+        broadcast = np.broadcast_to(values, picks.shape + (values.shape[-1],))
+        return np.take_along_axis(broadcast, picks[..., None], axis=-1)[..., 0]
+
+    def pooled_vmaf(self, picks: np.ndarray) -> np.ndarray:
+        """
+        :return: duration weighted mean vmaf of the picks, shape [..., resolution]
+        """
+        vmaf = np.nan_to_num(self._gather(self.vmaf, picks), nan=0)
+        return (vmaf * self.lengths).sum(axis=-1) / self.duration
+
+    def average_bitrate(self, picks: np.ndarray) -> np.ndarray:
+        """
+        :return: kbps of the picks played back to back, shape [..., resolution]
+        """
+        bits = np.nan_to_num(self._gather(self.bits, picks), nan=0)
+        return bits.sum(axis=-1) / self.duration
+
+
+def _bisect(table: CandidateTable, goals: np.ndarray) -> np.ndarray:
+    """
+    Find, for every goal and resolution at once, the smallest lambda whose picks reach the pooled vmaf goal,
+    pooled vmaf is non-decreasing in lambda
+    :param goals: shape [rung]
+    :return: picks of shape [rung, resolution, chunk]
+    """
+    shape = (len(goals), len(table.resolutions))
+    low = np.full(shape, np.log(LAMBDA_MIN))
+    high = np.full(shape, np.log(LAMBDA_MAX))
+    goals = goals[:, None]
+    for _ in range(BISECT_STEPS):
+        mid = (low + high) / 2
+        reached = table.pooled_vmaf(table._pick(np.exp(mid))) >= goals
+        high = np.where(reached, mid, high)
+        low = np.where(reached, low, mid)
+    return table._pick(np.exp(high))
+
+
+def solve_min_bits(table: CandidateTable, vmaf_targets: List[float]) -> dict:
+    """
+    For every rung: the cheapest picks whose pooled vmaf reaches the target, for every resolution
+    :return: {"picks": [rung, resolution, chunk] crf indexes, "vmaf": [rung, resolution] pooled vmaf,
+    "bitrate": [rung, resolution] kbps, "feasible": [rung, resolution]}
+    """
+    picks = _bisect(table, np.asarray(vmaf_targets, dtype=np.float64))
+    vmaf = table.pooled_vmaf(picks)
+    complete = ~np.any(table.get_missing(), axis=1)
+    return {
+        "picks": picks,
+        "vmaf": vmaf,
+        "bitrate": table.average_bitrate(picks),
+        # float noise on the pooled mean
+        "feasible": (vmaf >= np.asarray(vmaf_targets)[:, None] - 1e-9)
+        & complete[None, :],
+    }
+
+
+def get_best_resolutions(table: CandidateTable, solution: dict) -> np.ndarray:
+    """
+    The convex hull point of every rung: the resolution that reaches the target with the fewest bits,
+    or the one that gets closest when none does
+    :param solution: see `solve_min_bits`
+    :return: resolution indexes, shape [rung]
+    """
+    complete = ~np.any(table.get_missing(), axis=1)
+    best = []
+    for t in range(solution["vmaf"].shape[0]):
+        feasible = np.where(solution["feasible"][t])[0]
+        if len(feasible) > 0:
+            best.append(feasible[np.argmin(solution["bitrate"][t, feasible])])
+        else:
+            candidates = np.where(complete)[0]
+            best.append(candidates[np.argmax(solution["vmaf"][t, candidates])])
+    return np.asarray(best, dtype=int)
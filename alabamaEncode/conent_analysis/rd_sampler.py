@@ -0,0 +1,103 @@
+"""
+Adaptive sampling of the rate-distortion curves for the multi-res convex hull,
+instead of encoding every crf of every resolution of every chunk
+"""
+
+from typing import List, Dict, Tuple
+
+from alabamaEncode.conent_analysis.convex_hull import (
+    CandidateTable,
+    get_best_resolutions,
+)
+
+__all__ = ["AdaptiveRdSampler"]
+
+# solving the title again after every round of refining encodes, the picks settle in 3-5 on the experiment's curves
+MAX_REFINE_ROUNDS = 8
+
+
+class AdaptiveRdSampler:
+    """
+    Decides which (resolution, crf) candidates get encoded. Every chunk starts with a coarse grid of crfs per
+    resolution and the crfs in between get interpolated (see CandidateTable.fill_gaps).
+    What the trellis picks depends on a lambda per rung that only the whole title sets, so the refining happens
+    after solving the title: for every resolution within `margin` of a rung's cheapest one, the interpolated picks
+    and the interpolated crfs next to them get encoded, then the title is solved again, until those picks are
+    encoded vertices with encoded neighbours. Resolutions that no rung comes close to picking never get refined
+    past the coarse grid.
+    """
+
+    def __init__(
+        self,
+        grid: List[float],
+        resolutions: List[str],
+        coarse_points=4,
+        margin=0.15,
+    ):
+        """
+        :param grid: every crf the exhaustive search would encode
+        :param resolutions: in the order of the candidate table's resolutions
+        :param coarse_points: crfs per resolution every chunk starts with, always including both ends of the grid
+        :param margin: how much more than a rung's cheapest resolution another one can cost and still get refined
+        """
+        self.grid = sorted(grid)
+        self.resolutions = resolutions
+        self.coarse_points = coarse_points
+        self.margin = margin
+
+    def get_coarse_grid(self) -> List[float]:
+        n = min(self.coarse_points, len(self.grid))
+        if n <= 1:
+            return self.grid[:1]
+        indexes = sorted({round(i * (len(self.grid) - 1) / (n - 1)) for i in range(n)})
+        return [self.grid[i] for i in indexes]
+
+    def get_coarse(self) -> List[Tuple[str, float]]:
+        """
+        :return: the (resolution, crf) encodes every chunk starts with
+        """
+        return [
+            (res, crf) for res in self.resolutions for crf in self.get_coarse_grid()
+        ]
+
+    def get_contending(self, table: CandidateTable, solution: dict) -> List[List[int]]:
+        """
+        :param solution: see `solve_min_bits`, on the table with its gaps filled
+        :return: per rung, the indexes of the resolutions that could still end up being picked for it
+        """
+        best = get_best_resolutions(table, solution)
+        contending = []
+        for t in range(len(best)):
+            cheapest = solution["bitrate"][t, best[t]]
+            contending.append(
+                [
+                    r
+                    for r in range(len(table.resolutions))
+                    if r == best[t]
+                    or (
+                        solution["feasible"][t, r]
+                        and solution["bitrate"][t, r] <= cheapest * (1 + self.margin)
+                    )
+                ]
+            )
+        return contending
+
+    def get_refinement(
+        self, table: CandidateTable, solution: dict
+    ) -> Dict[int, List[Tuple[str, float]]]:
+        """
+        :param table: the candidates encoded so far, with `fill_gaps` applied
+        :param solution: see `solve_min_bits`, on that table
+        :return: chunk index -> (resolution, crf) encodes to run before solving again, empty once the picks
+        that matter are all encoded
+        """
+        wanted: Dict[int, set] = {}
+        for t, resolutions in enumerate(self.get_contending(table, solution)):
+            for r in resolutions:
+                for c, pick in enumerate(solution["picks"][t, r]):
+                    for k in range(max(pick - 1, 0), min(pick + 2, len(table.crfs))):
+                        if table.estimated[r, c, k]:
+                            wanted.setdefault(table.chunk_indexes[c], set()).add(
+                                (self.resolutions[r], table.crfs[k])
+                            )
+        return {chunk_index: sorted(encodes) for chunk_index, encodes in wanted.items()}
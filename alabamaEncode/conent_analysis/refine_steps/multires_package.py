@@ -1,12 +1,100 @@
 import os
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Tuple
 
 from alabamaEncode.conent_analysis.opinionated_vmaf import get_vmaf_list
 from alabamaEncode.conent_analysis.refine_step import RefineStep
+from alabamaEncode.core.background import KeyedBackgroundTasks
 from alabamaEncode.core.bin_utils import get_binary
+from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.core.cmaf import (
+    CmafTrack,
+    CmafVideoSegmenter,
+    SEGMENT_DURATION,
+    group_chunks_into_segments,
+    split_fragmented_mp4,
+)
 from alabamaEncode.core.ffmpeg import Ffmpeg
+from alabamaEncode.core.manifest import write_mpd, write_hls
 from alabamaEncode.core.path import PathAlabama
+from alabamaEncode.encoder.codec import Codec
 from alabamaEncode.scene.concat import VideoConcatenator
 
+# kbps of every audio rendition
+AUDIO_LADDER = [96, 128]
+# fragmented so the native segmenter can cut it without touching the samples, the packager reads it just as well
+AUDIO_FRAGMENT_FLAGS = "-movflags +empty_moov+default_base_moof -frag_duration 2000000"
+
+
+def get_audio_ladder_paths(ctx) -> List[Tuple[int, str]]:
+    return [
+        (bitrate, os.path.join(ctx.output_folder, f"audio_track_{bitrate}.mp4"))
+        for bitrate in AUDIO_LADDER
+    ]
+
+
+def encode_audio_ladder(ctx, duration: float) -> List[str]:
+    """
+    Every rung of the audio ladder from a single decode of the source audio, one ffmpeg with an output per rung
+    :param duration: seconds of the encoded video, the audio gets cut to it when there is an end offset
+    :return: paths of the rungs, empty if the source has no audio
+    """
+    rungs = get_audio_ladder_paths(ctx)
+    if all([os.path.exists(path) for _, path in rungs]):
+        return [path for _, path in rungs]
+
+    tracks = Ffmpeg.get_tracks(PathAlabama(ctx.input_file))
+    if not any([track["codec_type"] == "audio" for track in tracks]):
+        print("No audio track found, not encoding")
+        return []
+
+    command = f"{get_binary('ffmpeg')} -y -v error"
+    if ctx.start_offset != -1:
+        command += f" -ss {ctx.start_offset}"
+    command += f" -i {shlex.quote(ctx.input_file)}"
+    if ctx.end_offset != -1:
+        command += f" -t {duration}"
+
+    temp_paths = []
+    for bitrate, path in rungs:
+        # written under a temp name so a killed run doesn't leave a truncated rung behind that looks done
+        temp_path = f"{path}.temp.mp4"
+        temp_paths.append((temp_path, path))
+        command += (
+            f" -map 0:a:0 -c:a libopus -ac 2 -b:a {bitrate}k -vbr on -map_metadata -1"
+            f" {AUDIO_FRAGMENT_FLAGS} {shlex.quote(temp_path)}"
+        )
+
+    run_cli(command).verify(fail_message="Audio ladder encoding failed")
+    for temp_path, path in temp_paths:
+        if Ffmpeg.check_for_invalid(PathAlabama(temp_path)):
+            raise Exception(f"Audio ladder encoding failed, {temp_path} is invalid")
+        os.replace(temp_path, path)
+    return [path for _, path in rungs]
+
+
+_audio_ladder_tasks = KeyedBackgroundTasks()
+
+
+def start_audio_ladder(ctx, sequence) -> Future:
+    """
+    Start encoding the audio ladder in the background, it only depends on the source, so it can run
+    while the video chunks are still encoding. Calling it again for the same output returns the same future
+    unless the previous run failed.
+    :return: future of `encode_audio_ladder`, its result is (paths, seconds it took)
+    """
+
+    def work():
+        start = time.time()
+        paths = encode_audio_ladder(
+            ctx, sum([chunk.get_lenght() for chunk in sequence.chunks])
+        )
+        return paths, time.time() - start
+
+    return _audio_ladder_tasks.start(ctx.output_folder, work)
+
 
 class MutliResPackage(RefineStep):
     def __call__(self, ctx, sequence):
@@ -27,57 +115,158 @@ class MutliResPackage(RefineStep):
                     print("Not packaging, final paths not done")
                     return
 
-        concated_files = []
-
-        ctc = VideoConcatenator(
-            output="",
-            file_with_audio=ctx.input_file,
-            start_offset=ctx.start_offset,
-            end_offset=ctx.end_offset,
-            title=ctx.get_title(),
-            encoder_name=ctx.encoder_name,
-            mux_audio=False,
-            subs_file=[],
-        )
+        # no-op when it was started alongside the chunk encodes
+        audio_future = start_audio_ladder(ctx, sequence)
+        timings = {}
 
+        chunk_paths = {}
         for path in final_paths:
-            vmaf_target = path["vmaf_target"]
-            print(f"\n vmaf_target: {vmaf_target}")
-            # concat
-            out_path = os.path.join(
-                ctx.output_folder,
-                f"vmaf{vmaf_target}_{path['res']}.mp4",
+            chunk_paths[path["vmaf_target"]] = [
+                ctx.get_kv().get(
+                    "multires_final_paths", f"{c.chunk_index}_{path['vmaf_target']}"
+                )
+                for c in sequence.chunks
+            ]
+
+        native = codec == Codec.av1 and all(
+            [p.endswith(".ivf") for paths in chunk_paths.values() for p in paths]
+        )
+        if native:
+            video_bitrates, audio_bitrates = self.package_cmaf(
+                ctx, sequence, final_paths, chunk_paths, audio_future, timings
+            )
+        else:
+            video_bitrates, audio_bitrates = self.package_with_packager(
+                ctx, final_paths, chunk_paths, audio_future, timings
             )
-            ctc.output = out_path
-            concated_files += [out_path]
 
-            ctc.files = []
-            for c in sequence.chunks:
-                chunk_vmaf_path = ctx.get_kv().get(
-                    "multires_final_paths", f"{c.chunk_index}_{vmaf_target}"
-                )
-                ctc.files += [chunk_vmaf_path]
+        stats_content = ""
+        for path, bitrate in zip(final_paths, video_bitrates):
+            stats_content += (
+                f"vmaf {path['vmaf_target']} res {path['res']} bitrate {bitrate}\n"
+            )
 
-            ctc.concat_videos()
+        for bitrate in audio_bitrates:
+            stats_content += f"audio bitrate {bitrate}k\n"
 
-        print("\n encoding audio tracks")
-        audio_track_96_path = os.path.join(
-            ctx.output_folder,
-            f"audio_track_96.mp4",
+        for step, seconds in timings.items():
+            stats_content += f"time {step} {seconds:.2f}s\n"
+
+        with open(os.path.join(ctx.output_folder, "stats.txt"), "w") as f:
+            f.write(stats_content)
+
+    @staticmethod
+    def wait_for_audio(audio_future: Future, timings: dict) -> List[str]:
+        print("\nWaiting for the audio ladder")
+        start = time.time()
+        audio_paths, audio_encode_time = audio_future.result()
+        timings["audio ladder encode"] = audio_encode_time
+        timings["audio ladder wait"] = time.time() - start
+        return audio_paths
+
+    def package_cmaf(
+        self, ctx, sequence, final_paths, chunk_paths, audio_future, timings
+    ) -> Tuple[List[int], List[int]]:
+        """
+        Chunks straight into CMAF segments, no concat and no packager re-reading the renditions
+        :return: (kbps of every rendition, kbps of every audio rung)
+        """
+        # every rendition is cut on the same chunk boundaries, so the segments line up across the ladder
+        groups = group_chunks_into_segments(
+            [chunk.get_lenght() for chunk in sequence.chunks], SEGMENT_DURATION
         )
-        ctc.audio_param_override = "-c:a libopus -ac 2 -b:a 96k -vbr on"
-        ctc.output = audio_track_96_path
-        ctc.audio_only = True
-        ctc.concat_videos()
 
-        audio_track_128_path = os.path.join(
-            ctx.output_folder,
-            f"audio_track_128.mp4",
+        def segment(path) -> CmafTrack:
+            name = f"vmaf{path['vmaf_target']}_{path['res']}"
+            segmenter = CmafVideoSegmenter(
+                os.path.join(ctx.output_folder, name), track_id=name
+            )
+            files = chunk_paths[path["vmaf_target"]]
+            for group in groups:
+                segmenter.add_segment([files[i] for i in group])
+            return segmenter.track
+
+        print(
+            f"\nSegmenting {len(final_paths)} renditions into {len(groups)} segments each"
         )
-        ctc.audio_param_override = "-c:a libopus -ac 2 -b:a 128k -vbr on"
-        ctc.output = audio_track_128_path
-        ctc.audio_only = True
-        ctc.concat_videos()
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=len(final_paths)) as executor:
+            video_tracks = list(executor.map(segment, final_paths))
+        timings["segment renditions"] = time.time() - start
+
+        audio_paths = self.wait_for_audio(audio_future, timings)
+        start = time.time()
+        audio_tracks = []
+        for (bitrate, _), audio_path in zip(get_audio_ladder_paths(ctx), audio_paths):
+            folder = os.path.join(ctx.output_folder, f"audio_{bitrate}")
+            track = split_fragmented_mp4(audio_path, folder, f"audio_{bitrate}", "opus")
+            if track is None:
+                # left behind by a run from before the ladder was fragmented
+                fragmented_path = f"{audio_path}.fragmented.mp4"
+                run_cli(
+                    f"{get_binary('ffmpeg')} -y -v error -i {shlex.quote(audio_path)} -c copy "
+                    f"{AUDIO_FRAGMENT_FLAGS} {shlex.quote(fragmented_path)}"
+                ).verify(fail_message=f"Failed to fragment {audio_path}")
+                os.replace(fragmented_path, audio_path)
+                track = split_fragmented_mp4(
+                    audio_path, folder, f"audio_{bitrate}", "opus"
+                )
+            audio_tracks.append(track)
+        timings["segment audio"] = time.time() - start
+
+        start = time.time()
+        write_mpd(ctx.output_file, video_tracks, audio_tracks)
+        write_hls(
+            os.path.join(os.path.dirname(ctx.output_file), "master.m3u8"),
+            video_tracks,
+            audio_tracks,
+        )
+        timings["manifests"] = time.time() - start
+
+        return (
+            [int(t.get_average_bandwidth() / 1000) for t in video_tracks],
+            [int(t.get_average_bandwidth() / 1000) for t in audio_tracks],
+        )
+
+    def package_with_packager(
+        self, ctx, final_paths, chunk_paths, audio_future, timings
+    ) -> Tuple[List[int], List[int]]:
+        """
+        Concat every rendition, then let the packager cut them, for chunks the native segmenter can't read
+        :return: (kbps of every rendition, kbps of every audio rung)
+        """
+
+        def concat(path) -> str:
+            out_path = os.path.join(
+                ctx.output_folder,
+                f"vmaf{path['vmaf_target']}_{path['res']}.mp4",
+            )
+            # every rendition gets its own temp dir, the concat list and the intermediate would collide otherwise
+            temp_dir = os.path.join(
+                ctx.temp_folder, f"concat_vmaf{path['vmaf_target']}", ""
+            )
+            os.makedirs(temp_dir, exist_ok=True)
+            VideoConcatenator(
+                files=chunk_paths[path["vmaf_target"]],
+                output=out_path,
+                file_with_audio=ctx.input_file,
+                start_offset=ctx.start_offset,
+                end_offset=ctx.end_offset,
+                title=ctx.get_title(),
+                encoder_name=ctx.encoder_name,
+                mux_audio=False,
+                subs_file=[],
+                temp_dir=temp_dir,
+            ).concat_videos()
+            return out_path
+
+        print(f"\nConcatenating {len(final_paths)} renditions")
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=len(final_paths)) as executor:
+            concated_files = list(executor.map(concat, final_paths))
+        timings["concat renditions"] = time.time() - start
+
+        audio_paths = self.wait_for_audio(audio_future, timings)
 
         # example cli:
         # packager \
@@ -98,42 +287,29 @@ class MutliResPackage(RefineStep):
             f"trick.mp4",
         )
         trick = f" in={concated_files[-1]},stream=video,output={trick_path},trick_play_factor=1 "
-        audio = (
-            f" in={audio_track_96_path},stream=audio,output={audio_track_96_path} "
-            f" in={audio_track_128_path},stream=audio,output={audio_track_128_path}"
-        )
+        audio = ""
+        for audio_path in audio_paths:
+            audio += f" in={audio_path},stream=audio,output={audio_path} "
 
         print("\n\n")
         final_cli = (
             f"{get_binary('packager')} {files_cli} {trick} {audio}"
-            f" --segment_duration 3 "
+            f" --segment_duration {SEGMENT_DURATION} "
             f" --mpd_output {ctx.output_file}"
         )
         print("Running final cli:")
         print(final_cli)
+        start = time.time()
         os.system(final_cli)
+        timings["packager"] = time.time() - start
 
-        stats_content = ""
-        for path in final_paths:
-            out_path = PathAlabama(
-                os.path.join(
-                    ctx.output_folder,
-                    f"vmaf{path['vmaf_target']}_{path['res']}.mp4",
-                )
-            )
-            bitrate = int(Ffmpeg.get_total_bitrate(out_path) / 1000)
-            stats_content += (
-                f"vmaf {path['vmaf_target']} res {path['res']} bitrate {bitrate}\n"
-            )
-
-        # audio track
-        bitrate = int(Ffmpeg.get_total_bitrate(PathAlabama(audio_track_96_path)) / 1000)
-        stats_content += f"audio bitrate {bitrate}k\n"
-
-        bitrate = int(
-            Ffmpeg.get_total_bitrate(PathAlabama(audio_track_128_path)) / 1000
+        return (
+            [
+                int(Ffmpeg.get_total_bitrate(PathAlabama(file)) / 1000)
+                for file in concated_files
+            ],
+            [
+                int(Ffmpeg.get_total_bitrate(PathAlabama(file)) / 1000)
+                for file in audio_paths
+            ],
         )
-        stats_content += f"audio bitrate {bitrate}k\n"
-
-        with open(os.path.join(ctx.output_folder, "stats.txt"), "w") as f:
-            f.write(stats_content)
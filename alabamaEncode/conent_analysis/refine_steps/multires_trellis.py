@@ -1,10 +1,26 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from alabamaEncode.conent_analysis.chunk.analyze_steps.multires_encode_candidates import (
+    encode_candidates,
+)
+from alabamaEncode.conent_analysis.convex_hull import (
+    CandidateTable,
+    solve_min_bits,
+    get_best_resolutions,
+)
 from alabamaEncode.conent_analysis.opinionated_vmaf import (
     get_vmaf_list,
     convexhull_get_crf_range,
     convexhull_get_resolutions,
 )
+from alabamaEncode.conent_analysis.rd_sampler import (
+    AdaptiveRdSampler,
+    MAX_REFINE_ROUNDS,
+)
 from alabamaEncode.conent_analysis.refine_step import RefineStep
-from alabamaEncode.encoder.codec import Codec
 
 
 class MutliResTrellis(RefineStep):
@@ -50,123 +66,96 @@ class MutliResTrellis(RefineStep):
         #         f"Compressing vmaf range to: {data_min} - {scaled_max}; final vmaf targets: {vmafs}"
         #     )
 
-        fps = sequence.chunks[0].framerate
-
-        trellis_paths = {}
-        for res in resolutions:
-            for vmaf_target in vmafs:
-                current_path = []
-                print(f"Calculating trellis for res: {res} vmaf_target: {vmaf_target}")
-                for chunk in sequence.chunks:
-                    all_crfs = []
-                    for crf in crf_range:
-                        data = ctx.get_kv().get(
-                            "multi_res_candidates",
-                            f"{chunk.chunk_index}_{res}_{crf}",
-                        )
-                        if data is None:
-                            continue
-                        data = {
-                            "vmaf": data["vmaf"],
-                            "crf": data["crf"],
-                            "bitrate": data["bitrate"],
-                            "file": data["file"],
-                            "res": data["res"],
-                            "index": chunk.chunk_index,
-                            "length": chunk.get_lenght(),
-                        }
-                        all_crfs.append(data)
-
-                    # sort by vmaf error from the target vmaf
-
-                    best_fit = all_crfs[0]
-                    if ctx.prototype_encoder.get_codec() == Codec.av1:
-
-                        def get_s(x):
-                            frames = x["length"] * fps
-                            bitrate = x["bitrate"]  # in kbps
-
-                            # bitrate component
-                            bitrate_weight = (bitrate / 650) ** 0.4 - 1
-                            bitrate_weight *= 2
-
-                            # Exponential component for the number of frames
-                            size_kb = (frames * bitrate) / 1000
-                            overall_size_weight = (size_kb / 250) ** 0.5
-                            overall_size_weight = max(overall_size_weight, 1)
-
-                            # Combine the components
-                            combined_weight = bitrate_weight * overall_size_weight
-
-                            # Ensure the combined weight is not negative
-                            combined_weight = max(combined_weight, 0)
-                            return abs(vmaf_target - x["vmaf"]) + combined_weight
-
-                        all_crfs.sort(key=lambda x: get_s(x))
-                        best_fit = all_crfs[0]
-
-                    else:
-                        all_crfs.sort(key=lambda x: abs(x["vmaf"] - vmaf_target))
-                        best_fit = all_crfs[0]
-
-                    current_path.append(best_fit)
-
-                if f"{vmaf_target}" not in trellis_paths:
-                    trellis_paths[f"{vmaf_target}"] = {}
-                trellis_paths[f"{vmaf_target}"][f"{res}"] = current_path
-
-        # now the filtering part, we need to pick the len(vmafs) best paths, one for each quality target
-        vmafs_reverse = vmafs[::-1]
-        prev_bitrate = -1
+        chunks = sequence.chunks
+        sampler = AdaptiveRdSampler(
+            grid=crf_range, resolutions=convexhull_get_resolutions(codec)
+        )
+        for refine_round in range(MAX_REFINE_ROUNDS + 1):
+            # the whole bucket at once, one kv.get per candidate re-reads the bucket from disk every time
+            table = CandidateTable(
+                candidates=ctx.get_kv().get_all("multi_res_candidates"),
+                chunk_indexes=[chunk.chunk_index for chunk in chunks],
+                lengths=[chunk.get_lenght() for chunk in chunks],
+                resolutions=resolutions,
+                crfs=crf_range,
+            )
+            missing = table.get_missing()
+            if missing.all(axis=0).any():
+                raise RuntimeError(
+                    "No multi-res candidates for chunks: "
+                    f"{[table.chunk_indexes[c] for c in np.where(missing.all(axis=0))[0]]}"
+                )
+            # the crfs the adaptive sampling skipped, a no-op after an exhaustive one
+            table.fill_gaps()
+
+            # every rung x resolution in one pass, the cheapest picks whose pooled vmaf reaches the rung
+            solution = solve_min_bits(table, vmafs)
+            if not ctx.multires_adaptive_sampling:
+                break
+            wanted = sampler.get_refinement(table, solution)
+            if len(wanted) == 0:
+                break
+            if refine_round == MAX_REFINE_ROUNDS:
+                print(
+                    f"Picks still not settled after {MAX_REFINE_ROUNDS} refine rounds, "
+                    f"going with {sum([len(w) for w in wanted.values()])} interpolated candidates"
+                )
+                break
+            print(
+                f"Refining {sum([len(w) for w in wanted.values()])} candidates around the picks "
+                f"of {len(wanted)} chunks, round {refine_round + 1}"
+            )
+            self.encode(ctx, [c for c in chunks if c.chunk_index in wanted], wanted)
+
+        for r, res in enumerate(resolutions):
+            if missing[r].any():
+                print(
+                    f"res {res} is missing candidates for {int(missing[r].sum())} chunks, skipping it"
+                )
+        best_resolutions = get_best_resolutions(table, solution)
+
         final_paths = []
-        for vmaf_target in vmafs_reverse:
+        for t, vmaf_target in reversed(list(enumerate(vmafs))):
             print("\n")
-            trys_in_vmaf_group = trellis_paths[f"{vmaf_target}"]
-            candidates = []
-            for res in resolutions:
-                paths_in_res = trys_in_vmaf_group[res]
-                vmaf_errors = []
-                bits = 0  # kb of all chunks together
-                lengths = 0  # seconds of all chunks together
-                for chunk in paths_in_res:
-                    vmaf_errors.append(abs(chunk["vmaf"] - vmaf_target))
-                    # get bits from bitrate and length filed
-                    bits += chunk["bitrate"] * chunk["length"]
-                    lengths += chunk["length"]
-
-                vmaf_error_avg = sum(vmaf_errors) / len(vmaf_errors)
-                bitrate = bits / lengths
+            for r, res in enumerate(resolutions):
                 print(
-                    f"vmaf target: {vmaf_target};   res: {res};   vmaf_error_avg: {vmaf_error_avg};  bitrate: {bitrate}"
+                    f"vmaf target: {vmaf_target};   res: {res};   pooled vmaf: {solution['vmaf'][t, r]:.2f};"
+                    f"  bitrate: {solution['bitrate'][t, r]:.1f}"
                 )
-                candidates.append(
+
+            best = best_resolutions[t]
+
+            paths = []
+            for c, chunk in enumerate(chunks):
+                data = table.entries[(best, c, solution["picks"][t, best, c])]
+                paths.append(
                     {
-                        "vmaf_error_avg": vmaf_error_avg,
-                        "bitrate": bitrate,
-                        "res": res,
-                        "paths": paths_in_res,
+                        "vmaf": data["vmaf"],
+                        "crf": data["crf"],
+                        "bitrate": data["bitrate"],
+                        "file": data["file"],
+                        "res": data["res"],
+                        "index": chunk.chunk_index,
+                        "length": chunk.get_lenght(),
                     }
                 )
 
-            if prev_bitrate == -1:
-                candidates.sort(key=lambda x: x["vmaf_error_avg"])
-            else:
-                candidates.sort(
-                    key=lambda x: x["vmaf_error_avg"]
-                    + min(abs(x["bitrate"] - prev_bitrate), 0)
-                )
-
-            best_candidate = candidates[0]
+            vmaf_error_avg = sum([abs(p["vmaf"] - vmaf_target) for p in paths]) / len(
+                paths
+            )
             print(
-                f"best candidate for vmaf target {vmaf_target} is res: {best_candidate['res']} "
-                f"with vmaf_error_avg: {best_candidate['vmaf_error_avg']}"
+                f"best candidate for vmaf target {vmaf_target} is res: {resolutions[best]} "
+                f"with pooled vmaf: {solution['vmaf'][t, best]:.2f}, bitrate: {solution['bitrate'][t, best]:.1f}"
+            )
+            final_paths.append(
+                {
+                    "vmaf_error_avg": vmaf_error_avg,
+                    "bitrate": float(solution["bitrate"][t, best]),
+                    "res": resolutions[best],
+                    "paths": paths,
+                    "vmaf_target": vmaf_target,
+                }
             )
-            prev_bitrate = best_candidate["bitrate"]
-            best_candidate = {
-                **best_candidate,
-                "vmaf_target": vmaf_target,
-            }
-            final_paths.append(best_candidate)
 
         # a = {
         #     "res": "720",
@@ -195,3 +184,27 @@ class MutliResTrellis(RefineStep):
             )
 
         ctx.get_kv().set("multires_final_paths", "final_paths", final_paths)
+
+    @staticmethod
+    def encode(ctx, chunks, wanted):
+        """
+        Run the refining encodes, chunks in parallel like the chunk pass
+        :param wanted: chunk index -> (res, crf) encodes, see AdaptiveRdSampler.get_refinement
+        """
+
+        def encode_chunk(chunk):
+            enc = ctx.get_encoder()
+            enc.chunk = chunk
+            try:
+                encode_candidates(ctx, chunk, enc, wanted[chunk.chunk_index])
+            except Exception as e:
+                # the candidates stay interpolated, the next round asks for them again
+                print(f"{chunk.log_prefix()}refining candidates failed: {e}")
+
+        workers = (
+            ctx.multiprocess_workers
+            if ctx.multiprocess_workers != -1
+            else os.cpu_count()
+        )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            executor.map(encode_chunk, chunks)
@@ -31,7 +31,7 @@ def calulcate_ssimdb(bitrate: int, chunk: ChunkObject, dbs: List[float], ctx):
         f"{enc.get_chunk_file_extension()}"
     )
     try:
-        stats: EncodeStats = enc.run(calcualte_ssim=True)
+        stats: EncodeStats = enc.run(calculate_ssim=True)
     except Exception as e:
         print(f"Failed to calculate ssim dB for {chunk.chunk_index}: {e}")
         return
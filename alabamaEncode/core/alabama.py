@@ -9,11 +9,17 @@ from alabamaEncode.conent_analysis.chunk.chunk_analyse_step import (
     ChunkAnalyzePipelineItem,
 )
 from alabamaEncode.core.ffmpeg import Ffmpeg
+from alabamaEncode.core.intermediate_cache import (
+    IntermediateCache,
+    configure_intermediate_cache,
+)
 from alabamaEncode.core.kv import AlabamaKv
 from alabamaEncode.core.path import PathAlabama
+from alabamaEncode.core.spool import SpoolBudget, configure_spool_budget
 from alabamaEncode.encoder.encoder import Encoder
 from alabamaEncode.encoder.impl.Svtenc import EncoderSvt
 from alabamaEncode.encoder.rate_dist import EncoderRateDistribution
+from alabamaEncode.metrics.cache import MetricCache, configure_metric_cache
 from alabamaEncode.metrics.comparison_display import ComparisonDisplayResolution
 from alabamaEncode.metrics.impl.vmaf import VmafOptions
 from alabamaEncode.metrics.metric import Metric
@@ -37,6 +43,15 @@ class AlabamaContext:
             "log_level": self.log_level,
             "print_analysis_logs": self.print_analysis_logs,
             "dry_run": self.dry_run,
+            "paranoid_integrity_check": self.paranoid_integrity_check,
+            "source_index": self.source_index,
+            "streaming_output": self.streaming_output,
+            "intermediate_cache_folder": self.intermediate_cache_folder,
+            "intermediate_cache_budget_mb": self.intermediate_cache_budget_mb,
+            "intermediate_cache_container": self.intermediate_cache_container,
+            "metric_cache_folder": self.metric_cache_folder,
+            "metric_cache_budget_mb": self.metric_cache_budget_mb,
+            "spool_budget_mb": self.spool_budget_mb,
             "temp_folder": self.temp_folder,
             "output_folder": self.output_folder,
             "output_file": self.output_file,
@@ -61,6 +76,9 @@ class AlabamaContext:
             "simple_denoise": self.simple_denoise,
             "vmaf": self.vmaf,
             "probe_count": self.probe_count,
+            "probe_batch_size": self.probe_batch_size,
+            "probe_subsample": self.probe_subsample,
+            "multires_adaptive_sampling": self.multires_adaptive_sampling,
             "vmaf_reference_display": self.vmaf_reference_display,
             "crf_based_vmaf_targeting": self.crf_based_vmaf_targeting,
             "vmaf_4k_model": self.vmaf_4k_model,
@@ -117,6 +135,15 @@ class AlabamaContext:
     log_level: int = 0
     print_analysis_logs = False
     dry_run: bool = False
+    paranoid_integrity_check: bool = False
+    source_index: bool = True
+    streaming_output: bool = False
+    intermediate_cache_folder: str = ""  # "" to decode every probe/reference live
+    intermediate_cache_budget_mb: int = 8192
+    intermediate_cache_container: str = "y4m"
+    metric_cache_folder: str = ""  # "" to score every encode again
+    metric_cache_budget_mb: int = 512
+    spool_budget_mb: int = 0  # 0 to decode the source again for every metric
     kv: [AlabamaKv | None] = None
     multi_res_pipeline = False
 
@@ -156,6 +183,9 @@ class AlabamaContext:
     vmaf: int = 96
     denoise_vmaf_ref = False
     probe_count = 3
+    probe_batch_size = 1  # >1 probes a chunk's crfs in parallel off one decode
+    probe_subsample = 1  # >1 scores only every Nth frame of a probe
+    multires_adaptive_sampling = True
     vmaf_reference_display = ""
     crf_based_vmaf_targeting = True
     vmaf_4k_model = False
@@ -219,8 +249,12 @@ class AlabamaContext:
                 "Prototype encoder is not set, this should be impossible"
             )
 
-    def get_vmaf_options(self) -> VmafOptions:
+    def get_vmaf_options(self, probe=False) -> VmafOptions:
+        """
+        :param probe: options for rate control probes, they get subsampled if `probe_subsample` is set
+        """
         return VmafOptions(
+            subsample=self.probe_subsample if probe else 1,
             uhd=self.vmaf_4k_model,
             phone=self.vmaf_phone_model,
             ref=(
@@ -278,6 +312,32 @@ class AlabamaContext:
             self.kv = AlabamaKv(self.temp_folder)
         return self.kv
 
+    def get_intermediate_cache(self) -> [IntermediateCache | None]:
+        """
+        Sets up the process-wide intermediate cache from this context, cheap to call again,
+        so every worker (celery included) calls it before encoding
+        """
+        return configure_intermediate_cache(
+            self.intermediate_cache_folder,
+            budget_bytes=self.intermediate_cache_budget_mb * 1024 * 1024,
+            container=self.intermediate_cache_container,
+        )
+
+    def get_metric_cache(self) -> [MetricCache | None]:
+        """
+        Sets up the process-wide metric result cache from this context, cheap to call again
+        """
+        return configure_metric_cache(
+            self.metric_cache_folder,
+            budget_bytes=self.metric_cache_budget_mb * 1024 * 1024,
+        )
+
+    def get_spool_budget(self) -> [SpoolBudget | None]:
+        """
+        Sets up the process-wide budget for probe/ladder spools from this context, cheap to call again
+        """
+        return configure_spool_budget(self.spool_budget_mb * 1024 * 1024)
+
     def get_probe_file_base(self, encoded_scene_path) -> str:
         """
         A helper function to get a probe file path derived from the encoded scene path
@@ -0,0 +1,34 @@
+"""
+Work that only depends on the source (audio, subs, the audio ladder) started once per job in the background,
+so it runs next to the chunk encodes and whatever needs it later picks up the same run
+"""
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from typing import Dict, Callable
+
+__all__ = ["KeyedBackgroundTasks"]
+
+
+class KeyedBackgroundTasks:
+    """
+    At most one run per key, starting a key again returns the running or finished run's future,
+    unless that run failed, then it starts over
+    """
+
+    def __init__(self, max_workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures: Dict[str, Future] = {}
+        self._lock = Lock()
+
+    def start(self, key: str, work: Callable) -> Future:
+        """
+        :param key: what identifies the job, e.g. its temp folder
+        :param work: runs in the background if there is no usable run for the key yet
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None or (future.done() and future.exception() is not None):
+                future = self._executor.submit(work)
+                self._futures[key] = future
+            return future
@@ -8,6 +8,8 @@ from alabamaEncode.conent_analysis.chunk.final_encode_steps.dynamic_target_vmaf
     DynamicTargetVmaf,
 )
 from alabamaEncode.core.alabama import AlabamaContext
+from alabamaEncode.core.integrity_manifest import get_integrity_manifest
+from alabamaEncode.core.resource_usage import resource_ledger, ResourceLedger
 from alabamaEncode.core.timer import Timer
 from alabamaEncode.encoder.impl.Svtenc import EncoderSvt
 from alabamaEncode.encoder.stats import EncodeStats
@@ -38,6 +40,18 @@ class ChunkEncoder(BaseCommandObject):
         )
 
     def run(self) -> [int, EncodeStats]:
+        intermediate_cache = self.ctx.get_intermediate_cache()
+        self.ctx.get_metric_cache()
+        self.ctx.get_spool_budget()
+        # sums what every encode/metric process of this chunk used, analysis probes included
+        with resource_ledger() as chunk_resources:
+            if intermediate_cache is None:
+                return self._run(chunk_resources)
+            # the chunk's probes & references read its cached frames until it's done
+            with intermediate_cache.pin(self.chunk):
+                return self._run(chunk_resources)
+
+    def _run(self, chunk_resources: ResourceLedger) -> [int, EncodeStats]:
         total_start = time.time()
 
         timeing = Timer()
@@ -77,7 +91,15 @@ class ChunkEncoder(BaseCommandObject):
 
         timeing.finish()
 
-        valid = self.chunk.verify_integrity(length_of_sequence=self.ctx.total_chunks, quiet=True)
+        # recorded in the manifest, the integrity check on resume then only has to stat the chunk
+        manifest = get_integrity_manifest(os.path.dirname(self.chunk.chunk_path))
+        valid = self.chunk.verify_integrity(
+            length_of_sequence=self.ctx.total_chunks,
+            quiet=True,
+            paranoid=self.ctx.paranoid_integrity_check,
+            manifest=manifest,
+        )
+        manifest.append()
         self.ctx.get_kv().set("chunk_integrity", self.chunk.chunk_index, not valid)
 
         if final_stats is not None:
@@ -88,6 +110,7 @@ class ChunkEncoder(BaseCommandObject):
             final_stats.total_fps = total_fps
             final_stats.chunk_index = self.chunk.chunk_index
             final_stats.rate_search_time = rate_search_time
+            final_stats.chunk_resources = chunk_resources.dict()
             self.ctx.log(
                 f"[{self.chunk.chunk_index}] final stats:"
                 f" vmaf={final_stats.vmaf} "
@@ -95,6 +118,7 @@ class ChunkEncoder(BaseCommandObject):
                 f" bitrate={final_stats.bitrate}k"
                 f" chunk_length={round(self.chunk.get_lenght(), 2)}s"
                 f" total_fps={total_fps}"
+                f" cpu_per_frame={final_stats.get_cpu_seconds_per_frame()}s"
             )
             # save the stats to [temp_folder]/chunks.log
             with open(f"{self.ctx.temp_folder}/chunks.log", "a") as f:
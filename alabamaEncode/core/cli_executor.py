@@ -1,19 +1,53 @@
+import asyncio
+import codecs
 import os
 import re
+import shlex
 import subprocess
 import time
+from collections import deque
 from queue import Queue
-from threading import Thread
-from typing import List, Callable, Optional
+from threading import Thread, Timer, Lock
+from typing import List, Callable, Optional, Coroutine, Any
 
-__all__ = ["run_cli", "run_cli_parallel", "CliResult"]
+import psutil
+
+from alabamaEncode.core.resource_usage import ResourceUsage, wait_with_rusage
+
+__all__ = [
+    "run_cli",
+    "run_cli_parallel",
+    "run_cli_async",
+    "run_cli_parallel_async",
+    "run_sync",
+    "get_cli_loop",
+    "CliResult",
+]
+
+# how much we read from a child's stdout per syscall
+READ_BLOCK_SIZE = 64 * 1024
+
+# "async" runs every child process on one shared event loop,
+# "thread" is the old blocking Popen + thread per process path, kept as a fallback
+CLI_BACKEND = os.environ.get("ALABAMA_CLI_BACKEND", "async")
+
+# encoders report progress with `\r` and log with `\n`, treat both (and runs of them) as a record break
+_RECORD_SEPARATOR = re.compile(r"[\r\n]+")
 
 
 class CliResult:
-    def __init__(self, return_code, output, time_taken=-1.0):
+    def __init__(
+        self,
+        return_code,
+        output,
+        time_taken=-1.0,
+        resources: Optional[ResourceUsage] = None,
+    ):
         self.return_code = return_code
         self.output = output
         self.time_taken = time_taken
+        # cpu time, peak rss etc. of the process and everything it waited for (e.g. a shell's pipe members)
+        self.resources = resources
 
     def __repr__(self):
         return f"ExecuteResult(return_code={self.return_code}, output={self.output})"
@@ -75,11 +109,91 @@ class CliResult:
         return float(self.output.strip())
 
 
+class _RecordSplitter:
+    """
+    Turns a stream of byte blocks into whole text records split on `\r` and `\n`,
+    so callbacks get e.g. a complete `Encoding frame ...` progress line instead of single characters
+    """
+
+    def __init__(self, on_record: Callable[[str], None]):
+        self.on_record = on_record
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._pending = ""
+
+    def feed(self, data: bytes):
+        records = _RECORD_SEPARATOR.split(self._pending + self._decoder.decode(data))
+        # the last element is an unterminated record, keep it until more data arrives
+        self._pending = records.pop()
+        for record in records:
+            if record != "":
+                self.on_record(record)
+
+    def flush(self):
+        record = self._pending + self._decoder.decode(b"", final=True)
+        self._pending = ""
+        if record != "":
+            self.on_record(record)
+
+
+class _OutputBuffer:
+    """
+    Collects raw output blocks, joined and decoded once at the end.
+    If `limit` is set only the last `limit` bytes are kept (ring buffer),
+    for long-running processes where we only care about the tail for error messages
+    """
+
+    def __init__(self, limit: int = -1):
+        self.limit = limit
+        self._blocks = deque()
+        self._size = 0
+
+    def append(self, data: bytes):
+        self._blocks.append(data)
+        self._size += len(data)
+        if self.limit > 0:
+            while self._size - len(self._blocks[0]) >= self.limit:
+                self._size -= len(self._blocks.popleft())
+
+    def get(self) -> str:
+        data = b"".join(self._blocks)
+        if self.limit > 0:
+            data = data[-self.limit :]
+        return data.decode(errors="ignore")
+
+
+def _kill_process_tree(p):
+    """
+    Kill the shell and everything it started, killing just the shell leaves
+    the pipe members running and holding our stdout open
+    """
+    try:
+        root = psutil.Process(p.pid)
+        processes = root.children(recursive=True) + [root]
+    except psutil.NoSuchProcess:
+        return
+    # signal through psutil rather than p.kill(), Popen.send_signal polls (and so reaps) the child
+    # first, which steals the exit status from asyncio's child watcher
+    for process in processes:
+        try:
+            process.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
 def run_cli(
     cmd,
     timeout_value=-1,
     on_output: Optional[Callable[[str], None]] = None,
+    output_limit: int = -1,
 ) -> CliResult:
+    """
+    Run a shell command and collect its (stdout + stderr) output
+    :param cmd: shell command
+    :param timeout_value: kill the process after this many seconds, -1 to wait forever
+    :param on_output: called with every output record (a line split on `\r` or `\n`, without the separator)
+    :param output_limit: keep only the last `output_limit` bytes of output, -1 to keep everything
+    :return: CliResult
+    """
     start = time.perf_counter()
     p = subprocess.Popen(
         cmd,
@@ -89,25 +203,258 @@ def run_cli(
         stderr=subprocess.STDOUT,
     )
 
-    output = ""
-    while p.poll() is None:  # While the process is still running...
-        chunk = p.stdout.read(1).decode(errors="ignore")  # Read output chunk by chunk
-        output += chunk  # Add chunk to total output
-        if on_output is not None:  # If on_output is provided...
-            on_output(chunk)  # ...apply it to each chunk
-
+    kill_timer = None
     if timeout_value > 0:
-        try:
-            p.wait(timeout=timeout_value)
-        except subprocess.TimeoutExpired:
-            p.kill()
-    else:
-        p.wait()
+        kill_timer = Timer(timeout_value, _kill_process_tree, args=(p,))
+        kill_timer.daemon = True
+        kill_timer.start()
+
+    output = _OutputBuffer(limit=output_limit)
+    splitter = _RecordSplitter(on_output) if on_output is not None else None
+
+    fd = p.stdout.fileno()
+    while True:
+        data = os.read(fd, READ_BLOCK_SIZE)
+        if not data:  # EOF, the process closed its output
+            break
+        output.append(data)
+        if splitter is not None:
+            splitter.feed(data)
+
+    if splitter is not None:
+        splitter.flush()
 
-    output += p.stdout.read().decode(errors="ignore")
+    p.returncode, resources = wait_with_rusage(p.pid)
+    if kill_timer is not None:
+        kill_timer.cancel()
+    p.stdout.close()
+    p.stdin.close()
 
     end = time.perf_counter()
-    return CliResult(p.returncode, output, end - start)
+    return CliResult(p.returncode, output.get(), end - start, resources=resources)
+
+
+_cli_loop: Optional[asyncio.AbstractEventLoop] = None
+_cli_loop_lock = Lock()
+
+
+def get_cli_loop() -> asyncio.AbstractEventLoop:
+    """
+    The event loop all async child processes live on, it runs in its own daemon thread
+    so sync code (the chunk analyze chain, celery workers) can hand it work with `run_sync`
+    """
+    global _cli_loop
+    with _cli_loop_lock:
+        if _cli_loop is None:
+            loop = asyncio.new_event_loop()
+            Thread(target=loop.run_forever, name="cli-event-loop", daemon=True).start()
+            _cli_loop = loop
+        return _cli_loop
+
+
+def run_sync(coro: Coroutine[Any, Any, Any]) -> Any:
+    """
+    Run a coroutine on the cli loop and block the calling thread until it's done.
+    If the caller gets interrupted the coroutine is cancelled, which kills its processes
+    """
+    loop = get_cli_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError(
+            "run_sync called from the cli loop, await the coroutine instead"
+        )
+
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+class _AsyncChild:
+    """
+    A child process driven by the running loop. We don't use asyncio's subprocess transports
+    because their child watchers reap with waitpid() and throw the rusage away,
+    instead the exit is noticed through a pidfd and the child is reaped with wait4
+    """
+
+    def __init__(self, popen: subprocess.Popen, loop: asyncio.AbstractEventLoop):
+        self.popen = popen
+        self.pid = popen.pid
+        self.returncode: Optional[int] = None
+        self.resources: Optional[ResourceUsage] = None
+        self.stdout: Optional[asyncio.StreamReader] = None
+        self._loop = loop
+        self._exited = loop.create_future()
+        self._stdout_transport = None
+
+        if hasattr(os, "pidfd_open"):
+            self._pidfd = os.pidfd_open(self.pid)
+            loop.add_reader(self._pidfd, self._on_pidfd_readable)
+        else:
+            # no pidfd (pre 5.3 kernel), park a blocking wait4 on the default executor instead
+            self._pidfd = None
+            loop.run_in_executor(None, wait_with_rusage, self.pid).add_done_callback(
+                lambda f: self._on_reaped(*f.result())
+            )
+
+    async def connect_stdout(self):
+        self.stdout = asyncio.StreamReader()
+        self._stdout_transport, _ = await self._loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self.stdout), self.popen.stdout
+        )
+
+    def _on_pidfd_readable(self):
+        reaped = wait_with_rusage(self.pid, os.WNOHANG)
+        if reaped is None:
+            return
+        self._loop.remove_reader(self._pidfd)
+        os.close(self._pidfd)
+        self._on_reaped(*reaped)
+
+    def _on_reaped(self, returncode: int, resources: ResourceUsage):
+        self.returncode = returncode
+        self.popen.returncode = returncode
+        self.resources = resources
+        self._exited.set_result(returncode)
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self._exited)
+
+    def close(self):
+        if self._stdout_transport is not None:
+            self._stdout_transport.close()
+        if self.popen.stdin is not None:
+            self.popen.stdin.close()
+
+
+async def _spawn(
+    cmd: [str | List[str]],
+    stdin=subprocess.PIPE,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.STDOUT,
+) -> _AsyncChild:
+    """
+    Start a process on the running loop, a string is run through the shell, a list is exec'd directly
+    """
+    p = subprocess.Popen(
+        cmd,
+        shell=isinstance(cmd, str),
+        stdin=stdin,
+        stdout=stdout,
+        stderr=stderr,
+    )
+    child = _AsyncChild(p, asyncio.get_running_loop())
+    if stdout == subprocess.PIPE:
+        await child.connect_stdout()
+    return child
+
+
+async def _run_cli_async(
+    cmd: [str | List[str]],
+    timeout_value=-1,
+    on_output: Optional[Callable[[str], None]] = None,
+    output_limit: int = -1,
+) -> CliResult:
+    start = time.perf_counter()
+    p = await _spawn(cmd)
+
+    output = _OutputBuffer(limit=output_limit)
+    splitter = _RecordSplitter(on_output) if on_output is not None else None
+
+    async def pump():
+        while True:
+            data = await p.stdout.read(READ_BLOCK_SIZE)
+            if not data:
+                break
+            output.append(data)
+            if splitter is not None:
+                splitter.feed(data)
+        await p.wait()
+
+    try:
+        await asyncio.wait_for(pump(), timeout_value if timeout_value > 0 else None)
+    except asyncio.TimeoutError:
+        _kill_process_tree(p)
+        await p.wait()
+    except BaseException:
+        # cancelled (a sibling failed, the caller gave up) or something broke, don't leave orphans behind
+        _kill_process_tree(p)
+        raise
+
+    finally:
+        p.close()
+
+    if splitter is not None:
+        splitter.flush()
+
+    end = time.perf_counter()
+    return CliResult(p.returncode, output.get(), end - start, resources=p.resources)
+
+
+async def run_cli_async(
+    cmd: [str | List[str]],
+    timeout_value=-1,
+    on_output: Optional[Callable[[str], None]] = None,
+    output_limit: int = -1,
+) -> CliResult:
+    """
+    Awaitable version of `run_cli`, the process is driven by the running event loop instead of a blocked thread.
+    Cancelling the awaiting task kills the process tree.
+    :param cmd: shell command, or an argv list to run without a shell
+    :param timeout_value: kill the process after this many seconds, -1 to wait forever
+    :param on_output: called with every output record (a line split on `\r` or `\n`, without the separator)
+    :param output_limit: keep only the last `output_limit` bytes of output, -1 to keep everything
+    :return: CliResult
+    """
+    if CLI_BACKEND == "thread":
+        if not isinstance(cmd, str):
+            cmd = shlex.join(cmd)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, run_cli, cmd, timeout_value, on_output, output_limit
+        )
+    return await _run_cli_async(
+        cmd, timeout_value=timeout_value, on_output=on_output, output_limit=output_limit
+    )
+
+
+async def run_cli_parallel_async(cmds: List[str], timeout_value=-1) -> List[CliResult]:
+    """
+    Run commands concurrently and return their results in the order of `cmds`.
+    As soon as one exits with a non-zero code the others are killed,
+    e.g. when vmaf dies the ffmpeg processes feeding its pipes would otherwise block forever
+    """
+    if CLI_BACKEND == "thread":
+        return await asyncio.get_running_loop().run_in_executor(
+            None, _run_cli_parallel_threaded, cmds, timeout_value
+        )
+
+    tasks = [
+        asyncio.create_task(_run_cli_async(cmd, timeout_value=timeout_value))
+        for cmd in cmds
+    ]
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            failed = [t.result() for t in done if not t.result().success()]
+            if len(failed) > 0:
+                raise RuntimeError(
+                    "One or more processes  finished with a non-zero exit code, "
+                    f"output: {[f.output for f in failed]}"
+                )
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return [t.result() for t in tasks]
 
 
 def _run_command(
@@ -129,8 +476,8 @@ def _run_command(
 
     output = process.stdout.read().decode(errors="ignore")
 
-    process.wait()
-    result_queue.put(CliResult(process.returncode, output))
+    process.returncode, resources = wait_with_rusage(process.pid)
+    result_queue.put(CliResult(process.returncode, output, resources=resources))
 
     if process.returncode != 0:
         error_flag[0] = True
@@ -138,6 +485,14 @@ def _run_command(
 
 def run_cli_parallel(
     cmds: List[str], timeout_value=-1, stream_to_stdout=False
+) -> List[CliResult]:
+    if CLI_BACKEND == "async":
+        return run_sync(run_cli_parallel_async(cmds, timeout_value=timeout_value))
+    return _run_cli_parallel_threaded(cmds, timeout_value, stream_to_stdout)
+
+
+def _run_cli_parallel_threaded(
+    cmds: List[str], timeout_value=-1, stream_to_stdout=False
 ) -> List[CliResult]:
     results = []
     result_queue = Queue()
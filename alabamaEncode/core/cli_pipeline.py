@@ -0,0 +1,316 @@
+"""
+Runs process graphs like `ffmpeg ... -f yuv4mpegpipe - | SvtAv1EncApp -i stdin ...` without a shell,
+wiring the stages together with `os.pipe` so we control the pipe sizes and see every stage's exit code
+"""
+
+import asyncio
+import fcntl
+import os
+import shlex
+import signal
+import subprocess
+import time
+from typing import List, Optional, Callable, Tuple, Dict
+
+from alabamaEncode.core import cli_executor
+from alabamaEncode.core.resource_usage import ResourceUsage
+from alabamaEncode.core.cli_executor import (
+    CliResult,
+    READ_BLOCK_SIZE,
+    _OutputBuffer,
+    _RecordSplitter,
+    _kill_process_tree,
+    _spawn,
+    _AsyncChild,
+    run_cli_async,
+    run_sync,
+)
+
+__all__ = [
+    "PipelineStage",
+    "Pipeline",
+    "PipelineResult",
+    "run_pipeline",
+    "run_pipeline_async",
+]
+
+
+def _get_pipe_max_size() -> int:
+    try:
+        with open("/proc/sys/fs/pipe-max-size") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return 1024 * 1024
+
+
+# the biggest pipe an unprivileged process may ask for, the kernel default is a measly 64KiB
+PIPE_MAX_SIZE = _get_pipe_max_size()
+
+
+def _grow_pipe(fd: int, size: int = -1) -> int:
+    """
+    Raise the capacity of a pipe, a single 4k 10bit y4m frame is ~24MB so with the default
+    64KiB the decoder and encoder constantly stall on each other
+    :param size: wanted capacity in bytes, -1 for the system maximum
+    :return: the capacity the pipe ended up with
+    """
+    if size <= 0:
+        size = PIPE_MAX_SIZE
+    for attempt in (size, PIPE_MAX_SIZE):
+        try:
+            return fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, attempt)
+        except OSError:
+            # EPERM above pipe-max-size without CAP_SYS_RESOURCE
+            continue
+    return fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ)
+
+
+class PipelineStage:
+    """
+    One process in a pipeline, its stdout feeds the next stage's stdin
+    """
+
+    def __init__(self, argv: List[str], name: str = ""):
+        self.argv = [str(a) for a in argv]
+        self.name = name if name != "" else os.path.basename(self.argv[0])
+
+    def __repr__(self):
+        return f"PipelineStage(name={self.name}, argv={self.argv})"
+
+
+class Pipeline:
+    """
+    A linear process graph: stage 0 stdout -> stage 1 stdin -> ... , every stage's stderr
+    and the last stage's stdout are collected as the pipeline output
+    """
+
+    def __init__(self, stages: List[PipelineStage], pipe_size: int = -1):
+        """
+        :param stages: processes in pipe order
+        :param pipe_size: capacity of the pipes between stages in bytes, -1 for the system maximum
+        """
+        if len(stages) == 0:
+            raise ValueError("A pipeline needs at least one stage")
+        self.stages = stages
+        self.pipe_size = pipe_size
+
+    def to_shell(self) -> str:
+        """
+        :return: the equivalent `a | b | c` shell command, used for logging and the thread backend
+        """
+        return " | ".join([shlex.join(stage.argv) for stage in self.stages])
+
+    def __str__(self):
+        return self.to_shell()
+
+    def __repr__(self):
+        return f"Pipeline({self.stages})"
+
+
+class PipelineResult(CliResult):
+    def __init__(
+        self,
+        return_code,
+        output,
+        time_taken=-1.0,
+        stage_return_codes: List[Tuple[str, int]] = None,
+        stage_resources: Dict[str, ResourceUsage] = None,
+    ):
+        """
+        :param return_code: exit code of the first stage that failed, 0 if all of them succeeded
+        :param stage_return_codes: (stage name, exit code) for every stage, in pipe order
+        :param stage_resources: usage per stage name, stages sharing a name are summed
+        """
+        self.stage_return_codes = (
+            stage_return_codes if stage_return_codes is not None else []
+        )
+        self.stage_resources = stage_resources if stage_resources is not None else {}
+        super().__init__(
+            return_code,
+            output,
+            time_taken,
+            resources=sum(self.stage_resources.values(), ResourceUsage()),
+        )
+
+    def __repr__(self):
+        return (
+            f"PipelineResult(return_code={self.return_code},"
+            f" stages={self.stage_return_codes}, output={self.output})"
+        )
+
+
+async def _spawn_stages(pipeline: Pipeline, output_fd: int) -> List[_AsyncChild]:
+    processes = []
+    stdin = subprocess.DEVNULL
+    try:
+        for i, stage in enumerate(pipeline.stages):
+            is_last = i == len(pipeline.stages) - 1
+            next_stdin = None
+            if is_last:
+                stdout = output_fd
+            else:
+                next_stdin, stdout = os.pipe()
+                _grow_pipe(stdout, pipeline.pipe_size)
+            try:
+                processes.append(
+                    await _spawn(
+                        stage.argv, stdin=stdin, stdout=stdout, stderr=output_fd
+                    )
+                )
+            finally:
+                # the children hold their own copies now
+                if stdin != subprocess.DEVNULL:
+                    os.close(stdin)
+                if not is_last:
+                    os.close(stdout)
+                stdin = next_stdin
+    except BaseException:
+        if stdin is not None and stdin != subprocess.DEVNULL:
+            os.close(stdin)
+        for p in processes:
+            _kill_process_tree(p)
+        for p in processes:
+            await p.wait()
+        raise
+    return processes
+
+
+async def _run_pipeline_async(
+    pipeline: Pipeline,
+    timeout_value=-1,
+    on_output: Optional[Callable[[str], None]] = None,
+    output_limit: int = -1,
+) -> PipelineResult:
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+
+    output_read, output_write = os.pipe()
+    try:
+        processes = await _spawn_stages(pipeline, output_write)
+    except BaseException:
+        os.close(output_read)
+        raise
+    finally:
+        os.close(output_write)
+
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader),
+        os.fdopen(output_read, "rb", buffering=0),
+    )
+
+    output = _OutputBuffer(limit=output_limit)
+    splitter = _RecordSplitter(on_output) if on_output is not None else None
+    failed_stage: Optional[int] = None
+
+    def kill_graph():
+        for p in processes:
+            _kill_process_tree(p)
+
+    async def watch(index: int, p: _AsyncChild):
+        nonlocal failed_stage
+        return_code = await p.wait()
+        if return_code == -signal.SIGPIPE and index < len(processes) - 1:
+            # the next stage stopped reading, like `yes | head -1`, not a failure by itself:
+            # if that stage (or one after it) didn't exit cleanly its own watcher fails the pipeline
+            return
+        if return_code != 0 and failed_stage is None:
+            # e.g. the encoder rejected a flag, don't let ffmpeg decode into a closed pipe
+            failed_stage = index
+            kill_graph()
+
+    watchers = [asyncio.create_task(watch(i, p)) for i, p in enumerate(processes)]
+
+    async def pump():
+        while True:
+            data = await reader.read(READ_BLOCK_SIZE)
+            if not data:
+                break
+            output.append(data)
+            if splitter is not None:
+                splitter.feed(data)
+        await asyncio.gather(*watchers)
+
+    try:
+        await asyncio.wait_for(pump(), timeout_value if timeout_value > 0 else None)
+    except asyncio.TimeoutError:
+        kill_graph()
+        await asyncio.gather(*watchers)
+    except BaseException:
+        kill_graph()
+        for w in watchers:
+            w.cancel()
+        raise
+    finally:
+        transport.close()
+
+    if splitter is not None:
+        splitter.flush()
+
+    stage_return_codes = []
+    stage_resources: Dict[str, ResourceUsage] = {}
+    for stage, p in zip(pipeline.stages, processes):
+        stage_return_codes.append((stage.name, p.returncode))
+        stage_resources[stage.name] = (
+            stage_resources.get(stage.name, ResourceUsage()) + p.resources
+        )
+    return_code = 0
+    if failed_stage is not None:
+        return_code = processes[failed_stage].returncode
+
+    end = time.perf_counter()
+    return PipelineResult(
+        return_code,
+        output.get(),
+        end - start,
+        stage_return_codes=stage_return_codes,
+        stage_resources=stage_resources,
+    )
+
+
+async def run_pipeline_async(
+    pipeline: Pipeline,
+    timeout_value=-1,
+    on_output: Optional[Callable[[str], None]] = None,
+    output_limit: int = -1,
+) -> CliResult:
+    """
+    Run a pipeline without a shell, if any stage fails the whole graph is killed
+    :param pipeline: the stages to wire together
+    :param timeout_value: kill the graph after this many seconds, -1 to wait forever
+    :param on_output: called with every output record (a line split on `\\r` or `\\n`, without the separator)
+    :param output_limit: keep only the last `output_limit` bytes of output, -1 to keep everything
+    :return: PipelineResult, or a plain CliResult of the shell form on the thread backend
+    """
+    if cli_executor.CLI_BACKEND == "thread":
+        return await run_cli_async(
+            pipeline.to_shell(),
+            timeout_value=timeout_value,
+            on_output=on_output,
+            output_limit=output_limit,
+        )
+    return await _run_pipeline_async(
+        pipeline,
+        timeout_value=timeout_value,
+        on_output=on_output,
+        output_limit=output_limit,
+    )
+
+
+def run_pipeline(
+    pipeline: Pipeline,
+    timeout_value=-1,
+    on_output: Optional[Callable[[str], None]] = None,
+    output_limit: int = -1,
+) -> CliResult:
+    """
+    Blocking version of `run_pipeline_async`
+    """
+    return run_sync(
+        run_pipeline_async(
+            pipeline,
+            timeout_value=timeout_value,
+            on_output=on_output,
+            output_limit=output_limit,
+        )
+    )
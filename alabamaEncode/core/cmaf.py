@@ -0,0 +1,667 @@
+"""
+Native CMAF (fragmented mp4) segmenting. AV1 chunks go straight from their IVFs into fragments, every chunk
+starts on a keyframe so a segment is just one or more whole chunks with a running decode timeline.
+Already fragmented mp4s (the audio ladder) get cut on their fragment boundaries.
+"""
+
+import os
+import struct
+from typing import List, Optional, Tuple
+
+from alabamaEncode.core.ivf import iter_ivf_frames, read_ivf_header
+
+__all__ = [
+    "CmafSegment",
+    "CmafTrack",
+    "Av1SequenceHeader",
+    "CmafVideoSegmenter",
+    "split_fragmented_mp4",
+    "group_chunks_into_segments",
+    "SEGMENT_DURATION",
+]
+
+# seconds, segments are whole chunks so they come out at least this long
+SEGMENT_DURATION = 3
+
+OBU_SEQUENCE_HEADER = 1
+OBU_TEMPORAL_DELIMITER = 2
+
+# sample_depends_on=2 / sample_depends_on=1 + sample_is_non_sync_sample
+SAMPLE_FLAGS_SYNC = 0x02000000
+SAMPLE_FLAGS_NON_SYNC = 0x01010000
+
+UNITY_MATRIX = struct.pack(">9I", 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, version: int, flags: int, payload: bytes) -> bytes:
+    return box(box_type, struct.pack(">I", (version << 24) | flags) + payload)
+
+
+def iter_boxes(data: bytes, offset: int = 0, end: int = -1):
+    """
+    :return: (type, payload start, box end) of every box between offset and end
+    """
+    end = len(data) if end == -1 else end
+    while offset + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[offset : offset + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8 : offset + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+class CmafSegment:
+    def __init__(self, path: str, start: int, duration: int, size: int):
+        """
+        :param start: decode time of the first sample, in the track's timescale
+        :param duration: in the track's timescale
+        :param size: bytes
+        """
+        self.path = path
+        self.start = start
+        self.duration = duration
+        self.size = size
+
+
+class CmafTrack:
+    """
+    An init segment plus media segments, what the manifests describe as one representation
+    """
+
+    def __init__(
+        self,
+        track_id: str,
+        content_type: str,
+        codecs: str,
+        timescale: int,
+        init_path: str,
+        width: int = 0,
+        height: int = 0,
+        frame_rate: str = "",
+        audio_sampling_rate: int = 0,
+    ):
+        self.track_id = track_id
+        self.content_type = content_type  # "video" or "audio"
+        self.codecs = codecs
+        self.timescale = timescale
+        self.init_path = init_path
+        self.width = width
+        self.height = height
+        self.frame_rate = frame_rate
+        self.audio_sampling_rate = audio_sampling_rate
+        self.segments: List[CmafSegment] = []
+
+    def get_duration(self) -> float:
+        return sum([s.duration for s in self.segments]) / self.timescale
+
+    def get_bandwidth(self) -> int:
+        """
+        :return: bits per second of the most demanding segment, what a player has to sustain
+        """
+        peaks = [
+            s.size * 8 * self.timescale / s.duration
+            for s in self.segments
+            if s.duration > 0
+        ]
+        return int(max(peaks)) if len(peaks) > 0 else 0
+
+    def get_average_bandwidth(self) -> int:
+        duration = self.get_duration()
+        if duration == 0:
+            return 0
+        return int(sum([s.size for s in self.segments]) * 8 / duration)
+
+
+def read_leb128(data: bytes, offset: int) -> Tuple[int, int]:
+    value = 0
+    for i in range(8):
+        byte = data[offset + i]
+        value |= (byte & 0x7F) << (i * 7)
+        if not byte & 0x80:
+            return value, offset + i + 1
+    raise ValueError("Invalid leb128")
+
+
+def iter_obus(temporal_unit: bytes):
+    """
+    :return: (obu type, whole obu bytes, payload bytes) of every OBU, they have to carry their size field
+    """
+    offset = 0
+    while offset < len(temporal_unit):
+        start = offset
+        header = temporal_unit[offset]
+        obu_type = (header >> 3) & 0xF
+        has_extension = (header >> 2) & 1
+        has_size = (header >> 1) & 1
+        offset += 1 + has_extension
+        if not has_size:
+            raise ValueError("AV1 OBUs without a size field can't be segmented")
+        size, offset = read_leb128(temporal_unit, offset)
+        yield obu_type, temporal_unit[start : offset + size], temporal_unit[
+            offset : offset + size
+        ]
+        offset += size
+
+
+class BitReader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 0
+
+    def f(self, bits: int) -> int:
+        value = 0
+        for _ in range(bits):
+            byte = self.data[self.position >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.position & 7))) & 1)
+            self.position += 1
+        return value
+
+    def uvlc(self) -> int:
+        leading_zeros = 0
+        while self.f(1) == 0:
+            leading_zeros += 1
+            if leading_zeros >= 32:
+                return (1 << 32) - 1
+        return self.f(leading_zeros) + (1 << leading_zeros) - 1
+
+
+class Av1SequenceHeader:
+    """
+    The parts of an AV1 sequence header the av1C box and the codecs string need
+    """
+
+    def __init__(self, obu: bytes, payload: bytes):
+        self.obu = obu
+        r = BitReader(payload)
+        self.profile = r.f(3)
+        r.f(1)  # still_picture
+        reduced_still_picture_header = r.f(1)
+        self.tier = 0
+        if reduced_still_picture_header:
+            self.level = r.f(5)
+        else:
+            decoder_model_info_present = 0
+            buffer_delay_length = 0
+            if r.f(1):  # timing_info_present_flag
+                r.f(32)
+                r.f(32)
+                if r.f(1):  # equal_picture_interval
+                    r.uvlc()
+                decoder_model_info_present = r.f(1)
+                if decoder_model_info_present:
+                    buffer_delay_length = r.f(5) + 1
+                    r.f(32)
+                    r.f(5)
+                    r.f(5)
+            initial_display_delay_present = r.f(1)
+            operating_points = r.f(5) + 1
+            for i in range(operating_points):
+                r.f(12)  # operating_point_idc
+                level = r.f(5)
+                tier = r.f(1) if level > 7 else 0
+                if i == 0:
+                    self.level, self.tier = level, tier
+                if decoder_model_info_present and r.f(1):
+                    r.f(buffer_delay_length)
+                    r.f(buffer_delay_length)
+                    r.f(1)
+                if initial_display_delay_present and r.f(1):
+                    r.f(4)
+
+        frame_width_bits = r.f(4) + 1
+        frame_height_bits = r.f(4) + 1
+        self.max_width = r.f(frame_width_bits) + 1
+        self.max_height = r.f(frame_height_bits) + 1
+        if not reduced_still_picture_header and r.f(1):  # frame_id_numbers_present
+            r.f(4)
+            r.f(3)
+        r.f(1)  # use_128x128_superblock
+        r.f(1)  # enable_filter_intra
+        r.f(1)  # enable_intra_edge_filter
+        if not reduced_still_picture_header:
+            r.f(4)  # interintra, masked compound, warped motion, dual filter
+            enable_order_hint = r.f(1)
+            if enable_order_hint:
+                r.f(2)  # jnt_comp, ref_frame_mvs
+            seq_force_screen_content_tools = 2 if r.f(1) else r.f(1)
+            if seq_force_screen_content_tools > 0 and not r.f(1):
+                r.f(1)  # seq_force_integer_mv
+            if enable_order_hint:
+                r.f(3)
+        r.f(3)  # superres, cdef, restoration
+
+        # color_config
+        high_bitdepth = r.f(1)
+        self.twelve_bit = 0
+        if self.profile == 2 and high_bitdepth:
+            self.twelve_bit = r.f(1)
+        self.high_bitdepth = high_bitdepth
+        self.bit_depth = 12 if self.twelve_bit else (10 if high_bitdepth else 8)
+        self.monochrome = 0 if self.profile == 1 else r.f(1)
+        color_primaries, transfer, matrix = 2, 2, 2
+        if r.f(1):  # color_description_present_flag
+            color_primaries, transfer, matrix = r.f(8), r.f(8), r.f(8)
+        self.chroma_sample_position = 0
+        if self.monochrome:
+            self.subsampling_x, self.subsampling_y = 1, 1
+        elif color_primaries == 1 and transfer == 13 and matrix == 0:
+            self.subsampling_x, self.subsampling_y = 0, 0
+        else:
+            r.f(1)  # color_range
+            if self.profile == 0:
+                self.subsampling_x, self.subsampling_y = 1, 1
+            elif self.profile == 1:
+                self.subsampling_x, self.subsampling_y = 0, 0
+            elif self.bit_depth == 12:
+                self.subsampling_x = r.f(1)
+                self.subsampling_y = r.f(1) if self.subsampling_x else 0
+            else:
+                self.subsampling_x, self.subsampling_y = 1, 0
+            if self.subsampling_x and self.subsampling_y:
+                self.chroma_sample_position = r.f(2)
+
+    def get_codecs_string(self) -> str:
+        return (
+            f"av01.{self.profile}.{self.level:02d}{'H' if self.tier else 'M'}"
+            f".{self.bit_depth:02d}"
+        )
+
+    def get_av1c(self) -> bytes:
+        return box(
+            b"av1C",
+            bytes(
+                [
+                    0x81,
+                    (self.profile << 5) | self.level,
+                    (self.tier << 7)
+                    | (self.high_bitdepth << 6)
+                    | (self.twelve_bit << 5)
+                    | (self.monochrome << 4)
+                    | (self.subsampling_x << 3)
+                    | (self.subsampling_y << 2)
+                    | self.chroma_sample_position,
+                    0,
+                ]
+            )
+            + self.obu,
+        )
+
+
+def get_av1_init_segment(
+    sequence_header: Av1SequenceHeader, width: int, height: int, timescale: int
+) -> bytes:
+    ftyp = box(b"ftyp", b"iso6" + struct.pack(">I", 0) + b"iso6cmfcav01dashmp41")
+    mvhd = full_box(
+        b"mvhd",
+        0,
+        0,
+        struct.pack(">IIII", 0, 0, timescale, 0)
+        + struct.pack(">IH", 0x00010000, 0x0100)
+        + bytes(10)
+        + UNITY_MATRIX
+        + bytes(24)
+        + struct.pack(">I", 2),
+    )
+    tkhd = full_box(
+        b"tkhd",
+        0,
+        3,
+        struct.pack(">IIIII", 0, 0, 1, 0, 0)
+        + bytes(8)
+        + struct.pack(">hhhH", 0, 0, 0, 0)
+        + UNITY_MATRIX
+        + struct.pack(">II", width << 16, height << 16),
+    )
+    mdhd = full_box(
+        b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, timescale, 0, 0x55C4, 0)
+    )
+    hdlr = full_box(
+        b"hdlr", 0, 0, struct.pack(">I4s", 0, b"vide") + bytes(12) + b"VideoHandler\0"
+    )
+    av01 = box(
+        b"av01",
+        bytes(6)
+        + struct.pack(">H", 1)
+        + bytes(16)
+        + struct.pack(">HHIIIH", width, height, 0x00480000, 0x00480000, 0, 1)
+        + bytes(32)
+        + struct.pack(">Hh", 0x0018, -1)
+        + sequence_header.get_av1c(),
+    )
+    stbl = box(
+        b"stbl",
+        full_box(b"stsd", 0, 0, struct.pack(">I", 1) + av01)
+        + full_box(b"stts", 0, 0, struct.pack(">I", 0))
+        + full_box(b"stsc", 0, 0, struct.pack(">I", 0))
+        + full_box(b"stsz", 0, 0, struct.pack(">II", 0, 0))
+        + full_box(b"stco", 0, 0, struct.pack(">I", 0)),
+    )
+    minf = box(
+        b"minf",
+        full_box(b"vmhd", 0, 1, bytes(8))
+        + box(
+            b"dinf",
+            full_box(
+                b"dref", 0, 0, struct.pack(">I", 1) + full_box(b"url ", 0, 1, b"")
+            ),
+        )
+        + stbl,
+    )
+    trak = box(b"trak", tkhd + box(b"mdia", mdhd + hdlr + minf))
+    mvex = box(b"mvex", full_box(b"trex", 0, 0, struct.pack(">IIIII", 1, 1, 0, 0, 0)))
+    return ftyp + box(b"moov", mvhd + trak + mvex)
+
+
+def get_fragment(
+    sequence_number: int,
+    decode_time: int,
+    samples: List[Tuple[bytes, int, bool]],
+) -> bytes:
+    """
+    :param samples: (data, duration, is sync sample)
+    :return: moof + mdat
+    """
+    trun_flags = 0x000001 | 0x000100 | 0x000200 | 0x000400
+    entries = b"".join(
+        [
+            struct.pack(
+                ">III",
+                duration,
+                len(data),
+                SAMPLE_FLAGS_SYNC if sync else SAMPLE_FLAGS_NON_SYNC,
+            )
+            for data, duration, sync in samples
+        ]
+    )
+
+    def moof(data_offset: int) -> bytes:
+        traf = box(
+            b"traf",
+            # default-base-is-moof
+            full_box(b"tfhd", 0, 0x020000, struct.pack(">I", 1))
+            + full_box(b"tfdt", 1, 0, struct.pack(">Q", decode_time))
+            + full_box(
+                b"trun",
+                0,
+                trun_flags,
+                struct.pack(">Ii", len(samples), data_offset) + entries,
+            ),
+        )
+        return box(
+            b"moof", full_box(b"mfhd", 0, 0, struct.pack(">I", sequence_number)) + traf
+        )
+
+    # the data offset doesn't change the size of the moof, so build it once to measure it
+    moof_size = len(moof(0))
+    payload = b"".join([data for data, _, _ in samples])
+    return moof(moof_size + 8) + box(b"mdat", payload)
+
+
+def group_chunks_into_segments(
+    durations: List[float], target_duration: float
+) -> List[List[int]]:
+    """
+    Chunks back to back until a segment is at least `target_duration` seconds long, chunks longer than that
+    make a segment on their own. Feed every rendition the same durations and their segments line up.
+    :return: chunk indexes (into `durations`) of every segment
+    """
+    groups, current, current_duration = [], [], 0
+    for i, duration in enumerate(durations):
+        current.append(i)
+        current_duration += duration
+        if current_duration >= target_duration:
+            groups.append(current)
+            current, current_duration = [], 0
+    if len(current) > 0:
+        if len(groups) > 0 and current_duration < target_duration / 2:
+            # don't leave a tiny segment at the end
+            groups[-1] += current
+        else:
+            groups.append(current)
+    return groups
+
+
+class CmafVideoSegmenter:
+    """
+    Turns AV1 IVF chunks into `init.mp4` + numbered `.m4s` CMAF segments in a folder
+    """
+
+    def __init__(self, folder: str, track_id: str):
+        self.folder = folder
+        self.track: Optional[CmafTrack] = None
+        self.track_id = track_id
+        self.sequence_number = 0
+        self.decode_time = 0
+        self.scale = 1
+        os.makedirs(folder, exist_ok=True)
+
+    def _init_track(self, first_chunk: str):
+        header = read_ivf_header(first_chunk)
+        if header.fourcc != b"AV01":
+            raise ValueError(
+                f"Only AV1 IVF chunks can be segmented natively, got {header.fourcc}"
+            )
+        sequence_header = None
+        for _, temporal_unit in iter_ivf_frames(first_chunk):
+            for obu_type, obu, payload in iter_obus(temporal_unit):
+                if obu_type == OBU_SEQUENCE_HEADER:
+                    sequence_header = Av1SequenceHeader(obu, payload)
+                    break
+            break
+        if sequence_header is None:
+            raise ValueError(f"No AV1 sequence header at the start of {first_chunk}")
+
+        init_path = os.path.join(self.folder, "init.mp4")
+        with open(init_path, "wb") as f:
+            f.write(
+                get_av1_init_segment(
+                    sequence_header, header.width, header.height, header.rate
+                )
+            )
+        self.scale = header.scale
+        self.track = CmafTrack(
+            track_id=self.track_id,
+            content_type="video",
+            codecs=sequence_header.get_codecs_string(),
+            timescale=header.rate,
+            init_path=init_path,
+            width=header.width,
+            height=header.height,
+            frame_rate=(
+                f"{header.rate}/{header.scale}"
+                if header.scale != 1
+                else str(header.rate)
+            ),
+        )
+
+    def _read_chunk(self, path: str) -> List[Tuple[bytes, int, bool]]:
+        header = read_ivf_header(path)
+        if header.rate != self.track.timescale or header.scale != self.scale:
+            raise ValueError(f"{path} has a different time base than the first chunk")
+        frames = []
+        for pts, temporal_unit in iter_ivf_frames(path):
+            data, sync = b"", False
+            for obu_type, obu, _ in iter_obus(temporal_unit):
+                # temporal delimiters are implied by the samples in mp4
+                if obu_type == OBU_TEMPORAL_DELIMITER:
+                    continue
+                if obu_type == OBU_SEQUENCE_HEADER:
+                    # encoders repeat the sequence header on keyframes
+                    sync = True
+                data += obu
+            frames.append((pts, data, sync))
+
+        samples = []
+        for i, (pts, data, sync) in enumerate(frames):
+            if i + 1 < len(frames):
+                ticks = frames[i + 1][0] - pts
+            else:
+                ticks = pts - frames[i - 1][0] if i > 0 else 1
+            # the first frame of a chunk is always a keyframe
+            samples.append((data, max(ticks, 1) * self.scale, sync or i == 0))
+        return samples
+
+    def add_segment(self, chunk_paths: List[str]) -> CmafSegment:
+        """
+        Write the next segment, one fragment per chunk
+        """
+        if self.track is None:
+            self._init_track(chunk_paths[0])
+
+        path = os.path.join(self.folder, f"{len(self.track.segments) + 1}.m4s")
+        start = self.decode_time
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(box(b"styp", b"cmfs" + struct.pack(">I", 0) + b"cmfsmsdhmsix"))
+            for chunk_path in chunk_paths:
+                samples = self._read_chunk(chunk_path)
+                self.sequence_number += 1
+                f.write(get_fragment(self.sequence_number, self.decode_time, samples))
+                self.decode_time += sum([duration for _, duration, _ in samples])
+        os.replace(temp_path, path)
+
+        segment = CmafSegment(
+            path, start, self.decode_time - start, os.path.getsize(path)
+        )
+        self.track.segments.append(segment)
+        return segment
+
+
+def _get_fragment_timing(
+    data: bytes, moof_start: int, moof_end: int, trex_duration: int
+) -> Tuple[Optional[int], int]:
+    """
+    :return: (tfdt decode time if there is one, sum of the sample durations) of a moof
+    """
+    decode_time, duration = None, 0
+    for box_type, start, end in iter_boxes(data, moof_start, moof_end):
+        if box_type != b"traf":
+            continue
+        default_duration = trex_duration
+        for child, c_start, c_end in iter_boxes(data, start, end):
+            flags = struct.unpack(">I", data[c_start : c_start + 4])[0] & 0xFFFFFF
+            if child == b"tfdt":
+                if data[c_start] == 1:
+                    decode_time = struct.unpack(">Q", data[c_start + 4 : c_start + 12])[
+                        0
+                    ]
+                else:
+                    decode_time = struct.unpack(">I", data[c_start + 4 : c_start + 8])[
+                        0
+                    ]
+            elif child == b"tfhd":
+                offset = c_start + 8  # version/flags + track_ID
+                if flags & 0x01:
+                    offset += 8  # base_data_offset
+                if flags & 0x02:
+                    offset += 4  # sample_description_index
+                if flags & 0x08:
+                    default_duration = struct.unpack(">I", data[offset : offset + 4])[0]
+            elif child == b"trun":
+                count = struct.unpack(">I", data[c_start + 4 : c_start + 8])[0]
+                offset = c_start + 8
+                if flags & 0x01:
+                    offset += 4
+                if flags & 0x04:
+                    offset += 4
+                if not flags & 0x100:
+                    duration += count * default_duration
+                    continue
+                entry_size = 4 * bin(flags & 0xF00).count("1")
+                for i in range(count):
+                    duration += struct.unpack(
+                        ">I",
+                        data[offset + i * entry_size : offset + i * entry_size + 4],
+                    )[0]
+    return decode_time, duration
+
+
+def split_fragmented_mp4(
+    path: str, folder: str, track_id: str, codecs: str
+) -> Optional[CmafTrack]:
+    """
+    Cut a fragmented mp4 (one track) into `init.mp4` + a `.m4s` per moof/mdat pair
+    :return: the track, None if the file isn't fragmented
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    boxes = list(iter_boxes(data))
+    init_end, timescale, trex_duration, sampling_rate = 0, 0, 0, 0
+    for box_type, start, end in boxes:
+        if box_type == b"moof":
+            break
+        if box_type == b"moov":
+            for child, c_start, c_end in iter_boxes(data, start, end):
+                if child == b"mvex":
+                    for trex, t_start, _ in iter_boxes(data, c_start, c_end):
+                        if trex == b"trex":
+                            trex_duration = struct.unpack(
+                                ">I", data[t_start + 12 : t_start + 16]
+                            )[0]
+                if child == b"trak":
+                    for mdia, m_start, m_end in iter_boxes(data, c_start, c_end):
+                        if mdia != b"mdia":
+                            continue
+                        for mdhd, h_start, _ in iter_boxes(data, m_start, m_end):
+                            if mdhd == b"mdhd":
+                                version = data[h_start]
+                                offset = h_start + (20 if version == 1 else 12)
+                                timescale = struct.unpack(
+                                    ">I", data[offset : offset + 4]
+                                )[0]
+        if box_type in (b"ftyp", b"moov"):
+            init_end = end
+
+    if not any([box_type == b"moof" for box_type, _, _ in boxes]) or timescale == 0:
+        return None
+
+    os.makedirs(folder, exist_ok=True)
+    init_path = os.path.join(folder, "init.mp4")
+    with open(init_path, "wb") as f:
+        f.write(data[:init_end])
+
+    track = CmafTrack(
+        track_id=track_id,
+        content_type="audio",
+        codecs=codecs,
+        timescale=timescale,
+        init_path=init_path,
+        audio_sampling_rate=timescale,
+    )
+    decode_time = 0
+    for i, (box_type, start, end) in enumerate(boxes):
+        if box_type != b"moof":
+            continue
+        # moofs never need a 64 bit size
+        moof_start = start - 8
+        fragment_end = end
+        # the mdat that belongs to it
+        if i + 1 < len(boxes) and boxes[i + 1][0] == b"mdat":
+            fragment_end = boxes[i + 1][2]
+        tfdt, duration = _get_fragment_timing(data, start, end, trex_duration)
+        if tfdt is not None:
+            decode_time = tfdt
+
+        segment_path = os.path.join(folder, f"{len(track.segments) + 1}.m4s")
+        with open(segment_path, "wb") as f:
+            f.write(box(b"styp", b"cmfs" + struct.pack(">I", 0) + b"cmfsmsdhmsix"))
+            f.write(data[moof_start:fragment_end])
+        track.segments.append(
+            CmafSegment(
+                segment_path,
+                decode_time,
+                duration,
+                os.path.getsize(segment_path),
+            )
+        )
+        decode_time += duration
+    return track
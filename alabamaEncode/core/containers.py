@@ -0,0 +1,313 @@
+"""
+Pure python walkers for the containers our chunks come in (IVF from aomenc/SvtAv1EncApp/vpxenc, Matroska/WebM from
+x264/x265/ffmpeg). They only read frame/block headers, so counting frames and spotting truncated files
+doesn't need a process.
+"""
+
+import io
+import os
+import struct
+from typing import Optional
+
+from alabamaEncode.core.ivf import IVF_SIGNATURE, READ_BUFFER_SIZE, IvfError, walk_ivf
+
+__all__ = ["ContainerSummary", "read_ivf", "read_matroska", "read_container"]
+
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+
+
+class ContainerSummary:
+    """
+    What a header walk found out about a file
+    """
+
+    def __init__(self, container: str):
+        self.container = container
+        self.frame_count = 0
+        self.frame_bytes = 0  # sum of the frame payload sizes
+        self.codec = ""  # ivf fourcc or matroska codec id
+        self.width = -1
+        self.height = -1
+        self.error = ""  # empty when the file is structurally sound
+
+    @property
+    def valid(self) -> bool:
+        return self.error == ""
+
+    def __repr__(self):
+        return (
+            f"ContainerSummary(container={self.container}, codec={self.codec},"
+            f" frames={self.frame_count}, frame_bytes={self.frame_bytes},"
+            f" {self.width}x{self.height}, error={self.error})"
+        )
+
+
+# AV1 OBU types that may start a temporal unit, see the AV1 spec 5.3.1
+_AV1_OBU_TYPES = {1, 2, 3, 4, 5, 6, 7, 8, 15}
+
+
+def read_ivf(path: str) -> ContainerSummary:
+    """
+    Walk the 12 byte frame headers of an IVF file
+    """
+    summary = ContainerSummary("ivf")
+    file_size = os.path.getsize(path)
+
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        try:
+            header, frames = walk_ivf(f, file_size)
+        except IvfError as e:
+            summary.error = str(e)
+            return summary
+
+        summary.codec = header.get_codec()
+        summary.width, summary.height = header.width, header.height
+        is_av1 = summary.codec == "AV01"
+
+        previous_pts = None
+        try:
+            for _, frame_size, pts in frames:
+                if frame_size == 0:
+                    summary.error = f"frame {summary.frame_count} is empty"
+                    return summary
+                if previous_pts is not None and pts < previous_pts:
+                    summary.error = f"frame {summary.frame_count} pts goes backwards"
+                    return summary
+                previous_pts = pts
+
+                if is_av1:
+                    # first OBU header: forbidden bit must be 0 and the type must exist
+                    obu_header = f.read(1)[0]
+                    obu_type = (obu_header >> 3) & 0xF
+                    if obu_header & 0x80 or obu_type not in _AV1_OBU_TYPES:
+                        summary.error = f"frame {summary.frame_count} starts with a broken obu header"
+                        return summary
+
+                summary.frame_count += 1
+                summary.frame_bytes += frame_size
+        except IvfError as e:
+            summary.error = f"frame {summary.frame_count}: {e}"
+
+    return summary
+
+
+# EBML element ids we care about
+_ID_SEGMENT = 0x18538067
+_ID_CLUSTER = 0x1F43B675
+_ID_TRACKS = 0x1654AE6B
+_ID_TRACK_ENTRY = 0xAE
+_ID_TRACK_NUMBER = 0xD7
+_ID_TRACK_TYPE = 0x83
+_ID_CODEC_ID = 0x86
+_ID_VIDEO = 0xE0
+_ID_PIXEL_WIDTH = 0xB0
+_ID_PIXEL_HEIGHT = 0xBA
+_ID_SIMPLE_BLOCK = 0xA3
+_ID_BLOCK_GROUP = 0xA0
+_ID_BLOCK = 0xA1
+
+# level 1 elements, seeing one of these inside an unknown-sized cluster means that cluster has ended
+_SEGMENT_LEVEL_IDS = {
+    _ID_CLUSTER,
+    _ID_TRACKS,
+    0x114D9B74,  # SeekHead
+    0x1549A966,  # Info
+    0x1C53BB6B,  # Cues
+    0x1941A469,  # Attachments
+    0x1043A770,  # Chapters
+    0x1254C367,  # Tags
+}
+
+_UNKNOWN_SIZE = -1
+
+
+class _EbmlError(Exception):
+    pass
+
+
+def _read_vint(f, keep_marker: bool) -> (int, int):
+    """
+    :return: (value, length in bytes), value is _UNKNOWN_SIZE for an all-ones size
+    """
+    first = f.read(1)
+    if len(first) == 0:
+        raise EOFError
+    first = first[0]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise _EbmlError("invalid vint")
+    rest = f.read(length - 1)
+    if len(rest) < length - 1:
+        raise EOFError
+    value = first if keep_marker else first & (mask - 1)
+    for b in rest:
+        value = (value << 8) | b
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return _UNKNOWN_SIZE, length
+    return value, length
+
+
+def _read_element_header(f) -> (int, int, int):
+    """
+    :return: (id, data size, header length)
+    """
+    element_id, id_length = _read_vint(f, keep_marker=True)
+    size, size_length = _read_vint(f, keep_marker=False)
+    return element_id, size, id_length + size_length
+
+
+def _read_uint(f, size: int) -> int:
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError
+    return int.from_bytes(data, "big")
+
+
+def _read_tracks(f, end: int, summary: ContainerSummary) -> Optional[int]:
+    """
+    :return: the track number of the first video track
+    """
+    video_track = None
+    while f.tell() < end:
+        element_id, size, _ = _read_element_header(f)
+        if element_id != _ID_TRACK_ENTRY:
+            f.seek(size, io.SEEK_CUR)
+            continue
+        entry_end = f.tell() + size
+        number, track_type, codec, width, height = None, None, "", -1, -1
+        while f.tell() < entry_end:
+            child_id, child_size, _ = _read_element_header(f)
+            if child_id == _ID_TRACK_NUMBER:
+                number = _read_uint(f, child_size)
+            elif child_id == _ID_TRACK_TYPE:
+                track_type = _read_uint(f, child_size)
+            elif child_id == _ID_CODEC_ID:
+                codec = f.read(child_size).decode(errors="ignore")
+            elif child_id == _ID_VIDEO:
+                video_end = f.tell() + child_size
+                while f.tell() < video_end:
+                    video_id, video_size, _ = _read_element_header(f)
+                    if video_id == _ID_PIXEL_WIDTH:
+                        width = _read_uint(f, video_size)
+                    elif video_id == _ID_PIXEL_HEIGHT:
+                        height = _read_uint(f, video_size)
+                    else:
+                        f.seek(video_size, io.SEEK_CUR)
+            else:
+                f.seek(child_size, io.SEEK_CUR)
+        if track_type == 1 and video_track is None:
+            video_track = number
+            summary.codec, summary.width, summary.height = codec, width, height
+    return video_track
+
+
+def _count_block(f, size: int, video_track: int, summary: ContainerSummary):
+    block_start = f.tell()
+    track, track_length = _read_vint(f, keep_marker=False)
+    header = f.read(3)  # int16 timecode + flags
+    if len(header) < 3:
+        raise EOFError
+    frames = 1
+    header_length = track_length + 3
+    lacing = (header[2] >> 1) & 0x3
+    if lacing != 0:
+        lace_count = f.read(1)
+        if len(lace_count) == 0:
+            raise EOFError
+        frames = lace_count[0] + 1
+        header_length += 1
+    if track == video_track:
+        summary.frame_count += frames
+        summary.frame_bytes += size - header_length
+    f.seek(block_start + size)
+
+
+def read_matroska(path: str) -> ContainerSummary:
+    """
+    Walk the EBML tree of a Matroska/WebM file down to the (Simple)Blocks of the first video track,
+    without reading the block payloads
+    """
+    summary = ContainerSummary("matroska")
+    file_size = os.path.getsize(path)
+
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        try:
+            element_id, size, _ = _read_element_header(f)
+            if element_id != int.from_bytes(EBML_MAGIC, "big"):
+                summary.error = "not an ebml file"
+                return summary
+            f.seek(size, io.SEEK_CUR)
+
+            element_id, size, _ = _read_element_header(f)
+            if element_id != _ID_SEGMENT:
+                summary.error = "no segment after the ebml header"
+                return summary
+            segment_end = file_size if size == _UNKNOWN_SIZE else f.tell() + size
+            if segment_end > file_size:
+                summary.error = (
+                    f"segment claims {segment_end} bytes but the file has {file_size}"
+                )
+                return summary
+
+            video_track = None
+            cluster_end = None  # set while we are inside a cluster
+            while f.tell() < segment_end:
+                if cluster_end is not None and f.tell() >= cluster_end:
+                    cluster_end = None
+                element_start = f.tell()
+                element_id, size, _ = _read_element_header(f)
+
+                if cluster_end is not None and element_id in _SEGMENT_LEVEL_IDS:
+                    # an unknown-sized cluster ended, handle this element at segment level
+                    cluster_end = None
+
+                if size != _UNKNOWN_SIZE and f.tell() + size > segment_end:
+                    summary.error = f"element at byte {element_start} is truncated"
+                    return summary
+
+                if element_id == _ID_TRACKS:
+                    video_track = _read_tracks(f, f.tell() + size, summary)
+                elif element_id == _ID_CLUSTER:
+                    cluster_end = (
+                        segment_end if size == _UNKNOWN_SIZE else f.tell() + size
+                    )
+                    # descend: the cluster's children are walked by this loop
+                elif element_id == _ID_BLOCK_GROUP:
+                    # descend, the Block is a child
+                    pass
+                elif element_id in (_ID_SIMPLE_BLOCK, _ID_BLOCK):
+                    if video_track is None:
+                        summary.error = "blocks before the track list"
+                        return summary
+                    _count_block(f, size, video_track, summary)
+                elif size == _UNKNOWN_SIZE:
+                    summary.error = f"unknown sized element {hex(element_id)}"
+                    return summary
+                else:
+                    f.seek(size, io.SEEK_CUR)
+        except EOFError:
+            summary.error = f"file ends in the middle of an element ({file_size} bytes)"
+        except _EbmlError as e:
+            summary.error = str(e)
+
+    if summary.error == "" and video_track is None:
+        summary.error = "no video track"
+    return summary
+
+
+def read_container(path: str) -> Optional[ContainerSummary]:
+    """
+    Pick a walker from the file's magic bytes
+    :return: the summary, None if we don't know the container and the caller has to ask ffmpeg
+    """
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == IVF_SIGNATURE:
+        return read_ivf(path)
+    if magic == EBML_MAGIC:
+        return read_matroska(path)
+    return None
@@ -202,7 +202,8 @@ class AutoThumbnailer:
         self.pool.apply_async(
             process_frame_worker,
             args=(
-                yuv_frame.buffer,
+                # the reader reuses its buffers, the pool pickles the args later on its own thread
+                bytes(yuv_frame.buffer),
                 yuv_frame.headers["H"],
                 yuv_frame.headers["W"],
                 yuv_frame.count,
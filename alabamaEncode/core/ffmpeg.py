@@ -5,6 +5,7 @@ from typing import Any
 
 from alabamaEncode.core.bin_utils import get_binary, verify_ffmpeg_library
 from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.core.media_info import probe_media
 from alabamaEncode.core.path import PathAlabama
 
 
@@ -48,16 +49,7 @@ class Ffmpeg:
 
     @staticmethod
     def get_tracks(path: PathAlabama):
-        path.check_video()
-        out = (
-            run_cli(
-                f'{get_binary("ffprobe")} -v error -show_entries stream -of json {path.get_safe()}'
-            )
-            .verify()
-            .strip_mp4_warning()
-            .get_output()
-        )
-        return json.loads(out)["streams"]
+        return probe_media(path).get_raw_streams()
 
     @staticmethod
     def get_video_length(path: PathAlabama, sexagesimal=False) -> float | str:
@@ -67,27 +59,18 @@ class Ffmpeg:
         :param path: Path to the video
         :return: float
         """
-        path.check_video()
-        cli_command = (
-            f"ffprobe -v error -show_entries format=duration {'-sexagesimal' if sexagesimal else ''}"
-            f" -of default=noprint_wrappers=1:nokey=1 {path.get_safe()}"
-        )
-        try:
-            out = (
-                run_cli(cli_command)
-                .verify(
-                    bad_output_hints=["N/A", "Invalid data found"],
-                    fail_message=f"ffprobe failed, {cli_command}",
-                )
-                .strip_mp4_warning()
-                .get_output()
-            )
-        except RuntimeError:
+        duration = probe_media(path).duration
+        if duration is None:
             frame_count = Ffmpeg.get_frame_count(path)
             fps = Ffmpeg.get_video_frame_rate(path)
             return frame_count / fps
 
-        return out if sexagesimal else float(out)
+        if sexagesimal:
+            # same as ffprobe's -sexagesimal, H:MM:SS.micro
+            hours, rest = divmod(duration, 3600)
+            minutes, seconds = divmod(rest, 60)
+            return f"{int(hours)}:{int(minutes):02d}:{seconds:09.6f}"
+        return duration
 
     @staticmethod
     def get_total_bitrate(path: PathAlabama) -> float:
@@ -96,44 +79,16 @@ class Ffmpeg:
 
     @staticmethod
     def get_height(path: PathAlabama) -> int:
-        path.check_video()
-        return (
-            run_cli(
-                f"ffprobe -v error -select_streams v:0 -show_entries stream=height "
-                f"-of default=noprint_wrappers=1:nokey=1 {path.get_safe()}"
-            )
-            .verify()
-            .strip_mp4_warning()
-            .get_as_int()
-        )
+        return probe_media(path).require_video().height
 
     @staticmethod
     def get_width(path: PathAlabama) -> int:
-        path.check_video()
-        return (
-            run_cli(
-                f"ffprobe -v error -select_streams v:0 -show_entries stream=width "
-                f"-of default=noprint_wrappers=1:nokey=1 {path.get_safe()}"
-            )
-            .verify()
-            .strip_mp4_warning()
-            .get_as_int()
-        )
+        return probe_media(path).require_video().width
 
     @staticmethod
     def is_hdr(path: PathAlabama) -> bool:
         """Check if a video is HDR"""
-        path.check_video()
-        out = (
-            run_cli(
-                (
-                    f"ffprobe -v quiet -show_entries stream=color_transfer "
-                    f"-of csv=p=0 -select_streams v:0 {path.get_safe()}"
-                )
-            )
-            .get_output()
-            .strip()
-        )
+        out = probe_media(path).require_video().color_transfer
 
         if "bt709" in out or "unknown" in out:
             return False
@@ -141,35 +96,16 @@ class Ffmpeg:
 
     @staticmethod
     def get_video_frame_rate(file: PathAlabama) -> float:
-        file.check_video()
-        result = (
-            run_cli(
-                (
-                    f"ffprobe -v error -select_streams v -of default=noprint_wrappers=1:nokey=1"
-                    f" -show_entries stream=r_frame_rate {file.get_safe()}"
-                )
-            )
-            .verify(bad_output_hints=[""])
-            .strip_mp4_warning()
-            .get_output()
-            .split("/")
-        )
+        fraction = Ffmpeg.get_fps_fraction(file)
+        result = fraction.split("/")
         return float(result[0]) / float(result[1])
 
     @staticmethod
     def get_fps_fraction(file: PathAlabama) -> str:
-        file.check_video()
-        return (
-            run_cli(
-                (
-                    f"ffprobe -v error -select_streams v -of default=noprint_wrappers=1:nokey=1"
-                    f" -show_entries stream=r_frame_rate {file.get_safe()}"
-                )
-            )
-            .verify(bad_output_hints=[""])
-            .strip_mp4_warning()
-            .get_output()
-        )
+        fraction = probe_media(file).require_video().r_frame_rate
+        if fraction == "":
+            raise RuntimeError(f"ffprobe found no frame rate in {file.get()}")
+        return fraction
 
     @staticmethod
     def get_source_bitrates(
@@ -224,16 +160,7 @@ class Ffmpeg:
 
     @staticmethod
     def get_codec(path: PathAlabama) -> str:
-        path.check_video()
-        return (
-            run_cli(
-                f"ffprobe -v error -select_streams v:0 -show_entries stream=codec_name "
-                f"-of default=noprint_wrappers=1:nokey=1 {path.get_safe()}"
-            )
-            .verify()
-            .strip_mp4_warning()
-            .get_output()
-        )
+        return probe_media(path).require_video().codec_name
 
     @staticmethod
     def get_vmaf_motion(chunk) -> float:
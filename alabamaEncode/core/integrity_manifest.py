@@ -0,0 +1,221 @@
+"""
+Remembers which chunk files already passed the integrity check, so resuming a job only has to stat them
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+from threading import Lock
+from typing import Optional, Dict
+
+__all__ = ["IntegrityManifest", "MANIFEST_FILE_NAME", "get_integrity_manifest"]
+
+MANIFEST_FILE_NAME = "integrity_manifest.json"
+
+# bytes hashed from each end of the file, see _sample_digest
+DIGEST_SAMPLE_SIZE = 1024 * 1024
+
+
+def _sample_digest(path: str, size: int) -> str:
+    """
+    blake2b of the first and last DIGEST_SAMPLE_SIZE bytes plus the size, hashing every chunk in full
+    would read the whole encode back on each resume, this is enough to tell a rewritten chunk
+    from a copied/touched one
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(DIGEST_SAMPLE_SIZE))
+        if size > DIGEST_SAMPLE_SIZE:
+            f.seek(max(DIGEST_SAMPLE_SIZE, size - DIGEST_SAMPLE_SIZE))
+            h.update(f.read(DIGEST_SAMPLE_SIZE))
+    return h.hexdigest()
+
+
+class IntegrityManifest:
+    """
+    {chunk file name: {size, mtime_ns, digest, frame_count, decoded}} for every verified chunk,
+    stored as json next to the chunks, plus a journal of the entries recorded since then, one json line each.
+    Safe to use from several threads and several processes: chunk workers `append` their own chunk to the
+    journal, O(1) per chunk, and the sequence check `save`s, folding the journal into the json. Both happen
+    under a file lock.
+    """
+
+    def __init__(self, folder: str):
+        self.path = os.path.join(folder, MANIFEST_FILE_NAME)
+        self.journal_path = f"{self.path}.journal"
+        self._lock = Lock()
+        # keys recorded/forgotten since the last save/append
+        self._changed = set()
+        self._forgotten = set()
+        self._entries = self._read()
+
+    def _read(self) -> dict:
+        entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    entries = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                # a broken manifest only costs us a re-check
+                entries = {}
+        if os.path.exists(self.journal_path):
+            try:
+                with open(self.journal_path) as f:
+                    for line in f:
+                        try:
+                            key, entry = json.loads(line)
+                        except (json.JSONDecodeError, ValueError):
+                            continue  # a torn line, its chunk just gets checked again
+                        if entry is None:
+                            entries.pop(key, None)
+                        else:
+                            entries[key] = entry
+            except OSError:
+                pass
+        return entries
+
+    def is_verified(
+        self,
+        chunk_path: str,
+        expected_frame_count: int,
+        allow_frame_mismatch=False,
+        paranoid=False,
+    ) -> bool:
+        """
+        :param allow_frame_mismatch: accept any frame count, the last chunk of a sequence may be short
+        :param paranoid: only accept entries that were verified with a full decode
+        :return: True if the file is unchanged since it passed the check
+        """
+        key = os.path.basename(chunk_path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return False
+        if paranoid and not entry["decoded"]:
+            return False
+        if not allow_frame_mismatch and entry["frame_count"] != expected_frame_count:
+            return False
+
+        try:
+            st = os.stat(chunk_path)
+        except OSError:
+            return False
+        if st.st_size != entry["size"]:
+            return False
+        if st.st_mtime_ns == entry["mtime_ns"]:
+            return True
+
+        # same size, different mtime: the temp folder was copied or touched, check the content
+        if _sample_digest(chunk_path, st.st_size) != entry["digest"]:
+            return False
+        with self._lock:
+            entry["mtime_ns"] = st.st_mtime_ns
+            self._changed.add(key)
+        return True
+
+    def record(self, chunk_path: str, frame_count: int, decoded=False):
+        """
+        Mark a chunk file as verified in its current state
+        :param frame_count: frames the check found in the file
+        :param decoded: the check decoded the whole file with ffmpeg
+        """
+        st = os.stat(chunk_path)
+        entry = {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "digest": _sample_digest(chunk_path, st.st_size),
+            "frame_count": frame_count,
+            "decoded": decoded,
+        }
+        key = os.path.basename(chunk_path)
+        with self._lock:
+            self._entries[key] = entry
+            self._changed.add(key)
+            self._forgotten.discard(key)
+
+    def forget(self, chunk_path: str):
+        key = os.path.basename(chunk_path)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._changed.discard(key)
+            self._forgotten.add(key)
+
+    def get_frame_count(self, chunk_path: str) -> Optional[int]:
+        with self._lock:
+            entry = self._entries.get(os.path.basename(chunk_path))
+        return entry["frame_count"] if entry is not None else None
+
+    def _take_changes(self):
+        with self._lock:
+            changed = {
+                k: dict(self._entries[k]) for k in self._changed if k in self._entries
+            }
+            forgotten = set(self._forgotten)
+            self._changed.clear()
+            self._forgotten.clear()
+        return changed, forgotten
+
+    def append(self):
+        """
+        Add what changed to the journal, without reading or rewriting the manifest
+        """
+        changed, forgotten = self._take_changes()
+        if len(changed) == 0 and len(forgotten) == 0:
+            return
+        lines = [json.dumps([key, None]) + "\n" for key in forgotten]
+        lines += [json.dumps([key, entry]) + "\n" for key, entry in changed.items()]
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with open(self.journal_path, "a") as f:
+                f.write("".join(lines))
+
+    def save(self):
+        """
+        Fold the journal and what changed into the manifest on disk, via a temp file + rename so a crash never
+        leaves half a file
+        """
+        changed, forgotten = self._take_changes()
+        if (
+            len(changed) == 0
+            and len(forgotten) == 0
+            and not os.path.exists(self.journal_path)
+        ):
+            return
+
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = self._read()
+            for key in forgotten:
+                entries.pop(key, None)
+            entries.update(changed)
+            temp_path = f"{self.path}.{os.urandom(4).hex()}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(temp_path, self.path)
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+        with self._lock:
+            # pick up what other processes recorded meanwhile
+            for key, entry in entries.items():
+                if key not in self._forgotten:
+                    self._entries.setdefault(key, entry)
+
+
+_manifests: Dict[str, IntegrityManifest] = {}
+_manifests_lock = Lock()
+
+
+def get_integrity_manifest(folder: str) -> IntegrityManifest:
+    """
+    The process-wide manifest of a chunk folder, read once, so recording a finished chunk doesn't
+    read the whole file again
+    """
+    with _manifests_lock:
+        manifest = _manifests.get(folder)
+        if manifest is None:
+            manifest = IntegrityManifest(folder)
+            _manifests[folder] = manifest
+        return manifest
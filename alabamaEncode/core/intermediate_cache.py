@@ -0,0 +1,382 @@
+"""
+Materializes a chunk's decoded + filtered frames once, so the probe encodes and the metric reference pipes of
+that chunk read them back instead of decoding/cropping/denoising/tonemapping the source again every time.
+Entries hold the frames before any scaling, the scale (and whatever follows it) runs on the way out,
+so the encoder's input and the metric reference, which is scaled to the comparison resolution, share one entry.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shlex
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, List, Tuple
+
+from alabamaEncode.core.bin_utils import get_binary
+from alabamaEncode.core.cli_executor import run_cli
+
+__all__ = [
+    "IntermediateCache",
+    "CachedIntermediate",
+    "configure_intermediate_cache",
+    "get_intermediate_cache",
+]
+
+
+def normalize_filters(video_filters: str) -> str:
+    # "-vf a,,b" and "a,b" filter the same, so they share an entry
+    video_filters = (video_filters or "").replace("-vf", "").strip()
+    return ",".join([f.strip() for f in video_filters.split(",") if f.strip() != ""])
+
+
+def split_filters(video_filters: str) -> Tuple[str, str]:
+    """
+    :return: (the filters before the first scale, that one and the rest), both normalized
+    """
+    filters = [f for f in normalize_filters(video_filters).split(",") if f != ""]
+    for i, _filter in enumerate(filters):
+        if re.match(r"^(scale|zscale|scale_\w+)(=|$)", _filter):
+            return ",".join(filters[:i]), ",".join(filters[i:])
+    return ",".join(filters), ""
+
+
+class CachedIntermediate:
+    """
+    One materialized chunk, `serve_command` writes the same y4m stream the live decode would
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        container: str,
+        chunk_id: str = "",
+        tail_filters: str = "",
+        bit_depth: int = 10,
+    ):
+        self.path = path
+        self.size = size
+        self.container = container  # "y4m" or "ffv1"
+        self.chunk_id = chunk_id  # see IntermediateCache.get_chunk_id
+        # filters applied while serving, e.g. the scale to a rung's or the metric's resolution
+        self.tail_filters = tail_filters
+        self.bit_depth = bit_depth
+
+    def with_tail(self, tail_filters: str, bit_depth: int) -> "CachedIntermediate":
+        return CachedIntermediate(
+            self.path,
+            self.size,
+            self.container,
+            chunk_id=self.chunk_id,
+            tail_filters=tail_filters,
+            bit_depth=bit_depth,
+        )
+
+    def _get_read_argv(self) -> List[str]:
+        if self.container == "y4m":
+            return ["cat", self.path]
+        return [
+            get_binary("ffmpeg"),
+            "-threads",
+            "1",
+            "-v",
+            "error",
+            "-nostdin",
+            "-i",
+            self.path,
+            "-strict",
+            "-1",
+            "-f",
+            "yuv4mpegpipe",
+            "-",
+        ]
+
+    def _get_tail_argv(self, input_path: str) -> List[str]:
+        return [
+            get_binary("ffmpeg"),
+            "-threads",
+            "1",
+            "-v",
+            "error",
+            "-nostdin",
+            "-i",
+            input_path,
+            "-vf",
+            self.tail_filters,
+            "-pix_fmt",
+            "yuv420p10le" if self.bit_depth == 10 else "yuv420p",
+            "-strict",
+            "-1",
+            "-f",
+            "yuv4mpegpipe",
+            "-",
+        ]
+
+    def get_serve_argv(self) -> List[str]:
+        if self.tail_filters == "":
+            return self._get_read_argv()
+        # ffmpeg reads the entry itself, no pipe needed
+        return self._get_tail_argv(self.path)
+
+    def get_serve_command(self) -> str:
+        return f" {shlex.join(self.get_serve_argv())} "
+
+
+class IntermediateCache:
+    """
+    A folder of materialized chunks with a byte budget and LRU eviction.
+    y4m is the fastest to serve and meant for tmpfs (/dev/shm), ffv1 is ~3x smaller and meant for a fast disk.
+    A serve command can run any time after `get` handed it out, e.g. pass 2 of a two pass encode,
+    so entries are only served to chunks that are `pin`ned and never evicted while their chunk is.
+    """
+
+    def __init__(self, folder: str, budget_bytes: int, container: str = "y4m"):
+        if container not in ("y4m", "ffv1"):
+            raise ValueError(f"Unknown intermediate container {container}")
+        self.folder = folder
+        self.budget_bytes = budget_bytes
+        self.container = container
+        self.extension = ".y4m" if container == "y4m" else ".mkv"
+
+        self._lock = Lock()
+        self._key_locks = {}
+        self._entries: "OrderedDict[str, CachedIntermediate]" = OrderedDict()
+        self._oversized = (
+            set()
+        )  # keys that didn't fit the budget alone, don't decode those twice
+        self._pins = {}  # chunk id -> pin count
+        self._no_room = (
+            set()
+        )  # keys that didn't fit beside the pinned entries, until a pin is released
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = (
+            0  # decoded bytes served from the cache instead of a live decode
+        )
+        self.bytes_written = 0
+
+        os.makedirs(self.folder, exist_ok=True)
+        # pick up what a previous run left behind, oldest first so they get evicted first
+        existing = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+            elif name.endswith(self.extension):
+                st = os.stat(path)
+                existing.append((st.st_mtime, name[: -len(self.extension)], path, st))
+        for _, key, path, st in sorted(existing):
+            self._entries[key] = CachedIntermediate(path, st.st_size, self.container)
+            self._size += st.st_size
+        self._evict()
+
+    @staticmethod
+    def get_chunk_id(chunk) -> str:
+        st = os.stat(chunk.path)
+        end = chunk.last_frame_index
+        if chunk.end_override != -1 and chunk.length > chunk.end_override:
+            end = chunk.first_frame_index + chunk.end_override
+        chunk_id = [
+            os.path.realpath(chunk.path),
+            st.st_size,
+            st.st_mtime_ns,
+            chunk.first_frame_index,
+            end,
+        ]
+        return hashlib.sha1(json.dumps(chunk_id).encode()).hexdigest()
+
+    @staticmethod
+    def get_key(chunk, video_filters: str, bit_depth: int) -> str:
+        """
+        :param video_filters: the filters the entry is materialized with, i.e. the ones before any scale
+        """
+        key = [
+            IntermediateCache.get_chunk_id(chunk),
+            normalize_filters(video_filters),
+            bit_depth,
+        ]
+        return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+    @contextlib.contextmanager
+    def pin(self, chunk):
+        """
+        Serve the chunk from the cache and keep its entries for the duration,
+        wrap everything that runs commands of the chunk in it
+        """
+        chunk_id = self.get_chunk_id(chunk)
+        with self._lock:
+            self._pins[chunk_id] = self._pins.get(chunk_id, 0) + 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._pins[chunk_id] -= 1
+                if self._pins[chunk_id] == 0:
+                    del self._pins[chunk_id]
+                    self._no_room.clear()
+                self._evict()
+
+    def is_pinned(self, chunk) -> bool:
+        chunk_id = self.get_chunk_id(chunk)
+        with self._lock:
+            return chunk_id in self._pins
+
+    def get(
+        self, chunk, video_filters: str, bit_depth: int
+    ) -> Optional[CachedIntermediate]:
+        """
+        Serve a chunk's filtered frames, decoding them into the cache on the first request
+        :return: the entry, None if the chunk isn't pinned, it doesn't fit the budget or the decode failed,
+        use a live decode then
+        """
+        base_filters, tail_filters = split_filters(video_filters)
+        chunk_id = self.get_chunk_id(chunk)
+        key = self.get_key(chunk, base_filters, bit_depth)
+
+        with self._lock:
+            if chunk_id not in self._pins:
+                # nothing would keep the entry around until the serve command runs
+                return None
+            if key in self._oversized or key in self._no_room:
+                return None
+            key_lock = self._key_locks.setdefault(key, Lock())
+
+        # only one thread decodes a given chunk, the rest wait and then hit
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and os.path.exists(entry.path):
+                    # entries left by a previous run don't know their chunk yet
+                    entry.chunk_id = chunk_id
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self.bytes_saved += entry.size
+                    return entry.with_tail(tail_filters, bit_depth)
+                if entry is not None:
+                    # someone cleaned the folder behind our back
+                    self._drop(key)
+                self.misses += 1
+
+            entry = self._materialize(key, chunk, base_filters, bit_depth)
+            if entry is None:
+                return None
+            entry.chunk_id = chunk_id
+
+            with self._lock:
+                self._entries[key] = entry
+                self._size += entry.size
+                self.bytes_written += entry.size
+                self._evict()
+                if self._size > self.budget_bytes:
+                    # the pinned entries leave no room, it wasn't handed out yet so it can go
+                    self._drop(key)
+                    if entry.size > self.budget_bytes:
+                        # bigger than the whole budget on its own
+                        self._oversized.add(key)
+                    else:
+                        self._no_room.add(key)
+                    return None
+                return entry.with_tail(tail_filters, bit_depth)
+
+    def _materialize(
+        self, key: str, chunk, video_filters: str, bit_depth: int
+    ) -> Optional[CachedIntermediate]:
+        path = os.path.join(self.folder, key + self.extension)
+        temp_path = f"{path}.{os.urandom(4).hex()}.tmp"
+
+        decode = chunk.create_chunk_ffmpeg_pipe_command(
+            video_filters=video_filters,
+            bit_depth=bit_depth,
+            use_intermediate_cache=False,
+        )
+        if self.container == "y4m":
+            command = f"{decode} > {shlex.quote(temp_path)}"
+        else:
+            command = (
+                f"{decode} | {get_binary('ffmpeg')} -v error -nostdin -f yuv4mpegpipe -i - "
+                f"-c:v ffv1 -level 3 -threads 1 -f matroska {shlex.quote(temp_path)}"
+            )
+
+        if not run_cli(command).success():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        os.replace(temp_path, path)
+        return CachedIntermediate(path, os.path.getsize(path), self.container)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+        if os.path.exists(entry.path):
+            os.remove(entry.path)
+
+    def _evict(self):
+        # least recently used first, entries of pinned chunks may still be read
+        for key in list(self._entries.keys()):
+            if self._size <= self.budget_bytes:
+                break
+            if self._entries[key].chunk_id in self._pins:
+                continue
+            self._drop(key)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Drop every entry that isn't pinned
+        """
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if self._entries[key].chunk_id not in self._pins:
+                    self._drop(key)
+
+    def get_hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+    def dict(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.get_hit_rate(), 3),
+            "evictions": self.evictions,
+            "bytes_saved": self.bytes_saved,
+            "bytes_written": self.bytes_written,
+            "size": self._size,
+            "budget": self.budget_bytes,
+        }
+
+
+_active_cache: Optional[IntermediateCache] = None
+_active_cache_lock = Lock()
+
+
+def configure_intermediate_cache(
+    folder: str, budget_bytes: int, container: str = "y4m"
+) -> Optional[IntermediateCache]:
+    """
+    Set the process-wide cache chunks decode into, calling it again with the same settings is a no-op,
+    so every worker can call it with its ctx
+    :param folder: where to keep the entries, "" to turn the cache off
+    """
+    global _active_cache
+    with _active_cache_lock:
+        if folder == "":
+            _active_cache = None
+        elif (
+            _active_cache is None
+            or _active_cache.folder != folder
+            or _active_cache.budget_bytes != budget_bytes
+            or _active_cache.container != container
+        ):
+            _active_cache = IntermediateCache(folder, budget_bytes, container)
+        return _active_cache
+
+
+def get_intermediate_cache() -> Optional[IntermediateCache]:
+    return _active_cache
@@ -0,0 +1,326 @@
+"""
+Reading and concatenating IVF files, the container SvtAv1EncApp, aomenc, rav1e and vpxenc write chunks in
+"""
+
+import json
+import os
+import struct
+from typing import Iterator, Tuple, List, Optional
+
+__all__ = [
+    "IVF_SIGNATURE",
+    "IVF_HEADER_SIZE",
+    "IVF_FRAME_HEADER_SIZE",
+    "IvfError",
+    "IvfHeader",
+    "read_ivf_header",
+    "walk_ivf",
+    "iter_ivf_frames",
+    "iter_ivf_frame_headers",
+    "IvfIndex",
+    "concat_ivf",
+]
+
+IVF_SIGNATURE = b"DKIF"
+IVF_HEADER_SIZE = 32
+IVF_FRAME_HEADER_SIZE = 12
+
+# big sequential reads, the seeks over frame payloads then mostly stay inside the buffer
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+class IvfError(ValueError):
+    """
+    The file isn't IVF or its frames don't add up
+    """
+
+
+class IvfHeader:
+    """
+    The 32 byte file header, frame timestamps are in units of `scale / rate` seconds
+    """
+
+    def __init__(
+        self,
+        fourcc: bytes,
+        width: int,
+        height: int,
+        rate: int,
+        scale: int,
+        frame_count: int,
+        header_size: int = IVF_HEADER_SIZE,
+    ):
+        self.fourcc = fourcc
+        self.width = width
+        self.height = height
+        self.rate = rate
+        self.scale = scale
+        self.frame_count = frame_count
+        self.header_size = header_size  # where the first frame starts
+
+    @staticmethod
+    def parse(data: bytes) -> "IvfHeader":
+        if len(data) < IVF_HEADER_SIZE or data[:4] != IVF_SIGNATURE:
+            raise IvfError("not an ivf file")
+        version, header_size, fourcc, width, height, rate, scale, frame_count = (
+            struct.unpack("<HH4sHHIII", data[4:28])
+        )
+        if header_size < IVF_HEADER_SIZE:
+            raise IvfError(f"unsupported ivf header size {header_size}")
+        return IvfHeader(fourcc, width, height, rate, scale, frame_count, header_size)
+
+    def get_codec(self) -> str:
+        return self.fourcc.decode(errors="ignore")
+
+    def pack(self) -> bytes:
+        return IVF_SIGNATURE + struct.pack(
+            "<HH4sHHIIII",
+            0,
+            IVF_HEADER_SIZE,
+            self.fourcc,
+            self.width,
+            self.height,
+            self.rate,
+            self.scale,
+            self.frame_count,
+            0,
+        )
+
+    def get_frame_rate(self) -> float:
+        return self.rate / self.scale
+
+
+def read_ivf_header(path: str) -> IvfHeader:
+    with open(path, "rb") as f:
+        return IvfHeader.parse(f.read(IVF_HEADER_SIZE))
+
+
+def walk_ivf(f, file_size: int) -> Tuple[IvfHeader, Iterator[Tuple[int, int, int]]]:
+    """
+    Parse the file header and walk the 12 byte frame headers, seeking over the payloads
+    :param f: the file opened in binary mode, at its start
+    :param file_size: bytes of the whole file
+    :return: the header and an iterator of (offset of the frame header, payload size, pts), the iterator raises
+    IvfError on a truncated frame. Between frames f sits at the start of the payload, reading from it is fine,
+    the walk seeks to the next frame on its own
+    """
+    header = IvfHeader.parse(f.read(IVF_HEADER_SIZE))
+
+    def frames():
+        position = header.header_size
+        while position < file_size:
+            f.seek(position)
+            frame_header = f.read(IVF_FRAME_HEADER_SIZE)
+            if len(frame_header) < IVF_FRAME_HEADER_SIZE:
+                raise IvfError(f"truncated frame header at byte {position}")
+            size, pts = struct.unpack("<IQ", frame_header)
+            end = position + IVF_FRAME_HEADER_SIZE + size
+            if end > file_size:
+                raise IvfError(
+                    f"frame of {size} bytes at byte {position + IVF_FRAME_HEADER_SIZE} "
+                    f"runs past the end of the file ({file_size} bytes)"
+                )
+            yield position, size, pts
+            position = end
+
+    return header, frames()
+
+
+def iter_ivf_frames(path: str) -> Iterator[Tuple[int, bytes]]:
+    """
+    :return: (pts, payload) of every frame, for AV1 a payload is one temporal unit
+    """
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        _, frames = walk_ivf(f, os.path.getsize(path))
+        for _, size, pts in frames:
+            yield pts, f.read(size)
+
+
+def iter_ivf_frame_headers(path: str) -> Iterator[Tuple[int, int, int]]:
+    """
+    Walk the frame headers only, seeking over the payloads
+    :return: (offset of the frame header, payload size, pts) of every frame
+    """
+    with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        _, frames = walk_ivf(f, os.path.getsize(path))
+        yield from frames
+
+
+class IvfIndex:
+    """
+    Where every packet of a concatenated IVF ended up, written next to it so the mux can trust the file
+    without walking or decoding it again
+    """
+
+    def __init__(
+        self, header: IvfHeader, packets: List[Tuple[int, int, int]], size: int
+    ):
+        """
+        :param packets: (offset of the frame header, payload size, pts)
+        :param size: bytes of the whole file
+        """
+        self.header = header
+        self.packets = packets
+        self.size = size
+
+    def get_duration(self) -> float:
+        if len(self.packets) == 0:
+            return 0
+        frame_ticks = 1
+        if len(self.packets) > 1:
+            frame_ticks = self.packets[-1][2] - self.packets[-2][2]
+        ticks = self.packets[-1][2] - self.packets[0][2] + frame_ticks
+        return ticks * self.header.scale / self.header.rate
+
+    @staticmethod
+    def get_path(ivf_path: str) -> str:
+        return f"{ivf_path}.index.json"
+
+    def save(self, ivf_path: str):
+        temp_path = f"{self.get_path(ivf_path)}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(
+                {
+                    "fourcc": self.header.fourcc.decode(),
+                    "width": self.header.width,
+                    "height": self.header.height,
+                    "rate": self.header.rate,
+                    "scale": self.header.scale,
+                    "size": self.size,
+                    "packets": self.packets,
+                },
+                f,
+            )
+        os.replace(temp_path, self.get_path(ivf_path))
+
+    @staticmethod
+    def load(ivf_path: str) -> Optional["IvfIndex"]:
+        """
+        :return: the index, None if there is none or the file changed since it was written
+        """
+        try:
+            with open(IvfIndex.get_path(ivf_path)) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if not os.path.exists(ivf_path) or os.path.getsize(ivf_path) != data["size"]:
+            return None
+        header = IvfHeader(
+            data["fourcc"].encode(),
+            data["width"],
+            data["height"],
+            data["rate"],
+            data["scale"],
+            len(data["packets"]),
+        )
+        return IvfIndex(header, [tuple(p) for p in data["packets"]], data["size"])
+
+
+def _copy_range(source_fd: int, destination_fd: int, offset: int, count: int):
+    """
+    Copy `count` bytes from `offset` of the source to the current position of the destination, in the kernel
+    when it can (copy_file_range can even reflink/server-side copy), with plain reads otherwise
+    """
+    copied = 0
+    try:
+        while copied < count:
+            n = os.copy_file_range(
+                source_fd, destination_fd, count - copied, offset + copied
+            )
+            if n == 0:
+                break
+            copied += n
+    except (OSError, AttributeError):
+        try:
+            while copied < count:
+                n = os.sendfile(
+                    destination_fd, source_fd, offset + copied, count - copied
+                )
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass
+    while copied < count:
+        data = os.pread(
+            source_fd, min(count - copied, 16 * 1024 * 1024), offset + copied
+        )
+        if len(data) == 0:
+            break
+        os.write(destination_fd, data)
+        copied += len(data)
+    if copied != count:
+        raise IOError(f"Short copy, {copied} of {count} bytes")
+
+
+def concat_ivf(files: List[str], output_path: str) -> IvfIndex:
+    """
+    Concatenate IVF files without demuxing them. Every file's frames are copied in one extent, then
+    their pts get renumbered in place so the timeline keeps going across files, and the file header gets
+    the total frame count. The files have to share codec, size and time base.
+    :return: the index of the output, also saved next to it
+    """
+    first = read_ivf_header(files[0])
+    packets = []
+    temp_path = f"{output_path}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, first.pack())
+        position = IVF_HEADER_SIZE
+        pts_offset = 0
+        for path in files:
+            header = read_ivf_header(path)
+            if header.header_size != IVF_HEADER_SIZE:
+                raise ValueError(f"{path} has a {header.header_size} byte header")
+            if (
+                header.fourcc,
+                header.width,
+                header.height,
+                header.rate,
+                header.scale,
+            ) != (
+                first.fourcc,
+                first.width,
+                first.height,
+                first.rate,
+                first.scale,
+            ):
+                raise ValueError(f"{path} doesn't match the stream of {files[0]}")
+            frames = list(iter_ivf_frame_headers(path))
+            if len(frames) == 0:
+                continue
+
+            body_size = os.path.getsize(path) - IVF_HEADER_SIZE
+            source_fd = os.open(path, os.O_RDONLY)
+            try:
+                _copy_range(source_fd, fd, IVF_HEADER_SIZE, body_size)
+            finally:
+                os.close(source_fd)
+
+            first_pts = frames[0][2]
+            for offset, size, pts in frames:
+                new_offset = position + offset - IVF_HEADER_SIZE
+                new_pts = pts - first_pts + pts_offset
+                os.pwrite(fd, struct.pack("<Q", new_pts), new_offset + 4)
+                packets.append((new_offset, size, new_pts))
+
+            frame_ticks = frames[-1][2] - frames[-2][2] if len(frames) > 1 else 1
+            pts_offset = packets[-1][2] + max(frame_ticks, 1)
+            position += body_size
+
+        first.frame_count = len(packets)
+        os.pwrite(fd, first.pack(), 0)
+    except BaseException:
+        os.close(fd)
+        os.remove(temp_path)
+        raise
+    os.close(fd)
+
+    # an index left from an earlier output must not outlive it
+    index_path = IvfIndex.get_path(output_path)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    os.replace(temp_path, output_path)
+    index = IvfIndex(first, packets, position)
+    index.save(output_path)
+    return index
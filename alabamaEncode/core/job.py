@@ -18,6 +18,9 @@ from alabamaEncode.conent_analysis.pipelines import (
     run_sequence_pipeline,
     get_refine_steps,
 )
+from alabamaEncode.conent_analysis.refine_steps.multires_package import (
+    start_audio_ladder,
+)
 from alabamaEncode.core.alabama import AlabamaContext
 from alabamaEncode.core.chunk_job import ChunkEncoder
 from alabamaEncode.core.ffmpeg import Ffmpeg
@@ -27,12 +30,15 @@ from alabamaEncode.core.final_touches import (
     create_torrent_file,
 )
 from alabamaEncode.core.path import PathAlabama
+from alabamaEncode.core.source_index import build_source_index
+from alabamaEncode.core.streaming_output import StreamingOutput
 from alabamaEncode.core.ws_update import WebsocketServer
 from alabamaEncode.parallelEncoding.CeleryApp import app
 from alabamaEncode.parallelEncoding.execute_commands import execute_commands
 from alabamaEncode.scene.annel import annealing
 from alabamaEncode.scene.concat import VideoConcatenator
 from alabamaEncode.scene.sequence import ChunkSequence
+from alabamaEncode.scene.source_tracks import start_source_tracks
 from alabamaEncode.scene.split import get_video_scene_list_skinny
 from alabamaEncode_frontends.cli.cli_setup.paths import parse_paths
 from alabamaEncode_frontends.cli.cli_setup.ratecontrol import parse_rd
@@ -271,6 +277,10 @@ class AlabamaEncodingJob:
                 static_length_size=self.ctx.max_scene_length,
                 scene_merge=self.ctx.scene_merge,
             )
+            if self.ctx.source_index:
+                self.update_current_step_name("Indexing source")
+                if build_source_index(PathAlabama(self.ctx.input_file)) is None:
+                    print("Source can't be indexed, chunks will seek by frame rate")
             sequence.setup_paths(
                 temp_folder=self.ctx.temp_folder,
                 extension=self.ctx.get_encoder().get_chunk_file_extension(),
@@ -278,6 +288,22 @@ class AlabamaEncodingJob:
 
             self.ctx.total_chunks = len(sequence.chunks)
 
+            if self.ctx.multi_res_pipeline:
+                # only needs the source, get it done while the chunks encode, packaging waits for it
+                start_audio_ladder(self.ctx, sequence)
+
+            source_tracks = None
+            if not self.ctx.multi_res_pipeline and self.ctx.encode_audio:
+                # audio & subs only need the source, get them done while the chunks encode, the mux waits for them
+                source_tracks = start_source_tracks(self.ctx, sequence)
+                source_tracks.add_done_callback(
+                    lambda f: tqdm.write(
+                        "Audio & subs failed to prepare, encoding them at the mux"
+                        if f.exception() is not None
+                        else f"Audio & subs prepared in {f.result().encode_time:.2f}s"
+                    )
+                )
+
             self.update_proc_done(10)
             self.update_current_step_name("Analyzing content")
             await run_sequence_pipeline(self.ctx, sequence)
@@ -290,7 +316,33 @@ class AlabamaEncodingJob:
             if self.ctx.dry_run:
                 iter_counter = 2
 
-            while sequence.sequence_integrity_check(kv=self.ctx.get_kv()):
+            intermediate_cache = self.ctx.get_intermediate_cache()
+            metric_cache = self.ctx.get_metric_cache()
+            if metric_cache is not None:
+                # the stats are per job
+                metric_cache.reset_stats()
+            spool_budget = self.ctx.get_spool_budget()
+            if spool_budget is not None:
+                spool_budget.reset_stats()
+
+            streaming_output = None
+            # segmenting reads and writes whole chunks, it runs in a thread, one update at a time
+            streaming_update = None
+            if self.ctx.streaming_output and not self.ctx.multi_res_pipeline:
+                if StreamingOutput.is_supported(self.ctx):
+                    streaming_output = StreamingOutput(self.ctx, sequence)
+                    print(
+                        f"Publishing finished chunks to {streaming_output.hls_path} and {streaming_output.mpd_path}"
+                    )
+                    streaming_update = asyncio.create_task(
+                        asyncio.to_thread(streaming_output.update)
+                    )
+                else:
+                    print("Streaming output needs AV1 ivf chunks, not streaming")
+
+            while sequence.sequence_integrity_check(
+                kv=self.ctx.get_kv(), paranoid=self.ctx.paranoid_integrity_check
+            ):
                 iter_counter += 1
                 if iter_counter > 3:
                     print("Integrity check failed 3 times, aborting")
@@ -317,7 +369,9 @@ class AlabamaEncodingJob:
 
                             return True
                         else:
-                            return _chunk.is_done(kv=ctx.get_kv())
+                            return _chunk.is_done(
+                                kv=ctx.get_kv(), paranoid=ctx.paranoid_integrity_check
+                            )
 
                     for chunk in sequence.chunks:
                         if not is_chunk_done(chunk):
@@ -357,8 +411,10 @@ class AlabamaEncodingJob:
                     )
 
                     already_done = len(sequence.chunks) - len(command_objects)
+                    streamed_scenes = 0
 
                     def update_proc_done(num_finished_scenes):
+                        nonlocal streaming_output, streaming_update, streamed_scenes
                         # map 20 to 95% as the space where the scenes are encoded
                         self.update_proc_done(
                             20
@@ -366,6 +422,27 @@ class AlabamaEncodingJob:
                             / len(sequence.chunks)
                             * 75
                         )
+                        # called every poll tick, only publish when a scene finished since the last update
+                        if (
+                            streaming_output is None
+                            or num_finished_scenes == streamed_scenes
+                        ):
+                            return
+                        if streaming_update is not None:
+                            if not streaming_update.done():
+                                return  # the next tick picks the new scenes up
+                            if streaming_update.exception() is not None:
+                                # only a preview, the encode goes on without it
+                                print(
+                                    f"Streaming output failed: {streaming_update.exception()},"
+                                    " not streaming the rest of this run"
+                                )
+                                streaming_output, streaming_update = None, None
+                                return
+                        streamed_scenes = num_finished_scenes
+                        streaming_update = asyncio.create_task(
+                            asyncio.to_thread(streaming_output.update)
+                        )
 
                     if len(command_objects) == 0:
                         print("Nothing to encode, skipping")
@@ -397,8 +474,41 @@ class AlabamaEncodingJob:
                         task.cancel()
                     quit()
 
+            if streaming_output is not None:
+                try:
+                    if streaming_update is not None:
+                        await streaming_update
+                    await asyncio.to_thread(streaming_output.finish)
+                except Exception as e:
+                    print(
+                        f"Streaming output failed: {e}, the final output isn't affected"
+                    )
+
+            if intermediate_cache is not None:
+                print(f"Intermediate cache stats: {intermediate_cache.dict()}")
+                intermediate_cache.clear()
+
+            if metric_cache is not None:
+                print(
+                    f"Metric cache stats: {metric_cache.dict()}, skipped"
+                    f" {metric_cache.seconds_saved:.0f}s of decoding & scoring"
+                )
+
+            if spool_budget is not None and spool_budget.fallbacks > 0:
+                print(f"Spool stats: {spool_budget.dict()}")
+
             if not self.ctx.multi_res_pipeline:
                 self.update_proc_done(95)
+                if source_tracks is not None:
+                    if not source_tracks.done():
+                        self.update_current_step_name("Waiting for audio & subs")
+                    try:
+                        await asyncio.wrap_future(source_tracks)
+                    except Exception as e:
+                        print(
+                            f"Preparing audio & subs in the background failed: {e}, encoding them at the mux"
+                        )
+                        source_tracks = None
                 self.update_current_step_name("Concatenating scenes")
 
                 try:
@@ -413,6 +523,7 @@ class AlabamaEncodingJob:
                         mux_audio=self.ctx.encode_audio,
                         subs_file=[self.ctx.sub_file],
                         temp_dir=self.ctx.temp_folder,
+                        source_tracks=source_tracks,
                     ).find_files_in_dir(
                         folder_path=self.ctx.temp_folder,
                         extension=self.ctx.get_encoder().get_chunk_file_extension(),
@@ -1,5 +1,7 @@
+import copy
 import json
 import os
+from threading import Lock
 
 
 class AlabamaKv(object):
@@ -15,12 +17,26 @@ class AlabamaKv(object):
     exists(bucket, key) -> bool
     get_global(key) -> str  # shortcut for get("kv", key)
     set_global(key, value)  # shortcut for set("kv", key, value)
+    Parsed buckets are kept in memory and only re-read when the file's mtime/size change,
+    so other processes writing to the same folder are still seen.
     """
 
     def __init__(self, folder):
         self.folder = folder
         if not os.path.exists(self.folder):
             os.makedirs(self.folder)
+        # bucket name -> ((mtime_ns, size), parsed content)
+        self._cache = {}
+        self._cache_lock = Lock()
+
+    def __getstate__(self):
+        # ctx (and with it the kv) gets pickled to celery workers, locks don't pickle
+        return {"folder": self.folder}
+
+    def __setstate__(self, state):
+        self.folder = state["folder"]
+        self._cache = {}
+        self._cache_lock = Lock()
 
     def get_global(self, key):
         return self.get("kv", key)
@@ -29,7 +45,7 @@ class AlabamaKv(object):
         return self.set("kv", key, value)
 
     def set(self, bucket, key, value):
-        b = self._load(bucket)
+        b = dict(self._load(bucket))
         b[key] = value
         self._save(bucket, b)
 
@@ -39,25 +55,45 @@ class AlabamaKv(object):
             key = str(key)
         if key not in b:
             return None
-        return b[key]
+        return copy.deepcopy(b[key])
 
     def get_all(self, bucket):
         b = self._load(bucket)
-        return b
+        return copy.deepcopy(b)
 
     def exists(self, bucket, key):
         b = self._load(bucket)
         return key in b
 
     def _load(self, bucket_name: str) -> dict:
+        """
+        :return: the cached bucket, callers that hand it out or modify it must copy it first
+        """
         bucket_path = os.path.join(self.folder, bucket_name + ".json")
-        if os.path.exists(bucket_path):
-            with open(bucket_path) as f:
-                return json.load(f)
-        else:
+        try:
+            st = os.stat(bucket_path)
+        except FileNotFoundError:
             return {}
+        version = (st.st_mtime_ns, st.st_size)
+
+        with self._cache_lock:
+            cached = self._cache.get(bucket_name)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        with open(bucket_path) as f:
+            content = json.load(f)
+        with self._cache_lock:
+            self._cache[bucket_name] = (version, content)
+        return content
 
     def _save(self, name: str, content):
         bucket_path = os.path.join(self.folder, name + ".json")
-        with open(bucket_path, "w") as f:
+        # readers in other threads/processes see the old or the new bucket, never half of one
+        temp_path = f"{bucket_path}.{os.urandom(4).hex()}.tmp"
+        with open(temp_path, "w") as f:
             json.dump(content, f)
+        os.replace(temp_path, bucket_path)
+        # the next read parses what we wrote, so keys come back as str like they always did
+        with self._cache_lock:
+            self._cache.pop(name, None)
@@ -0,0 +1,174 @@
+"""
+DASH (MPD) and HLS playlists for CMAF tracks, segment durations follow the scenes so both use explicit timelines
+"""
+
+import math
+import os
+from typing import List
+from xml.sax.saxutils import quoteattr
+
+from alabamaEncode.core.cmaf import CmafTrack
+
+__all__ = ["write_mpd", "write_hls"]
+
+
+def _get_iso_duration(seconds: float) -> str:
+    return f"PT{seconds:.3f}S"
+
+
+def _relative(path: str, manifest_path: str) -> str:
+    return os.path.relpath(path, os.path.dirname(os.path.abspath(manifest_path)))
+
+
+def _write_atomically(path: str, content: str):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+def _get_segment_timeline(track: CmafTrack) -> str:
+    """
+    <S> entries, runs of equal durations are folded into one with a repeat count
+    """
+    entries = []
+    for segment in track.segments:
+        if len(entries) > 0:
+            start, duration, repeat = entries[-1]
+            if (
+                duration == segment.duration
+                and start + duration * (repeat + 1) == segment.start
+            ):
+                entries[-1] = (start, duration, repeat + 1)
+                continue
+        entries.append((segment.start, segment.duration, 0))
+
+    lines = []
+    for start, duration, repeat in entries:
+        repeat_attribute = f' r="{repeat}"' if repeat > 0 else ""
+        lines.append(f'<S t="{start}" d="{duration}"{repeat_attribute}/>')
+    return "".join(lines)
+
+
+def _get_representation(track: CmafTrack, manifest_path: str) -> str:
+    folder = _relative(os.path.dirname(track.init_path), manifest_path)
+    attributes = (
+        f'id={quoteattr(track.track_id)} bandwidth="{track.get_bandwidth()}"'
+        f" codecs={quoteattr(track.codecs)}"
+    )
+    if track.content_type == "video":
+        attributes += (
+            f' width="{track.width}" height="{track.height}"'
+            f' frameRate="{track.frame_rate}"'
+        )
+    else:
+        attributes += f' audioSamplingRate="{track.audio_sampling_rate}"'
+    return (
+        f"      <Representation {attributes}>\n"
+        f'        <SegmentTemplate timescale="{track.timescale}"'
+        f" initialization={quoteattr(f'{folder}/init.mp4')}"
+        f" media={quoteattr(f'{folder}/$Number$.m4s')}"
+        f' startNumber="1">\n'
+        f"          <SegmentTimeline>{_get_segment_timeline(track)}</SegmentTimeline>\n"
+        f"        </SegmentTemplate>\n"
+        f"      </Representation>\n"
+    )
+
+
+def write_mpd(path: str, video_tracks: List[CmafTrack], audio_tracks: List[CmafTrack]):
+    """
+    Static (VOD) MPD, one adaptation set for the video renditions and one for the audio ones
+    """
+    all_tracks = video_tracks + audio_tracks
+    duration = max([track.get_duration() for track in all_tracks])
+    max_segment = max(
+        [s.duration / t.timescale for t in all_tracks for s in t.segments]
+    )
+
+    content = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011"'
+        ' profiles="urn:mpeg:dash:profile:isoff-live:2011,urn:mpeg:dash:profile:cmaf:2019"'
+        f' type="static" mediaPresentationDuration="{_get_iso_duration(duration)}"'
+        f' minBufferTime="{_get_iso_duration(max_segment)}">\n'
+        '  <Period id="0" start="PT0S">\n'
+    )
+    for set_id, (content_type, tracks) in enumerate(
+        [("video", video_tracks), ("audio", audio_tracks)]
+    ):
+        if len(tracks) == 0:
+            continue
+        content += (
+            f'    <AdaptationSet id="{set_id}" contentType="{content_type}"'
+            f' mimeType="{content_type}/mp4" segmentAlignment="true" startWithSAP="1">\n'
+        )
+        for track in tracks:
+            content += _get_representation(track, path)
+        content += "    </AdaptationSet>\n"
+    content += "  </Period>\n</MPD>\n"
+    _write_atomically(path, content)
+
+
+def _write_media_playlist(
+    track: CmafTrack, path: str, live: bool, target_duration: int
+):
+    target_duration = max(
+        target_duration,
+        math.ceil(max([s.duration / track.timescale for s in track.segments])),
+    )
+    content = (
+        "#EXTM3U\n"
+        "#EXT-X-VERSION:7\n"
+        f"#EXT-X-TARGETDURATION:{target_duration}\n"
+        "#EXT-X-MEDIA-SEQUENCE:1\n"
+        f"#EXT-X-PLAYLIST-TYPE:{'EVENT' if live else 'VOD'}\n"
+        "#EXT-X-INDEPENDENT-SEGMENTS\n"
+        f'#EXT-X-MAP:URI="{_relative(track.init_path, path)}"\n'
+    )
+    for segment in track.segments:
+        content += f"#EXTINF:{segment.duration / track.timescale:.5f},\n"
+        content += f"{_relative(segment.path, path)}\n"
+    if not live:
+        content += "#EXT-X-ENDLIST\n"
+    _write_atomically(path, content)
+
+
+def write_hls(
+    path: str,
+    video_tracks: List[CmafTrack],
+    audio_tracks: List[CmafTrack],
+    live: bool = False,
+    target_duration: int = 0,
+):
+    """
+    Master playlist at `path`, a media playlist next to every track's segments
+    :param live: EVENT playlists without an end, segments still get appended to them
+    :param target_duration: lower bound of EXT-X-TARGETDURATION, a live playlist must not change it
+    """
+    content = "#EXTM3U\n#EXT-X-VERSION:7\n#EXT-X-INDEPENDENT-SEGMENTS\n"
+
+    for i, track in enumerate(audio_tracks):
+        media_path = os.path.join(os.path.dirname(track.init_path), "playlist.m3u8")
+        _write_media_playlist(track, media_path, live, target_duration)
+        content += (
+            f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="{track.track_id}",'
+            f'DEFAULT={"YES" if i == 0 else "NO"},AUTOSELECT=YES,'
+            f'URI="{_relative(media_path, path)}"\n'
+        )
+
+    audio_bandwidth = max([t.get_bandwidth() for t in audio_tracks], default=0)
+    audio_average = max([t.get_average_bandwidth() for t in audio_tracks], default=0)
+    audio_codecs = ",".join(dict.fromkeys([t.codecs for t in audio_tracks]))
+    for track in video_tracks:
+        media_path = os.path.join(os.path.dirname(track.init_path), "playlist.m3u8")
+        _write_media_playlist(track, media_path, live, target_duration)
+        codecs = ",".join([c for c in [track.codecs, audio_codecs] if c != ""])
+        content += (
+            f"#EXT-X-STREAM-INF:BANDWIDTH={track.get_bandwidth() + audio_bandwidth},"
+            f"AVERAGE-BANDWIDTH={track.get_average_bandwidth() + audio_average},"
+            f'CODECS="{codecs}",RESOLUTION={track.width}x{track.height}'
+        )
+        if len(audio_tracks) > 0:
+            content += ',AUDIO="audio"'
+        content += f"\n{_relative(media_path, path)}\n"
+    _write_atomically(path, content)
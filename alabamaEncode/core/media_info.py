@@ -0,0 +1,201 @@
+"""
+One ffprobe per file instead of one per attribute, memoized in-process and on disk
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Tuple, List, Optional
+
+from alabamaEncode.core.bin_utils import get_binary
+from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.core.path import PathAlabama
+
+__all__ = ["MediaInfo", "StreamInfo", "probe_media"]
+
+PROBE_CACHE_DIR = os.path.expanduser("~/.alabamaEncoder/probe_cache")
+
+# only files this big get a disk entry, re-probing a small chunk is cheap and
+# caching every chunk/probe encode would grow the cache dir forever
+DISK_CACHE_MIN_SIZE = 64 * 1024 * 1024
+
+# in-process entries, each one is a few KB of parsed json
+MEMORY_CACHE_SIZE = 4096
+
+
+def _parse_fraction(fraction: Optional[str]) -> float:
+    if fraction is None or "/" not in fraction:
+        return -1
+    num, den = fraction.split("/")
+    if float(den) == 0:
+        return -1
+    return float(num) / float(den)
+
+
+def _parse_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class StreamInfo:
+    index: int
+    codec_type: str
+    codec_name: str
+    width: int = -1
+    height: int = -1
+    r_frame_rate: str = ""
+    color_transfer: str = ""
+    pix_fmt: str = ""
+
+    @property
+    def frame_rate(self) -> float:
+        return _parse_fraction(self.r_frame_rate)
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    """
+    Everything `ffprobe -show_streams -show_format` knows about a file, parsed once
+    """
+
+    path: str
+    size: int
+    duration: Optional[float]  # container duration in seconds, None if ffprobe said N/A
+    format_name: str
+    bit_rate: Optional[float]
+    streams: Tuple[StreamInfo, ...]
+    probe_json: (
+        str  # the raw ffprobe output, for callers that need fields we don't parse
+    )
+    start_time: Optional[float] = None  # container start, what ffmpeg's -ss counts from
+
+    @property
+    def video(self) -> Optional[StreamInfo]:
+        """
+        first video stream, same as ffprobe's `-select_streams v:0`
+        """
+        for stream in self.streams:
+            if stream.codec_type == "video":
+                return stream
+        return None
+
+    def require_video(self) -> StreamInfo:
+        video = self.video
+        if video is None:
+            raise RuntimeError(f"No video stream in {self.path}")
+        return video
+
+    def get_raw_streams(self) -> List[dict]:
+        """
+        :return: a fresh copy of ffprobe's stream dicts, safe to mutate
+        """
+        return json.loads(self.probe_json).get("streams", [])
+
+    @staticmethod
+    def from_probe_json(path: str, size: int, probe_json: str) -> "MediaInfo":
+        parsed = json.loads(probe_json)
+        fmt = parsed.get("format", {})
+        streams = tuple(
+            StreamInfo(
+                index=int(s.get("index", i)),
+                codec_type=s.get("codec_type", ""),
+                codec_name=s.get("codec_name", ""),
+                width=int(s.get("width", -1)),
+                height=int(s.get("height", -1)),
+                r_frame_rate=s.get("r_frame_rate", ""),
+                color_transfer=s.get("color_transfer", ""),
+                pix_fmt=s.get("pix_fmt", ""),
+            )
+            for i, s in enumerate(parsed.get("streams", []))
+        )
+        return MediaInfo(
+            path=path,
+            size=size,
+            duration=_parse_float(fmt.get("duration")),
+            format_name=fmt.get("format_name", ""),
+            bit_rate=_parse_float(fmt.get("bit_rate")),
+            streams=streams,
+            probe_json=probe_json,
+            start_time=_parse_float(fmt.get("start_time")),
+        )
+
+
+_memory_cache: "OrderedDict[tuple, MediaInfo]" = OrderedDict()
+_memory_cache_lock = Lock()
+
+
+def _cache_key(path: str) -> tuple:
+    st = os.stat(path)
+    return os.path.realpath(path), st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def _disk_cache_path(key: tuple) -> str:
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    return os.path.join(PROBE_CACHE_DIR, f"{digest}.json")
+
+
+def _run_ffprobe(path: PathAlabama) -> str:
+    cli_command = (
+        f"{get_binary('ffprobe')} -v error -show_streams -show_format -of json "
+        f"{path.get_safe()}"
+    )
+    out = (
+        run_cli(cli_command)
+        .verify(fail_message=f"ffprobe failed, {cli_command}")
+        .strip_mp4_warning()
+        .get_output()
+    )
+    # anything ffprobe logged before the json
+    if "{" not in out:
+        raise RuntimeError(f"ffprobe returned no json, {cli_command}")
+    return out[out.index("{") :]
+
+
+def probe_media(path: PathAlabama) -> MediaInfo:
+    """
+    Probe a file once, later calls for the same (path, size, mtime, inode) are served from memory,
+    or from ~/.alabamaEncoder/probe_cache for big files so resumed jobs don't re-probe the source
+    """
+    path.check_video()
+    key = _cache_key(path.get())
+
+    with _memory_cache_lock:
+        if key in _memory_cache:
+            _memory_cache.move_to_end(key)
+            return _memory_cache[key]
+
+    size = key[1]
+    disk_path = _disk_cache_path(key)
+    probe_json = None
+    if size >= DISK_CACHE_MIN_SIZE and os.path.exists(disk_path):
+        try:
+            with open(disk_path) as f:
+                probe_json = f.read()
+            json.loads(probe_json)
+        except (OSError, json.JSONDecodeError):
+            probe_json = None
+
+    if probe_json is None:
+        probe_json = _run_ffprobe(path)
+        if size >= DISK_CACHE_MIN_SIZE:
+            os.makedirs(PROBE_CACHE_DIR, exist_ok=True)
+            # write then rename so a parallel reader never sees half a file
+            temp_path = f"{disk_path}.{os.urandom(4).hex()}.tmp"
+            with open(temp_path, "w") as f:
+                f.write(probe_json)
+            os.replace(temp_path, disk_path)
+
+    info = MediaInfo.from_probe_json(path.get(), size, probe_json)
+
+    with _memory_cache_lock:
+        _memory_cache[key] = info
+        while len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+    return info
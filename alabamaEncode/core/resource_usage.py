@@ -0,0 +1,164 @@
+"""
+Resource accounting for child processes, filled from the rusage `wait4` hands back when we reap them
+"""
+
+import contextvars
+import os
+import resource
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, Optional
+
+__all__ = [
+    "ResourceUsage",
+    "ResourceLedger",
+    "resource_ledger",
+    "record_resources",
+    "wait_with_rusage",
+]
+
+
+class ResourceUsage:
+    """
+    CPU time, peak memory, block io and context switches of one or more processes (including what they waited for)
+    """
+
+    def __init__(
+        self,
+        user_cpu: float = 0.0,
+        system_cpu: float = 0.0,
+        max_rss_kb: int = 0,
+        block_input: int = 0,
+        block_output: int = 0,
+        voluntary_context_switches: int = 0,
+        involuntary_context_switches: int = 0,
+        processes: int = 0,
+    ):
+        self.user_cpu = user_cpu  # seconds
+        self.system_cpu = system_cpu  # seconds
+        self.max_rss_kb = max_rss_kb  # peak of the biggest single process, not a sum
+        self.block_input = block_input  # 512 byte blocks read from disk
+        self.block_output = block_output  # 512 byte blocks written to disk
+        self.voluntary_context_switches = voluntary_context_switches
+        self.involuntary_context_switches = involuntary_context_switches
+        self.processes = processes
+
+    @staticmethod
+    def from_rusage(usage: resource.struct_rusage) -> "ResourceUsage":
+        return ResourceUsage(
+            user_cpu=usage.ru_utime,
+            system_cpu=usage.ru_stime,
+            max_rss_kb=usage.ru_maxrss,
+            block_input=usage.ru_inblock,
+            block_output=usage.ru_oublock,
+            voluntary_context_switches=usage.ru_nvcsw,
+            involuntary_context_switches=usage.ru_nivcsw,
+            processes=1,
+        )
+
+    @property
+    def cpu_time(self) -> float:
+        return self.user_cpu + self.system_cpu
+
+    def __add__(self, other: "ResourceUsage") -> "ResourceUsage":
+        if other is None:
+            return self
+        return ResourceUsage(
+            user_cpu=self.user_cpu + other.user_cpu,
+            system_cpu=self.system_cpu + other.system_cpu,
+            max_rss_kb=max(self.max_rss_kb, other.max_rss_kb),
+            block_input=self.block_input + other.block_input,
+            block_output=self.block_output + other.block_output,
+            voluntary_context_switches=self.voluntary_context_switches
+            + other.voluntary_context_switches,
+            involuntary_context_switches=self.involuntary_context_switches
+            + other.involuntary_context_switches,
+            processes=self.processes + other.processes,
+        )
+
+    __radd__ = __add__
+
+    def dict(self) -> dict:
+        return {
+            "cpu_time": round(self.cpu_time, 3),
+            "user_cpu": round(self.user_cpu, 3),
+            "system_cpu": round(self.system_cpu, 3),
+            "max_rss_kb": self.max_rss_kb,
+            "block_input": self.block_input,
+            "block_output": self.block_output,
+            "voluntary_context_switches": self.voluntary_context_switches,
+            "involuntary_context_switches": self.involuntary_context_switches,
+            "processes": self.processes,
+        }
+
+    def __repr__(self):
+        return f"ResourceUsage({self.dict()})"
+
+
+def wait_with_rusage(pid: int, options: int = 0) -> [tuple[int, ResourceUsage] | None]:
+    """
+    Reap a child with wait4 so its rusage isn't thrown away like `Popen.wait()`/asyncio do
+    :return: (exit code, usage), None if called with WNOHANG and the child is still running
+    """
+    reaped_pid, status, usage = os.wait4(pid, options)
+    if reaped_pid == 0:
+        return None
+    return os.waitstatus_to_exitcode(status), ResourceUsage.from_rusage(usage)
+
+
+class ResourceLedger:
+    """
+    Sums usage per stage (e.g. decode, encode, metric) across everything run while it is active
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, ResourceUsage] = {}
+        self._lock = Lock()
+
+    def add(self, stage: str, usage: ResourceUsage):
+        if usage is None:
+            return
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, ResourceUsage()) + usage
+
+    def add_all(self, stages: Dict[str, ResourceUsage]):
+        for stage, usage in stages.items():
+            self.add(stage, usage)
+
+    def total(self) -> ResourceUsage:
+        with self._lock:
+            return sum(self.stages.values(), ResourceUsage())
+
+    def dict(self) -> dict:
+        with self._lock:
+            d = {stage: usage.dict() for stage, usage in self.stages.items()}
+        d["total"] = self.total().dict()
+        return d
+
+
+_current_ledger: contextvars.ContextVar[Optional[ResourceLedger]] = (
+    contextvars.ContextVar("resource_ledger", default=None)
+)
+
+
+@contextmanager
+def resource_ledger():
+    """
+    Collect the usage of every encode that runs inside the block (in this thread/task and what it awaits),
+    used to account a whole chunk including its analysis probes
+    """
+    ledger = ResourceLedger()
+    token = _current_ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _current_ledger.reset(token)
+
+
+def record_resources(stages: Dict[str, ResourceUsage]):
+    """
+    Add usage to the active ledger, if any
+    """
+    ledger = _current_ledger.get()
+    if ledger is not None:
+        ledger.add_all(stages)
@@ -0,0 +1,170 @@
+"""
+Per-input frame index (presentation timestamps + keyframes) so chunks can seek to an exact frame instead of
+`first_frame / fps` and hope the float lands on the right one
+"""
+
+import bisect
+import hashlib
+import json
+import os
+from threading import Lock
+from typing import List, Optional
+
+from alabamaEncode.core.bin_utils import get_binary
+from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.core.media_info import probe_media, _cache_key
+from alabamaEncode.core.path import PathAlabama
+
+__all__ = ["SourceIndex", "build_source_index", "load_source_index"]
+
+SOURCE_INDEX_DIR = os.path.expanduser("~/.alabamaEncoder/source_index")
+
+
+class SourceIndex:
+    """
+    frame_times[i] is when frame i (in presentation order) is shown, in seconds from the start of the file,
+    the same clock ffmpeg's input `-ss` uses. keyframes are the frame indexes ffmpeg can start decoding from.
+    """
+
+    def __init__(self, frame_times: List[float], keyframes: List[int]):
+        self.frame_times = frame_times
+        self.keyframes = keyframes
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.frame_times)
+
+    def seek_time(self, frame_index: int) -> float:
+        """
+        :return: an `-ss` value that starts decoding output exactly at `frame_index`, halfway between
+        it and the previous frame so float rounding can't pull in a neighbour
+        """
+        if frame_index <= 0:
+            return 0.0
+        return (self.frame_times[frame_index - 1] + self.frame_times[frame_index]) / 2
+
+    def keyframe_before(self, frame_index: int) -> int:
+        """
+        :return: the keyframe an input seek to `frame_index` starts decoding at
+        """
+        i = bisect.bisect_right(self.keyframes, frame_index) - 1
+        return self.keyframes[i] if i >= 0 else 0
+
+    def preroll_frames(self, frame_index: int) -> int:
+        """
+        :return: frames that get decoded and thrown away before `frame_index`
+        """
+        return frame_index - self.keyframe_before(frame_index)
+
+    def dict(self) -> dict:
+        return {"frame_times": self.frame_times, "keyframes": self.keyframes}
+
+    @staticmethod
+    def from_dict(d: dict) -> "SourceIndex":
+        return SourceIndex(frame_times=d["frame_times"], keyframes=d["keyframes"])
+
+
+# path -> (stat key, index), so every chunk of a sequence doesn't re-read the json
+_loaded: dict = {}
+_loaded_lock = Lock()
+
+
+def _index_path(key: tuple) -> str:
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    return os.path.join(SOURCE_INDEX_DIR, f"{digest}.json")
+
+
+def _scan_packets(path: PathAlabama) -> Optional[SourceIndex]:
+    """
+    Read every video packet's pts and flags, no decoding, so it's bound by disk speed
+    """
+    out = (
+        run_cli(
+            f"{get_binary('ffprobe')} -v error -select_streams v:0 "
+            f"-show_entries packet=pts_time,flags -of csv=p=0 {path.get_safe()}"
+        )
+        .verify(fail_message=f"Failed to index {path.get()}")
+        .strip_mp4_warning()
+        .get_output()
+    )
+
+    packets = []
+    for line in out.splitlines():
+        parts = line.strip().split(",")
+        if len(parts) < 2 or parts[0] == "":
+            continue
+        try:
+            pts = float(parts[0])
+        except ValueError:
+            # N/A pts (raw streams, some avi), can't index these
+            return None
+        packets.append((pts, "K" in parts[1]))
+
+    if len(packets) == 0:
+        return None
+
+    # packets come in decode order, b-frames make that differ from presentation order
+    packets.sort(key=lambda p: p[0])
+
+    start_time = probe_media(path).start_time
+    if start_time is None:
+        start_time = packets[0][0]
+
+    frame_times = [round(pts - start_time, 6) for pts, _ in packets]
+    keyframes = [i for i, (_, key) in enumerate(packets) if key]
+    return SourceIndex(frame_times=frame_times, keyframes=keyframes)
+
+
+def build_source_index(path: PathAlabama) -> Optional[SourceIndex]:
+    """
+    Index a file once, the result is kept in ~/.alabamaEncoder/source_index keyed by (path, size, mtime, inode)
+    :return: the index, None if the file's timestamps can't be indexed
+    """
+    existing = load_source_index(path.get())
+    if existing is not None:
+        return existing
+
+    path.check_video()
+    key = _cache_key(path.get())
+    index = _scan_packets(path)
+    if index is None:
+        return None
+
+    os.makedirs(SOURCE_INDEX_DIR, exist_ok=True)
+    disk_path = _index_path(key)
+    temp_path = f"{disk_path}.{os.urandom(4).hex()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(index.dict(), f)
+    os.replace(temp_path, disk_path)
+
+    with _loaded_lock:
+        _loaded[path.get()] = (key, index)
+    return index
+
+
+def load_source_index(path: str) -> Optional[SourceIndex]:
+    """
+    :return: the index if `build_source_index` already ran for this exact file, never builds one
+    """
+    try:
+        key = _cache_key(path)
+    except OSError:
+        return None
+
+    with _loaded_lock:
+        loaded = _loaded.get(path)
+    if loaded is not None and loaded[0] == key:
+        return loaded[1]
+
+    disk_path = _index_path(key)
+    if not os.path.exists(disk_path):
+        return None
+    try:
+        with open(disk_path) as f:
+            index = SourceIndex.from_dict(json.load(f))
+    except (OSError, json.JSONDecodeError, KeyError):
+        return None
+
+    with _loaded_lock:
+        _loaded[path] = (key, index)
+    return index
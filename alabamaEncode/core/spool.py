@@ -0,0 +1,152 @@
+"""
+Bookkeeping for the raw y4m spools probes and ladders decode a chunk into. Every chunk job of the process
+reserves its spool's size up front against one budget, so concurrent chunks can't fill tmpfs between each
+other's free-space checks. Spools only go to RAM backed folders, writing gigabytes of raw frames to disk and
+reading them back costs more than the second decode they save. A refused spool means decoding the source again
+for the metric, that gets logged and counted instead of happening silently.
+"""
+
+import os
+import shutil
+from threading import Lock
+from typing import Optional, List, Dict
+
+from tqdm import tqdm
+
+__all__ = [
+    "SpoolBudget",
+    "SpoolReservation",
+    "configure_spool_budget",
+    "get_spool_budget",
+]
+
+
+class SpoolReservation:
+    """
+    Room for one spool (or a ladder's set of them) in `folder`, `release` removes the files and frees the room
+    """
+
+    def __init__(self, budget: "SpoolBudget", folder: str, size: int):
+        self.budget = budget
+        self.folder = folder
+        self.size = size
+        self.paths: List[str] = []
+
+    def get_path(self, name: str) -> str:
+        path = os.path.join(self.folder, f"{name}.{os.urandom(4).hex()}.y4m")
+        self.paths.append(path)
+        return path
+
+    def release(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.paths = []
+        self.budget._release(self)
+
+
+class SpoolBudget:
+    def __init__(self, budget_bytes: int, folders: List[str] = None):
+        """
+        :param budget_bytes: max bytes of spools alive at once across the process
+        :param folders: tried in order, RAM backed ones
+        """
+        self.budget_bytes = budget_bytes
+        self.folders = ["/dev/shm"] if folders is None else folders
+        self._lock = Lock()
+        self._reserved: Dict[str, int] = {}  # folder -> bytes
+        self._logged = set()
+        self.reservations = 0
+        self.fallbacks = 0
+        self.peak_bytes = 0
+
+    def get_reserved(self) -> int:
+        return sum(self._reserved.values())
+
+    def reserve(
+        self, needed_bytes: float, log_prefix: str = ""
+    ) -> Optional[SpoolReservation]:
+        """
+        :param needed_bytes: the spool's size, the caller estimates it from the frame size, bit depth and count
+        :return: None if the spool doesn't fit the budget or any folder's free space
+        """
+        needed_bytes = int(needed_bytes)
+        with self._lock:
+            if self.get_reserved() + needed_bytes > self.budget_bytes:
+                self._fallback(
+                    "budget",
+                    f"{log_prefix}spool of {needed_bytes // 2 ** 20}MB doesn't fit the"
+                    f" {self.budget_bytes // 2 ** 20}MB spool budget"
+                    f" ({self.get_reserved() // 2 ** 20}MB in use), decoding the source again for the metric",
+                )
+                return None
+
+            for folder in self.folders:
+                if not os.path.isdir(folder):
+                    continue
+                free = shutil.disk_usage(folder).free - self._reserved.get(folder, 0)
+                if free > needed_bytes:
+                    self._reserved[folder] = (
+                        self._reserved.get(folder, 0) + needed_bytes
+                    )
+                    self.reservations += 1
+                    self.peak_bytes = max(self.peak_bytes, self.get_reserved())
+                    return SpoolReservation(self, folder, needed_bytes)
+
+            self._fallback(
+                "space",
+                f"{log_prefix}no free space for a {needed_bytes // 2 ** 20}MB spool in"
+                f" {', '.join(self.folders)}, decoding the source again for the metric",
+            )
+            return None
+
+    def _fallback(self, reason: str, msg: str):
+        self.fallbacks += 1
+        # the first of each kind, the rest end up in the stats
+        if reason not in self._logged:
+            self._logged.add(reason)
+            tqdm.write(msg)
+
+    def _release(self, reservation: SpoolReservation):
+        with self._lock:
+            self._reserved[reservation.folder] -= reservation.size
+            if self._reserved[reservation.folder] <= 0:
+                del self._reserved[reservation.folder]
+
+    def reset_stats(self):
+        with self._lock:
+            self._logged.clear()
+            self.reservations = 0
+            self.fallbacks = 0
+            self.peak_bytes = self.get_reserved()
+
+    def dict(self) -> dict:
+        return {
+            "spools": self.reservations,
+            "fallbacks": self.fallbacks,
+            "peak": self.peak_bytes,
+            "budget": self.budget_bytes,
+        }
+
+
+_active_budget: Optional[SpoolBudget] = None
+_active_budget_lock = Lock()
+
+
+def configure_spool_budget(budget_bytes: int) -> Optional[SpoolBudget]:
+    """
+    Set the process-wide spool budget, calling it again with the same budget is a no-op,
+    so every worker can call it with its ctx
+    :param budget_bytes: 0 (the default) to never spool and always decode the source again for the metric
+    """
+    global _active_budget
+    with _active_budget_lock:
+        if budget_bytes <= 0:
+            _active_budget = None
+        elif _active_budget is None or _active_budget.budget_bytes != budget_bytes:
+            _active_budget = SpoolBudget(budget_bytes)
+        return _active_budget
+
+
+def get_spool_budget() -> Optional[SpoolBudget]:
+    return _active_budget
@@ -0,0 +1,118 @@
+"""
+Progressive output, the finished prefix of a job's chunks gets published as CMAF segments while the rest is still
+encoding, so it can be watched long before the final concat. The HLS playlist is a live EVENT one. The MPD is a
+static one rewritten as segments land: encoding doesn't keep pace with the wall clock that a dynamic MPD's
+availabilityStartTime ties the segments to, so players would ask for segments that don't exist yet.
+"""
+
+import math
+import os
+import shutil
+from typing import List
+
+from alabamaEncode.core.cmaf import CmafVideoSegmenter, SEGMENT_DURATION
+from alabamaEncode.core.manifest import write_mpd, write_hls
+from alabamaEncode.encoder.codec import Codec
+
+__all__ = ["StreamingOutput"]
+
+
+class StreamingOutput:
+    """
+    Call `update` whenever chunks finish, it appends the longest contiguous run of finished chunks
+    after what's already published. `finish` publishes the rest and turns the playlists into VOD ones.
+    """
+
+    def __init__(self, ctx, sequence, folder: str = ""):
+        """
+        :param folder: where the segments and playlists go, <output folder>/stream by default
+        """
+        self.ctx = ctx
+        self.sequence = sequence
+        self.folder = folder or os.path.join(ctx.output_folder, "stream")
+        self.mpd_path = os.path.join(self.folder, "stream.mpd")
+        self.hls_path = os.path.join(self.folder, "master.m3u8")
+
+        # the segmenter keeps the timeline in memory, so a resumed job publishes from scratch
+        video_folder = os.path.join(self.folder, "video")
+        if os.path.exists(video_folder):
+            shutil.rmtree(video_folder)
+        self.segmenter = CmafVideoSegmenter(video_folder, track_id="video")
+
+        self.next_chunk = 0  # first chunk that isn't in a segment or pending yet
+        self.pending: List[str] = []
+        self.pending_duration = 0
+        self.finished = False
+        # the longest a segment can get, pending chunks just short of SEGMENT_DURATION plus the longest scene
+        self.target_duration = math.ceil(SEGMENT_DURATION + ctx.max_scene_length)
+
+    @staticmethod
+    def is_supported(ctx) -> bool:
+        encoder = ctx.get_encoder()
+        return (
+            encoder.get_codec() == Codec.av1
+            and encoder.get_chunk_file_extension() == ".ivf"
+        )
+
+    def _flush(self):
+        if len(self.pending) == 0:
+            return
+        self.segmenter.add_segment(self.pending)
+        self.pending, self.pending_duration = [], 0
+
+    def _write_playlists(self, live: bool):
+        track = self.segmenter.track
+        if track is None or len(track.segments) == 0:
+            return
+        write_mpd(self.mpd_path, [track], [])
+        write_hls(
+            self.hls_path,
+            [track],
+            [],
+            live=live,
+            target_duration=self.target_duration,
+        )
+
+    def update(self):
+        """
+        Publish the chunks that finished since the last call, if they continue the published prefix
+        """
+        if self.finished:
+            return
+        chunks = self.sequence.chunks
+        published = len(self.segmenter.track.segments) if self.segmenter.track else 0
+        while self.next_chunk < len(chunks) and chunks[self.next_chunk].is_done(
+            quiet=True,
+            kv=self.ctx.get_kv(),
+            paranoid=self.ctx.paranoid_integrity_check,
+        ):
+            chunk = chunks[self.next_chunk]
+            self.pending.append(chunk.chunk_path)
+            self.pending_duration += chunk.get_lenght()
+            self.next_chunk += 1
+            if self.pending_duration >= SEGMENT_DURATION:
+                self._flush()
+
+        if self.segmenter.track is not None and published < len(
+            self.segmenter.track.segments
+        ):
+            self._write_playlists(live=True)
+
+    def finish(self):
+        """
+        Every chunk passed the integrity check, publish the rest and end the playlists
+        """
+        if self.finished:
+            return
+        chunks = self.sequence.chunks
+        while self.next_chunk < len(chunks):
+            chunk = chunks[self.next_chunk]
+            self.pending.append(chunk.chunk_path)
+            self.pending_duration += chunk.get_lenght()
+            self.next_chunk += 1
+            if self.pending_duration >= SEGMENT_DURATION:
+                self._flush()
+        self._flush()
+        self._write_playlists(live=False)
+        self.finished = True
+        print(f"Streaming output done: {self.hls_path} {self.mpd_path}")
@@ -1,21 +1,37 @@
+import asyncio
 import copy
 import os
+import shlex
 import time
 from abc import abstractmethod, ABC
-from typing import List
+from typing import List, Optional
 
 from tqdm import tqdm
 
-from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.core.cli_executor import run_cli_async, run_sync
+from alabamaEncode.core.bin_utils import get_binary
+from alabamaEncode.core.cli_pipeline import (
+    Pipeline,
+    PipelineResult,
+    PipelineStage,
+    run_pipeline_async,
+)
 from alabamaEncode.core.ffmpeg import Ffmpeg
+from alabamaEncode.core.intermediate_cache import get_intermediate_cache
 from alabamaEncode.core.path import PathAlabama
+from alabamaEncode.core.resource_usage import record_resources
+from alabamaEncode.core.spool import SpoolReservation, get_spool_budget
 from alabamaEncode.encoder.codec import Codec
 from alabamaEncode.encoder.rate_dist import EncoderRateDistribution
 from alabamaEncode.encoder.stats import EncodeStats
-from alabamaEncode.metrics.calculate import calculate_metric
+from alabamaEncode.metrics.calculate import calculate_metric_async
 from alabamaEncode.metrics.exception import MetricException
 from alabamaEncode.metrics.impl.ssim import get_video_ssim
 from alabamaEncode.metrics.metric import Metric
+from alabamaEncode.metrics.multi_metric import (
+    calculate_metrics_async,
+    get_metric_list,
+)
 from alabamaEncode.metrics.options import MetricOptions
 
 
@@ -105,6 +121,11 @@ class Encoder(ABC):
 
     running_on_celery = False
 
+    # set while building fused encode-and-measure commands, the unfiltered reference decode gets tee'd here
+    _reference_spool: Optional[str] = None
+    # set while building batch probe commands, the already spooled decode is read back from here
+    _source_spool: Optional[str] = None
+
     def supports_float_crfs(self) -> bool:
         return False
 
@@ -116,19 +137,227 @@ class Encoder(ABC):
         self,
         override_if_exists=True,
         timeout_value=-1,
-        calcualte_ssim=False,
-        metric_to_calculate: Metric = None,
+        calculate_ssim=False,
+        metric_to_calculate: Metric | List[Metric] = None,
+        metric_params: MetricOptions = None,
+        on_frame_encoded: callable = None,
+    ) -> EncodeStats:
+        """
+        Blocking wrapper around `run_async`, the encode runs on the shared cli event loop
+        """
+        return run_sync(
+            self.run_async(
+                override_if_exists=override_if_exists,
+                timeout_value=timeout_value,
+                calculate_ssim=calculate_ssim,
+                metric_to_calculate=metric_to_calculate,
+                metric_params=metric_params,
+                on_frame_encoded=on_frame_encoded,
+            )
+        )
+
+    def encode_and_measure(
+        self,
+        metric_to_calculate: Metric = Metric.VMAF,
+        metric_params: MetricOptions = None,
+        override_if_exists=True,
+        timeout_value=-1,
+        on_frame_encoded: callable = None,
+    ) -> EncodeStats:
+        """
+        Blocking wrapper around `encode_and_measure_async`
+        """
+        return run_sync(
+            self.encode_and_measure_async(
+                metric_to_calculate=metric_to_calculate,
+                metric_params=metric_params,
+                override_if_exists=override_if_exists,
+                timeout_value=timeout_value,
+                on_frame_encoded=on_frame_encoded,
+            )
+        )
+
+    def _is_served_from_cache(self) -> bool:
+        intermediate_cache = get_intermediate_cache()
+        return intermediate_cache is not None and intermediate_cache.is_pinned(
+            self.chunk
+        )
+
+    async def encode_and_measure_async(
+        self,
+        metric_to_calculate: Metric = Metric.VMAF,
         metric_params: MetricOptions = None,
+        override_if_exists=True,
+        timeout_value=-1,
         on_frame_encoded: callable = None,
     ) -> EncodeStats:
         """
-        :param metric_to_calculate: the metric to calculate
-        :param calcualte_ssim: self-explanatory
+        Encode and calculate a metric while decoding the source only once, the unfiltered decode is tee'd
+        into a spool file on its way to the encoder and the metric builds its reference from that file
+        instead of decoding the source again. Falls back to a plain `run_async` when the intermediate cache
+        already dedupes the decodes or the spool doesn't fit the spool budget (see core.spool).
+        """
+        reservation = None
+        if self.chunk.first_frame_index != -1 and not self._is_served_from_cache():
+            reservation = await asyncio.to_thread(self._reserve_spool)
+        try:
+            return await self.run_async(
+                override_if_exists=override_if_exists,
+                timeout_value=timeout_value,
+                metric_to_calculate=metric_to_calculate,
+                metric_params=metric_params,
+                on_frame_encoded=on_frame_encoded,
+                _reference_spool=(
+                    reservation.get_path(f"{os.path.basename(self.output_path)}.ref")
+                    if reservation is not None
+                    else None
+                ),
+            )
+        finally:
+            if reservation is not None:
+                reservation.release()
+
+    def run_batch(
+        self,
+        crfs: List[float],
+        output_paths: List[str] = None,
+        metric_to_calculate: Metric = Metric.VMAF,
+        metric_params: MetricOptions = None,
+        override_if_exists=True,
+        timeout_value=-1,
+        max_parallel=-1,
+    ) -> List[EncodeStats]:
+        """
+        Blocking wrapper around `run_batch_async`
+        """
+        return run_sync(
+            self.run_batch_async(
+                crfs=crfs,
+                output_paths=output_paths,
+                metric_to_calculate=metric_to_calculate,
+                metric_params=metric_params,
+                override_if_exists=override_if_exists,
+                timeout_value=timeout_value,
+                max_parallel=max_parallel,
+            )
+        )
+
+    async def run_batch_async(
+        self,
+        crfs: List[float],
+        output_paths: List[str] = None,
+        metric_to_calculate: Metric = Metric.VMAF,
+        metric_params: MetricOptions = None,
+        override_if_exists=True,
+        timeout_value=-1,
+        max_parallel=-1,
+    ) -> List[EncodeStats]:
+        """
+        Encode the chunk at several crfs at once and measure each result, the chunk is decoded a single time
+        into a spool that every encode and every metric reference reads back.
+        Each encode runs on a copy of this encoder, so `self` is left untouched.
+        :param crfs: crfs to encode at
+        :param output_paths: where each encode goes, defaults to `<output_path without extension>.<crf><ext>`
+        :param max_parallel: how many encodes run at the same time, -1 for all of them
+        :return: EncodeStats for each crf, in the order of `crfs`
+        """
+        if len(crfs) == 0:
+            return []
+        if output_paths is None:
+            base = os.path.splitext(self.output_path)[0]
+            output_paths = [
+                f"{base}.{crf}{self.get_chunk_file_extension()}" for crf in crfs
+            ]
+        if len(output_paths) != len(crfs):
+            raise ValueError("run_batch needs one output path per crf")
+
+        spool = None
+        reservation = None
+        if self.chunk.first_frame_index != -1 and not self._is_served_from_cache():
+            # with the cache on, the first encode materializes the chunk and the rest hit it anyway
+            reservation = await asyncio.to_thread(self._reserve_spool)
+        if reservation is not None:
+            spool = reservation.get_path(f"{os.path.basename(self.output_path)}.src")
+
+        semaphore = asyncio.Semaphore(max_parallel if max_parallel > 0 else len(crfs))
+
+        async def probe(crf, output_path) -> EncodeStats:
+            enc = copy.deepcopy(self)
+            enc.crf = crf
+            enc.output_path = output_path
+            async with semaphore:
+                return await enc.run_async(
+                    override_if_exists=override_if_exists,
+                    timeout_value=timeout_value,
+                    metric_to_calculate=metric_to_calculate,
+                    # every probe fills in its own threads/filters
+                    metric_params=copy.copy(metric_params),
+                    _source_spool=spool,
+                )
+
+        try:
+            if spool is not None:
+                (
+                    await run_cli_async(
+                        f"{self.chunk.create_chunk_ffmpeg_pipe_command(video_filters='', bit_depth=self.bit_override)}"
+                        f" > {shlex.quote(spool)}"
+                    )
+                ).verify(
+                    fail_message=f"Failed to decode chunk {self.chunk.chunk_index}"
+                )
+            return list(
+                await asyncio.gather(
+                    *[probe(crf, path) for crf, path in zip(crfs, output_paths)]
+                )
+            )
+        finally:
+            if reservation is not None:
+                reservation.release()
+
+    def _reserve_spool(self) -> Optional[SpoolReservation]:
+        """
+        :return: room for the chunk's decoded frames, None if spooling is off or there is no room
+        """
+        spool_budget = get_spool_budget()
+        if spool_budget is None:
+            return None
+        # spooled at the pipe's bit depth, yuv420p is 1.5 bytes per pixel, yuv420p10le 3,
+        # plus slack for the y4m headers
+        needed = (
+            self.chunk.get_width()
+            * self.chunk.get_height()
+            * (1.5 if self.bit_override == 8 else 3)
+            * self.chunk.get_frame_count()
+            * 1.1
+        )
+        return spool_budget.reserve(
+            needed,
+            log_prefix=self.chunk.log_prefix(),
+        )
+
+    async def run_async(
+        self,
+        override_if_exists=True,
+        timeout_value=-1,
+        calculate_ssim=False,
+        metric_to_calculate: Metric | List[Metric] = None,
+        metric_params: MetricOptions = None,
+        on_frame_encoded: callable = None,
+        _reference_spool: Optional[str] = None,
+        _source_spool: Optional[str] = None,
+    ) -> EncodeStats:
+        """
+        :param metric_to_calculate: the metric to calculate, or a list of them to get out of one decode,
+        stats.metric_results is the first one's and stats.metrics has all of them
+        :param calculate_ssim: ffmpeg's all plane ssim into stats.ssim/ssim_db, a decode of its own,
+        for libvmaf's luma ssim in the same pass as the other metrics ask for Metric.SSIM
         :param metric_params: dict of vmaf params
         :param override_if_exists: if false and file already exist don't do anything
         :param timeout_value: how much (in seconds) before giving up
         :param on_frame_encoded: callback function that gets called when a frame is encoded,
         with the following parameters: frame: the frame number bitrate: bitrate so far fps: encoding fps
+        :param _reference_spool: see `encode_and_measure_async`
+        :param _source_spool: see `run_batch_async`
         :return: EncodeStats object with scores bitrate & stuff
         """
         stats = EncodeStats()
@@ -141,7 +370,7 @@ class Encoder(ABC):
             should_encode = True
         elif override_if_exists:
             should_encode = True
-        elif not self.chunk.is_done(quiet=True):
+        elif not await asyncio.to_thread(self.chunk.is_done, quiet=True):
             should_encode = True
 
         if not should_encode:
@@ -171,7 +400,16 @@ class Encoder(ABC):
 
             cli_output = []
             start = time.time()
-            commands = self.get_encode_commands()
+            # some encoders probe their version here, don't stall the loop on it
+            self._reference_spool = _reference_spool
+            self._source_spool = _source_spool
+            try:
+                commands = await asyncio.to_thread(self.get_encode_pipelines)
+                if commands is None:
+                    commands = await asyncio.to_thread(self.get_encode_commands)
+            finally:
+                self._reference_spool = None
+                self._source_spool = None
             self.output_path = original_path
 
             times_called = 0
@@ -188,40 +426,44 @@ class Encoder(ABC):
                     parse_func = None
 
                     if has_frame_callback:
-                        # We can report progress to a callback
-                        output_buffer = ""
+                        # We can report progress to a callback,
+                        # run_cli hands us whole output lines so each one is parsed on its own
 
-                        def parse(string):
-                            nonlocal output_buffer
+                        def parse(record):
                             nonlocal times_called
                             nonlocal latest_frame_update
-                            output_buffer += string
-                            prog = self.parse_output_for_output(output_buffer)
+                            prog = self.parse_output_for_output(record)
 
                             if len(prog) > 0:
                                 times_called += 1
-                                # tqdm.write("FRAME ENCODED")
-                                # tqdm.write(str(prog))
                                 latest_frame_update = prog[0]
                                 on_frame_encoded(prog[0], prog[1], prog[2])
 
-                                output_buffer = ""
-
                         parse_func = parse
 
-                    cli_out = (
-                        run_cli(
+                    if isinstance(command, Pipeline):
+                        cli_result = await run_pipeline_async(
                             command, timeout_value=timeout_value, on_output=parse_func
                         )
-                        .verify()
-                        .get_output()
-                    )
-                    cli_output.append(cli_out)
+                    else:
+                        cli_result = await run_cli_async(
+                            command, timeout_value=timeout_value, on_output=parse_func
+                        )
+                    if isinstance(cli_result, PipelineResult):
+                        for stage, usage in cli_result.stage_resources.items():
+                            stats.add_resources(stage, usage)
+                    else:
+                        # a shell string, the decoder is hidden inside it
+                        stats.add_resources("encode", cli_result.resources)
+                    cli_output.append(cli_result.get_output())
+                    cli_result.verify()
 
                 if self.running_on_celery:
                     # os.rename(celery_path, original_path)
                     # do a copy instead bc "invalid cross-device link"
-                    run_cli(f'cp "{celery_path}" "{original_path}"').verify()
+                    (
+                        await run_cli_async(f'cp "{celery_path}" "{original_path}"')
+                    ).verify()
                     os.remove(celery_path)
 
                 if has_frame_callback:
@@ -255,7 +497,8 @@ class Encoder(ABC):
                     print(c)
                 raise e
 
-        if metric_to_calculate is not None:
+        metrics = get_metric_list(metric_to_calculate)
+        if len(metrics) > 0:
             local_chunk = copy.deepcopy(
                 self.chunk
             )  # we need seeking variables from the chunk but the path from the
@@ -266,20 +509,45 @@ class Encoder(ABC):
             )
             metric_params.threads = self.threads
             metric_params.video_filters = self.video_filters
+            spool = _source_spool if _source_spool is not None else _reference_spool
+            if (
+                spool is not None
+                and os.path.exists(spool)
+                and os.path.getsize(spool) > 0
+            ):
+                # don't leak the spool into the caller's options object
+                metric_params = copy.copy(metric_params)
+                metric_params.reference_y4m = spool
 
             try:
-                stats.metric_results = calculate_metric(
-                    chunk=local_chunk,
-                    options=metric_params,
-                    metric=metric_to_calculate,
-                )
+                if len(metrics) == 1:
+                    result = await calculate_metric_async(
+                        chunk=local_chunk,
+                        options=metric_params,
+                        metric=metrics[0],
+                    )
+                    stats.metrics = {metrics[0]: result}
+                    stats.add_resources("metric", result.resources)
+                else:
+                    # one decode of the encode and the source for all of them
+                    results = await calculate_metrics_async(
+                        chunk=local_chunk,
+                        metrics=metrics,
+                        options=metric_params,
+                    )
+                    stats.metrics = results.results
+                    stats.add_resources("metric", results.resources)
             except MetricException as e:
                 raise Exception(
-                    f"{metric_to_calculate} calculation in encoder failed: {e}"
+                    f"{', '.join([m.name for m in metrics])} calculation in encoder failed: {e}"
                 )
 
-        if calcualte_ssim:
-            ssim, ssim_db = get_video_ssim(
+            stats.metric_results = stats.metrics[metrics[0]]
+
+        if calculate_ssim:
+            # ffmpeg's all plane ssim, Metric.SSIM is libvmaf's luma only float_ssim and reads higher
+            ssim, ssim_db = await asyncio.to_thread(
+                get_video_ssim,
                 self.output_path,
                 self.chunk,
                 video_filters=self.video_filters,
@@ -290,9 +558,14 @@ class Encoder(ABC):
 
         stats.size = os.path.getsize(self.output_path) / 1000
         stats.bitrate = int(
-            Ffmpeg.get_total_bitrate(PathAlabama(self.output_path)) / 1000
+            await asyncio.to_thread(
+                Ffmpeg.get_total_bitrate, PathAlabama(self.output_path)
+            )
+            / 1000
         )
 
+        record_resources(stats.resources)
+
         return stats
 
     @abstractmethod
@@ -303,15 +576,85 @@ class Encoder(ABC):
         """
         pass
 
+    def get_encode_pipelines(self) -> [List[Pipeline] | None]:
+        """
+        Overriden by encoders that can run without a shell,
+        same steps as `get_encode_commands` but as process graphs wired together by the executor
+        :return: A list of pipelines, or None to fall back to `get_encode_commands`
+        """
+        return None
+
     def get_ffmpeg_pipe_command(self) -> str:
         """
         return cli command that pipes a y4m stream into stdout using the chunk object
         """
+        if self._reference_spool is not None or self._source_spool is not None:
+            return " | ".join(
+                [shlex.join(stage.argv) for stage in self.get_ffmpeg_pipe_stages()]
+            )
         return self.chunk.create_chunk_ffmpeg_pipe_command(
             video_filters=self.video_filters,
             bit_depth=self.bit_override,
         )
 
+    def get_ffmpeg_pipe_argv(self) -> List[str]:
+        """
+        argv form of `get_ffmpeg_pipe_command`
+        """
+        return self.chunk.create_chunk_ffmpeg_pipe_argv(
+            video_filters=self.video_filters,
+            bit_depth=self.bit_override,
+        )
+
+    def get_ffmpeg_pipe_stages(self) -> List[PipelineStage]:
+        """
+        The processes that feed the encoder a y4m stream, the first one is always the source decode.
+        When spooling a reference for `encode_and_measure` that is decode -> tee -> filter,
+        so the spool holds the unfiltered frames and the metric can apply its own filters to them.
+        In a `run_batch` the spool is already filled and the decode is just reading it back.
+        """
+        if self._source_spool is not None:
+            stages = [PipelineStage(["cat", self._source_spool], name="decode")]
+        elif self._reference_spool is not None:
+            stages = [
+                PipelineStage(
+                    self.chunk.create_chunk_ffmpeg_pipe_argv(
+                        video_filters="", bit_depth=self.bit_override
+                    ),
+                    name="decode",
+                ),
+                PipelineStage(["tee", self._reference_spool], name="tee"),
+            ]
+        else:
+            return [PipelineStage(self.get_ffmpeg_pipe_argv(), name="decode")]
+
+        # the spool is already at the encoder's bit depth, only the filters are left
+        video_filters = self.video_filters if self.video_filters is not None else ""
+        if video_filters != "":
+            argv = [
+                get_binary("ffmpeg"),
+                "-threads",
+                "1",
+                "-v",
+                "error",
+                "-nostdin",
+                "-f",
+                "yuv4mpegpipe",
+                "-i",
+                "-",
+                "-pix_fmt",
+                "yuv420p" if self.bit_override == 8 else "yuv420p10le",
+                "-strict",
+                "-1",
+                "-vf",
+                video_filters,
+                "-f",
+                "yuv4mpegpipe",
+                "-",
+            ]
+            stages.append(PipelineStage(argv, name="filter"))
+        return stages
+
     @abstractmethod
     def get_chunk_file_extension(self) -> str:
         return ".mkv"
@@ -326,7 +669,7 @@ class Encoder(ABC):
     def parse_output_for_output(self, buffer) -> [List[str] | None]:
         """
         Parse the output of the encoder and return the frame number, bitrate, and fps.
-        :param buffer: The output of the encoder so far
+        :param buffer: A single line of encoder output
         :return: a list of [frame, bitrate, fps], [] if no output is found, None if not implemented
         """
         return None
@@ -38,9 +38,7 @@ class EncoderAom(Encoder):
 
     def get_encode_commands(self) -> List[str]:
         self.speed = min(self.speed, 9)
-        encode_command = self.chunk.create_chunk_ffmpeg_pipe_command(
-            video_filters=self.video_filters
-        )
+        encode_command = self.get_ffmpeg_pipe_command()
         encode_command += " | "
         encode_command += f"{get_binary('aomenc')} - "
         encode_command += " --quiet "
@@ -1,8 +1,10 @@
 import re
+import shlex
 from typing import List
 
 from alabamaEncode.core.bin_utils import get_binary, check_bin
 from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.core.cli_pipeline import Pipeline, PipelineStage
 from alabamaEncode.encoder.codec import Codec
 from alabamaEncode.encoder.encoder import Encoder
 from alabamaEncode.encoder.rate_dist import EncoderRateDistribution
@@ -40,107 +42,7 @@ class EncoderSvt(Encoder):
         )
 
         if self.override_flags == "" or self.override_flags is None:
-            kommand += f" --keyint {self.keyint}"
-
-            def crf_check():
-                """
-                validate crf fields
-                """
-                if self.crf is None or self.crf == -1:
-                    raise Exception("FATAL: crf is not set")
-                if self.crf > 63:
-                    raise Exception("FATAL: crf must be less than 63")
-
-            kommand += f" --color-primaries {self.color_primaries}"
-            kommand += f" --transfer-characteristics {self.transfer_characteristics}"
-
-            if self.matrix_coefficients == "bt2020c":
-                self.matrix_coefficients = "bt2020-cl"
-
-            kommand += f" --matrix-coefficients {self.matrix_coefficients}"
-
-            if self.hdr:
-                kommand += f" --enable-hdr 1"
-                kommand += f" --chroma-sample-position {self.chroma_sample_position}"
-                kommand += (
-                    f" --content-light "
-                    f"{self.maximum_content_light_level},{self.maximum_frame_average_light_level}"
-                )
-                if self.svt_master_display != "":
-                    kommand += f' --mastering-display "{self.svt_master_display}"'
-
-            def bitrate_check():
-                """
-                validate bitrate fields
-                """
-                if self.bitrate is None or self.bitrate == -1:
-                    raise Exception("FATAL: bitrate is not set")
-
-            match self.rate_distribution:
-                case EncoderRateDistribution.CQ:
-                    if self.passes != 1:
-                        print("WARNING: passes must be 1 for CQ, setting to 1")
-                        self.passes = 1
-                    crf_check()
-                    kommand += f" --crf {self.crf} --rc 0"
-                case EncoderRateDistribution.VBR:
-                    bitrate_check()
-                    kommand += f" --rc 1 --tbr {self.bitrate} --undershoot-pct 95 --overshoot-pct 10 "
-                case EncoderRateDistribution.CQ_VBV:
-                    bitrate_check()
-                    crf_check()
-                    kommand += f" --crf {self.crf} --mbr {self.bitrate}"
-                case EncoderRateDistribution.VBR_VBV:
-                    raise Exception("FATAL: VBR_VBV is not supported")
-
-            kommand += f" --tune {self.svt_tune}"
-
-            kommand += f" --pin 0"
-            kommand += f" --lp {self.threads}"
-
-            kommand += f" --aq-mode {self.svt_aq_mode}"
-
-            if self.tile_cols != -1:
-                kommand += f" --tile-columns {self.tile_cols}"
-            if self.tile_rows != -1:
-                kommand += f" --tile-rows {self.tile_rows}"
-
-            if self.svt_supperres_mode != 0:
-                kommand += f" --superres-mode {self.svt_supperres_mode}"
-                kommand += f" --superres-denom {self.svt_superres_denom}"
-                kommand += f" --superres-kf-denom {self.svt_superres_kf_denom}"
-                kommand += f" --superres-qthres {self.svt_superres_qthresh}"
-                kommand += f" --superres-kf-qthres {self.svt_superres_kf_qthresh}"
-
-            if self.svt_sframe_interval > 0:
-                kommand += f" --sframe-dist {self.svt_sframe_interval}"
-                kommand += f" --sframe-mode {self.svt_sframe_mode}"
-
-            if self.svt_resize_mode != 0:
-                kommand += f" --resize-mode {self.svt_resize_mode}"
-                kommand += f" --resize-denominator {self.svt_resize_denominator}"
-                kommand += f" --resize-kf-denominator {self.svt_resize_kf_denominator}"
-
-            if 0 <= self.grain_synth <= 50:
-                kommand += f" --film-grain {self.grain_synth}"
-
-            kommand += f" --preset {self.speed}"
-            kommand += f" --film-grain-denoise 0"
-            if self.qm_enabled:
-                kommand += f" --qm-min {self.qm_min}"
-                kommand += f" --qm-max {self.qm_max}"
-                kommand += " --enable-qm 1"
-            else:
-                kommand += " --enable-qm 0"
-
-            kommand += f" --enable-tf {self.svt_tf}"
-
-            kommand += f" --enable-variance-boost {self.svt_enable_variance_boost} "
-            kommand += f" --variance-boost-strength {self.svt_variance_boost_strength}"
-            kommand += f" --variance-octile {self.svt_variance_octile}"
-            if self.is_psy():
-                kommand += f" --sharpness {self.svt_sharpness}"
-
+            kommand += f" {shlex.join(self.get_svt_params())}"
         else:
             kommand += self.override_flags
 
@@ -170,6 +72,170 @@ class EncoderSvt(Encoder):
 
         return commands
 
+    def get_encode_pipelines(self) -> [List[Pipeline] | None]:
+        if self.override_flags != "" and self.override_flags is not None:
+            # override flags are a raw shell fragment, only the string form can take them
+            return None
+
+        if (
+            self.keyint == -1 or self.keyint == -2
+        ) and self.rate_distribution == EncoderRateDistribution.VBR:
+            print("WARNING: keyint must be set for VBR, setting to 240")
+            self.keyint = 240
+
+        feed = self.get_ffmpeg_pipe_stages()
+        if check_bin("taskset"):
+            if self.pin_to_core != -1:
+                feed[0] = PipelineStage(
+                    ["taskset", "-a", "-c", str(self.pin_to_core)] + feed[0].argv,
+                    name=feed[0].name,
+                )
+
+        encode = [
+            get_binary("SvtAv1EncApp"),
+            "-i",
+            "stdin",
+            "--input-depth",
+            str(self.bit_override),
+            "--progress",
+            "2",
+        ] + self.get_svt_params()
+
+        def svt_pass(pass_args: List[str]) -> Pipeline:
+            return Pipeline(feed + [PipelineStage(encode + pass_args, name="encode")])
+
+        stats = ["--stats", f"{self.output_path}.stat"]
+        remove_stats = Pipeline(
+            [PipelineStage(["rm", f"{self.output_path}.stat"], name="encode")]
+        )
+
+        match self.passes:
+            case 2:
+                return [
+                    svt_pass(["--pass", "1"] + stats),
+                    svt_pass(["--pass", "2"] + stats + ["-b", self.output_path]),
+                    remove_stats,
+                ]
+            case 1:
+                return [svt_pass(["-b", self.output_path])]
+            case 3:
+                return [
+                    svt_pass(["--pass", "1"] + stats),
+                    svt_pass(["--pass", "2"] + stats),
+                    svt_pass(["--pass", "3"] + stats + ["-b", self.output_path]),
+                    remove_stats,
+                ]
+            case _:
+                raise Exception(f"FATAL: invalid passes count {self.passes}")
+
+    def get_svt_params(self) -> List[str]:
+        """
+        :return: the SvtAv1EncApp arguments derived from the class fields, without input/output/pass args
+        """
+        params = ["--keyint", str(self.keyint)]
+
+        def crf_check():
+            """
+            validate crf fields
+            """
+            if self.crf is None or self.crf == -1:
+                raise Exception("FATAL: crf is not set")
+            if self.crf > 63:
+                raise Exception("FATAL: crf must be less than 63")
+
+        params += ["--color-primaries", self.color_primaries]
+        params += ["--transfer-characteristics", self.transfer_characteristics]
+
+        if self.matrix_coefficients == "bt2020c":
+            self.matrix_coefficients = "bt2020-cl"
+
+        params += ["--matrix-coefficients", self.matrix_coefficients]
+
+        if self.hdr:
+            params += ["--enable-hdr", "1"]
+            params += ["--chroma-sample-position", str(self.chroma_sample_position)]
+            params += [
+                "--content-light",
+                f"{self.maximum_content_light_level},{self.maximum_frame_average_light_level}",
+            ]
+            if self.svt_master_display != "":
+                params += ["--mastering-display", self.svt_master_display]
+
+        def bitrate_check():
+            """
+            validate bitrate fields
+            """
+            if self.bitrate is None or self.bitrate == -1:
+                raise Exception("FATAL: bitrate is not set")
+
+        match self.rate_distribution:
+            case EncoderRateDistribution.CQ:
+                if self.passes != 1:
+                    print("WARNING: passes must be 1 for CQ, setting to 1")
+                    self.passes = 1
+                crf_check()
+                params += ["--crf", str(self.crf), "--rc", "0"]
+            case EncoderRateDistribution.VBR:
+                bitrate_check()
+                params += ["--rc", "1", "--tbr", str(self.bitrate)]
+                params += ["--undershoot-pct", "95", "--overshoot-pct", "10"]
+            case EncoderRateDistribution.CQ_VBV:
+                bitrate_check()
+                crf_check()
+                params += ["--crf", str(self.crf), "--mbr", str(self.bitrate)]
+            case EncoderRateDistribution.VBR_VBV:
+                raise Exception("FATAL: VBR_VBV is not supported")
+
+        params += ["--tune", str(self.svt_tune)]
+
+        params += ["--pin", "0"]
+        params += ["--lp", str(self.threads)]
+
+        params += ["--aq-mode", str(self.svt_aq_mode)]
+
+        if self.tile_cols != -1:
+            params += ["--tile-columns", str(self.tile_cols)]
+        if self.tile_rows != -1:
+            params += ["--tile-rows", str(self.tile_rows)]
+
+        if self.svt_supperres_mode != 0:
+            params += ["--superres-mode", str(self.svt_supperres_mode)]
+            params += ["--superres-denom", str(self.svt_superres_denom)]
+            params += ["--superres-kf-denom", str(self.svt_superres_kf_denom)]
+            params += ["--superres-qthres", str(self.svt_superres_qthresh)]
+            params += ["--superres-kf-qthres", str(self.svt_superres_kf_qthresh)]
+
+        if self.svt_sframe_interval > 0:
+            params += ["--sframe-dist", str(self.svt_sframe_interval)]
+            params += ["--sframe-mode", str(self.svt_sframe_mode)]
+
+        if self.svt_resize_mode != 0:
+            params += ["--resize-mode", str(self.svt_resize_mode)]
+            params += ["--resize-denominator", str(self.svt_resize_denominator)]
+            params += ["--resize-kf-denominator", str(self.svt_resize_kf_denominator)]
+
+        if 0 <= self.grain_synth <= 50:
+            params += ["--film-grain", str(self.grain_synth)]
+
+        params += ["--preset", str(self.speed)]
+        params += ["--film-grain-denoise", "0"]
+        if self.qm_enabled:
+            params += ["--qm-min", str(self.qm_min)]
+            params += ["--qm-max", str(self.qm_max)]
+            params += ["--enable-qm", "1"]
+        else:
+            params += ["--enable-qm", "0"]
+
+        params += ["--enable-tf", str(self.svt_tf)]
+
+        params += ["--enable-variance-boost", str(self.svt_enable_variance_boost)]
+        params += ["--variance-boost-strength", str(self.svt_variance_boost_strength)]
+        params += ["--variance-octile", str(self.svt_variance_octile)]
+        if self.is_psy():
+            params += ["--sharpness", str(self.svt_sharpness)]
+
+        return params
+
     def get_chunk_file_extension(self) -> str:
         return ".ivf"
 
@@ -0,0 +1,276 @@
+"""
+Encodes a chunk at several resolutions x crfs off a single decode. One ffmpeg `split` + `scale` graph writes
+every rung and the metric reference out once, then all the encodes and metric runs read those back.
+"""
+
+import asyncio
+import copy
+import shlex
+from typing import List, Tuple, Optional
+
+from alabamaEncode.core.bin_utils import get_binary
+from alabamaEncode.core.cli_executor import run_cli_async, run_sync
+from alabamaEncode.core.spool import get_spool_budget
+from alabamaEncode.encoder.encoder import Encoder
+from alabamaEncode.encoder.stats import EncodeStats
+from alabamaEncode.metrics.calculate import get_reference_filters
+from alabamaEncode.metrics.metric import Metric
+from alabamaEncode.metrics.options import MetricOptions
+
+__all__ = ["LadderEncoder", "LadderRung", "get_rung_filters"]
+
+
+def get_rung_filters(video_filters: str, resolution: str) -> Tuple[str, str]:
+    """
+    Swap the lanczos scale filter of a chain for the rung's (or append one), and split the chain around it
+    :param resolution: e.g. "1280:-2"
+    :return: (filters that run before the scale, the scale + the filters after it)
+    """
+    scale_str = f"scale={resolution}:flags=lanczos"
+    vf = [f for f in (video_filters or "").split(",") if f != ""]
+
+    scale_index = len(vf)
+    for i in range(len(vf)):
+        if ":flags=lanczos" in vf[i]:
+            scale_index = i
+            break
+
+    shared = vf[:scale_index]
+    rung = [scale_str] + vf[scale_index + 1 :]
+    return ",".join(shared), ",".join(rung)
+
+
+class LadderRung:
+    def __init__(self, resolution: str, video_filters: str):
+        self.resolution = resolution
+        self.shared_filters, self.rung_filters = get_rung_filters(
+            video_filters, resolution
+        )
+        self.spool: Optional[str] = None
+        self.reference_spool: Optional[str] = None
+
+    @property
+    def video_filters(self) -> str:
+        """
+        the full chain an encoder at this rung applies to the source
+        """
+        return ",".join([f for f in [self.shared_filters, self.rung_filters] if f])
+
+    def get_pixel_count(self, source_width: int, source_height: int) -> int:
+        try:
+            width = int(self.resolution.split(":")[0])
+        except ValueError:
+            width = -1
+        if width <= 0:
+            return source_width * source_height
+        return width * int(width * source_height / source_width)
+
+
+class LadderEncoder:
+    """
+    Runs (resolution, crf, output path) jobs for one chunk, every job of a resolution reads the same
+    spooled rung, every job whose metric reference is the same reads the same spooled reference.
+    Falls back to one `Encoder.run_batch` per resolution when the spools don't fit the spool budget.
+    """
+
+    def __init__(self, encoder: Encoder, video_filters: str = ""):
+        """
+        :param encoder: prototype, every job runs on a copy of it
+        :param video_filters: the filters without the ladder's scaling, a lanczos scale in them gets replaced
+        """
+        self.encoder = encoder
+        self.video_filters = video_filters
+
+    def run(
+        self,
+        jobs: List[Tuple[str, float, str]],
+        metric_to_calculate: Metric | List[Metric] = Metric.VMAF,
+        metric_params: MetricOptions = None,
+        override_if_exists=True,
+        timeout_value=-1,
+        max_parallel=-1,
+    ) -> List[EncodeStats]:
+        """
+        Blocking wrapper around `run_async`
+        """
+        return run_sync(
+            self.run_async(
+                jobs=jobs,
+                metric_to_calculate=metric_to_calculate,
+                metric_params=metric_params,
+                override_if_exists=override_if_exists,
+                timeout_value=timeout_value,
+                max_parallel=max_parallel,
+            )
+        )
+
+    async def run_async(
+        self,
+        jobs: List[Tuple[str, float, str]],
+        metric_to_calculate: Metric | List[Metric] = Metric.VMAF,
+        metric_params: MetricOptions = None,
+        override_if_exists=True,
+        timeout_value=-1,
+        max_parallel=-1,
+    ) -> List[EncodeStats]:
+        """
+        :param jobs: (resolution like "1280:-2", crf, output path)
+        :param max_parallel: how many encodes run at the same time, -1 for all of them
+        :return: EncodeStats for each job, in the order of `jobs`
+        """
+        if len(jobs) == 0:
+            return []
+        chunk = self.encoder.chunk
+
+        rungs = {}
+        for resolution, _, _ in jobs:
+            if resolution not in rungs:
+                rungs[resolution] = LadderRung(resolution, self.video_filters)
+        rungs: List[LadderRung] = list(rungs.values())
+
+        # rungs whose references come out the same (the usual case, since the metric scales
+        # to the comparison display resolution) share a single spooled reference
+        references = {}
+        if metric_to_calculate is not None and metric_params is not None:
+            for rung in rungs:
+                options = copy.copy(metric_params)
+                options.video_filters = rung.video_filters
+                reference_filters, _ = get_reference_filters(options)
+                references.setdefault(reference_filters, []).append(rung)
+
+        spool_budget = get_spool_budget()
+        reservation = None
+        if chunk.first_frame_index != -1 and spool_budget is not None:
+            reservation = await asyncio.to_thread(
+                spool_budget.reserve,
+                self._get_spool_size(rungs, metric_params, len(references)),
+                chunk.log_prefix(),
+            )
+        if reservation is None:
+            return await self._run_per_rung(
+                jobs,
+                metric_to_calculate,
+                metric_params,
+                override_if_exists,
+                timeout_value,
+                max_parallel,
+            )
+
+        for i, rung in enumerate(rungs):
+            rung.spool = reservation.get_path(f"ladder.{chunk.chunk_index}.rung{i}")
+        for i, reference_rungs in enumerate(references.values()):
+            reference_spool = reservation.get_path(f"ladder.{chunk.chunk_index}.ref{i}")
+            for rung in reference_rungs:
+                rung.reference_spool = reference_spool
+
+        semaphore = asyncio.Semaphore(max_parallel if max_parallel > 0 else len(jobs))
+
+        async def encode(resolution, crf, output_path) -> EncodeStats:
+            rung = next(r for r in rungs if r.resolution == resolution)
+            enc = copy.deepcopy(self.encoder)
+            enc.crf = crf
+            enc.output_path = output_path
+            # the rung spool is already filtered and scaled
+            enc.video_filters = ""
+            options = copy.copy(metric_params)
+            if options is not None:
+                options.filtered_reference_y4m = rung.reference_spool or ""
+            async with semaphore:
+                return await enc.run_async(
+                    override_if_exists=override_if_exists,
+                    timeout_value=timeout_value,
+                    metric_to_calculate=metric_to_calculate,
+                    metric_params=options,
+                    _source_spool=rung.spool,
+                )
+
+        try:
+            (await run_cli_async(self._get_split_command(rungs, references))).verify(
+                fail_message=f"Failed to build the ladder of chunk {chunk.chunk_index}"
+            )
+            return list(
+                await asyncio.gather(
+                    *[encode(res, crf, path) for res, crf, path in jobs]
+                )
+            )
+        finally:
+            reservation.release()
+
+    def _get_spool_size(
+        self, rungs: List[LadderRung], metric_params: MetricOptions, references: int
+    ) -> float:
+        chunk = self.encoder.chunk
+        width, height = chunk.get_width(), chunk.get_height()
+        rung_pixels = sum([rung.get_pixel_count(width, height) for rung in rungs])
+        reference_pixels = 0
+        if references > 0:
+            if metric_params.ref is not None:
+                ref_width, ref_height = str(metric_params.ref).split(":")
+                reference_pixels = int(ref_width) * int(ref_height) * references
+            else:
+                reference_pixels = width * height * references
+        # rungs are at the encoder's bit depth, yuv420p is 1.5 bytes per pixel, yuv420p10le 3,
+        # references always 10 bit, plus slack for the y4m headers
+        rung_bytes = rung_pixels * (1.5 if self.encoder.bit_override == 8 else 3)
+        return (rung_bytes + reference_pixels * 3) * chunk.get_frame_count() * 1.1
+
+    def _get_split_command(self, rungs: List[LadderRung], references: dict) -> str:
+        """
+        decode | ffmpeg -filter_complex "split -> shared filters -> split -> per rung scale, + the references"
+        """
+        chunk = self.encoder.chunk
+        shared_filters = rungs[0].shared_filters or "null"
+        graph = [
+            f"[0:v]split={1 + len(references)}[enc]"
+            + "".join([f"[ref{i}]" for i in range(len(references))]),
+            f"[enc]{shared_filters},split={len(rungs)}"
+            + "".join([f"[rung{i}]" for i in range(len(rungs))]),
+        ]
+        rung_pix_fmt = "yuv420p" if self.encoder.bit_override == 8 else "yuv420p10le"
+        outputs = []
+        for i, rung in enumerate(rungs):
+            graph.append(f"[rung{i}]{rung.rung_filters}[out_rung{i}]")
+            outputs.append((f"[out_rung{i}]", rung.spool, rung_pix_fmt))
+        for i, (reference_filters, reference_rungs) in enumerate(references.items()):
+            graph.append(f"[ref{i}]{reference_filters or 'null'}[out_ref{i}]")
+            outputs.append(
+                (f"[out_ref{i}]", reference_rungs[0].reference_spool, "yuv420p10le")
+            )
+
+        command = (
+            f"{chunk.create_chunk_ffmpeg_pipe_command(video_filters='', bit_depth=10)} | "
+            f"{get_binary('ffmpeg')} -v error -nostdin -f yuv4mpegpipe -i - "
+            f"-filter_complex {shlex.quote(';'.join(graph))}"
+        )
+        for label, path, pix_fmt in outputs:
+            command += (
+                f" -map {shlex.quote(label)} -pix_fmt {pix_fmt} -strict -1"
+                f" -f yuv4mpegpipe {shlex.quote(path)}"
+            )
+        return command
+
+    async def _run_per_rung(
+        self,
+        jobs: List[Tuple[str, float, str]],
+        metric_to_calculate: Metric,
+        metric_params: MetricOptions,
+        override_if_exists: bool,
+        timeout_value: int,
+        max_parallel: int,
+    ) -> List[EncodeStats]:
+        results = {}
+        for resolution in dict.fromkeys([res for res, _, _ in jobs]):
+            indexes = [i for i, job in enumerate(jobs) if job[0] == resolution]
+            enc = copy.deepcopy(self.encoder)
+            enc.video_filters = LadderRung(resolution, self.video_filters).video_filters
+            all_stats = await enc.run_batch_async(
+                crfs=[jobs[i][1] for i in indexes],
+                output_paths=[jobs[i][2] for i in indexes],
+                metric_to_calculate=metric_to_calculate,
+                metric_params=metric_params,
+                override_if_exists=override_if_exists,
+                timeout_value=timeout_value,
+                max_parallel=max_parallel,
+            )
+            results.update(zip(indexes, all_stats))
+        return [results[i] for i in range(len(jobs))]
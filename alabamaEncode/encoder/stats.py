@@ -1,5 +1,8 @@
 import json
+from typing import Dict
 
+from alabamaEncode.core.resource_usage import ResourceUsage
+from alabamaEncode.metrics.metric import Metric
 from alabamaEncode.metrics.result import MetricResult
 
 
@@ -38,7 +41,24 @@ class EncodeStats:
         self.basename = basename
         self.version = version
         self.metric_results = metric_result or MetricResult()
+        # every metric calculated for the encode, metric_results among them
+        self.metrics: Dict[Metric, MetricResult] = {}
         self.length_frames = length_frames
+        # process usage of this encode per stage, e.g. decode, encode, metric
+        self.resources: Dict[str, ResourceUsage] = {}
+        # usage of everything run for the chunk, analysis probes included, set by the chunk job
+        self.chunk_resources: dict | None = None
+
+    def add_resources(self, stage: str, usage: ResourceUsage):
+        if usage is None:
+            return
+        self.resources[stage] = self.resources.get(stage, ResourceUsage()) + usage
+
+    def get_cpu_seconds_per_frame(self) -> float:
+        if self.length_frames <= 0 or len(self.resources) == 0:
+            return -1
+        total = sum(self.resources.values(), ResourceUsage())
+        return round(total.cpu_time / self.length_frames, 4)
 
     def __dict__(self):
         return {
@@ -60,8 +80,17 @@ class EncodeStats:
             "metric_percentile_25": self.metric_results.percentile_25,
             "metric_percentile_50": self.metric_results.percentile_50,
             "metric_avg": self.metric_results.mean,
+            "metrics": {
+                metric.name.lower(): result.mean
+                for metric, result in self.metrics.items()
+            },
             "basename": self.basename,
             "version": self.version,
+            "resources": {
+                stage: usage.dict() for stage, usage in self.resources.items()
+            },
+            "cpu_seconds_per_frame": self.get_cpu_seconds_per_frame(),
+            "chunk_resources": self.chunk_resources,
         }
 
     def save(self, path):
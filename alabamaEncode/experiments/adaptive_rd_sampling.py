@@ -0,0 +1,191 @@
+"""
+Checks the adaptive multi-res sampler against the exhaustive crf sweep on synthetic rate-distortion curves:
+how many encodes it saves and how often the convex hull trellis ends up with a different ladder.
+Run with `python -m alabamaEncode.experiments.adaptive_rd_sampling [titles] [chunks per title]`
+"""
+
+import math
+import random
+import sys
+
+import numpy as np
+
+from alabamaEncode.conent_analysis.convex_hull import (
+    CandidateTable,
+    solve_min_bits,
+    get_best_resolutions,
+)
+from alabamaEncode.conent_analysis.opinionated_vmaf import (
+    convexhull_get_crf_range,
+    convexhull_get_resolutions,
+    get_vmaf_list,
+)
+from alabamaEncode.conent_analysis.rd_sampler import (
+    AdaptiveRdSampler,
+    MAX_REFINE_ROUNDS,
+)
+from alabamaEncode.encoder.codec import Codec
+
+
+def make_chunk(rng: random.Random, resolutions, crfs):
+    """
+    :return: (what the probes measure, what the finals really get), both (resolution, crf) -> (vmaf, bitrate),
+    a logistic-ish vmaf falloff and exponential bitrate, lower resolutions top out lower and cost less,
+    the probes are off by measurement noise
+    """
+    complexity = rng.uniform(0.6, 1.8)
+    base_bitrate = rng.uniform(1500, 9000) * complexity
+    falloff = rng.uniform(0.9, 1.6) * complexity
+    measured, expected = {}, {}
+    for r, res in enumerate(resolutions):
+        width = int(res.split(":")[0])
+        ceiling = 99 - r * rng.uniform(2.5, 5)
+        for crf in crfs:
+            x = (crf - 18) / 40
+            vmaf = ceiling - 60 / (1 + math.exp(-(x * 6 * falloff - 3.5)))
+            bitrate = base_bitrate * (width / 1920) ** 1.6 * math.exp(-x * 4.2)
+            expected[(res, crf)] = (vmaf, bitrate)
+            measured[(res, crf)] = (
+                vmaf + rng.gauss(0, 0.25),
+                bitrate * rng.uniform(0.97, 1.03),
+            )
+    return measured, expected
+
+
+def get_table(chunks, lengths, resolutions, crfs) -> CandidateTable:
+    """
+    :param chunks: per chunk (resolution, crf) -> (vmaf, bitrate), whatever got encoded
+    """
+    candidates = {}
+    for c, results in enumerate(chunks):
+        for (res, crf), (vmaf, bitrate) in results.items():
+            candidates[f"{c}_{res.split(':')[0]}_{crf}"] = {
+                "vmaf": vmaf,
+                "bitrate": bitrate,
+            }
+    return CandidateTable(
+        candidates=candidates,
+        chunk_indexes=list(range(len(chunks))),
+        lengths=lengths,
+        resolutions=[r.split(":")[0] for r in resolutions],
+        crfs=crfs,
+    )
+
+
+def get_ladder(chunks, lengths, resolutions, crfs, targets):
+    """
+    :return: (best resolution per rung, picks [rung, resolution, chunk], the solution)
+    """
+    table = get_table(chunks, lengths, resolutions, crfs)
+    table.fill_gaps()
+    solution = solve_min_bits(table, targets)
+    return get_best_resolutions(table, solution), solution["picks"], solution
+
+
+def main():
+    titles = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    chunks_per_title = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    rng = random.Random(7)
+    resolutions = convexhull_get_resolutions(Codec.av1)
+    crf_low, crf_high = convexhull_get_crf_range(Codec.av1)
+    grid = list(range(crf_low, crf_high, 2))
+    targets = get_vmaf_list(Codec.av1)
+
+    exhaustive_encodes = adaptive_encodes = 0
+    same_resolution = rungs = close_rungs = close_same = 0
+    same_crf = chunk_picks = 0
+    extra_bitrate, vmaf_drift, refine_rounds = [], [], []
+    for _ in range(titles):
+        chunks = [make_chunk(rng, resolutions, grid) for _ in range(chunks_per_title)]
+        measured = [results for results, _ in chunks]
+        lengths = [rng.uniform(1, 10) for _ in range(chunks_per_title)]
+        # the finals are encoded again at the picked crfs, the probes' noise doesn't carry over
+        table = get_table(
+            [expected for _, expected in chunks], lengths, resolutions, grid
+        )
+
+        # the coarse grid per chunk, then refined around the title's picks like MutliResTrellis does
+        sampler = AdaptiveRdSampler(grid=grid, resolutions=resolutions)
+        sampled = [
+            {key: results[key] for key in sampler.get_coarse()} for results in measured
+        ]
+        for refine_round in range(MAX_REFINE_ROUNDS + 1):
+            adaptive_table = get_table(sampled, lengths, resolutions, grid)
+            adaptive_table.fill_gaps()
+            wanted = sampler.get_refinement(
+                adaptive_table, solve_min_bits(adaptive_table, targets)
+            )
+            if len(wanted) == 0 or refine_round == MAX_REFINE_ROUNDS:
+                break
+            for c, encodes in wanted.items():
+                for key in encodes:
+                    sampled[c][key] = measured[c][key]
+        refine_rounds.append(refine_round)
+        exhaustive_encodes += sum([len(results) for results in measured])
+        adaptive_encodes += sum([len(encoded) for encoded in sampled])
+
+        exhaustive_best, exhaustive_picks, solution = get_ladder(
+            measured, lengths, resolutions, grid, targets
+        )
+        adaptive_best, adaptive_picks, _ = get_ladder(
+            sampled, lengths, resolutions, grid, targets
+        )
+
+        for t in range(len(targets)):
+            rungs += 1
+            r, a = exhaustive_best[t], adaptive_best[t]
+            # what the finals of the adaptive ladder's rung cost and score against the exhaustive one's
+            truth_picks = np.zeros((1,) + table.bits.shape[:2], dtype=int)
+            truth_picks[0, r] = exhaustive_picks[t, r]
+            adaptive_rung = np.zeros_like(truth_picks)
+            adaptive_rung[0, a] = adaptive_picks[t, a]
+            extra_bitrate.append(
+                table.average_bitrate(adaptive_rung)[0, a]
+                / table.average_bitrate(truth_picks)[0, r]
+                - 1
+            )
+            vmaf_drift.append(
+                table.pooled_vmaf(adaptive_rung)[0, a]
+                - table.pooled_vmaf(truth_picks)[0, r]
+            )
+
+            # two resolutions within a percent of each other are a coin toss on the measurement noise
+            feasible = np.where(solution["feasible"][t])[0]
+            runner_up = sorted(solution["bitrate"][t, feasible])[1:2]
+            if len(runner_up) > 0 and runner_up[0] < solution["bitrate"][t, r] * 1.01:
+                close_rungs += 1
+                close_same += int(a == r)
+                continue
+            if a != r:
+                continue
+            same_resolution += 1
+            same_crf += int(np.sum(adaptive_picks[t, r] == exhaustive_picks[t, r]))
+            chunk_picks += chunks_per_title
+
+    print(f"titles: {titles}, chunks per title: {chunks_per_title}")
+    print(
+        f"encodes: exhaustive {exhaustive_encodes}, adaptive {adaptive_encodes} "
+        f"({100 * (1 - adaptive_encodes / exhaustive_encodes):.1f}% fewer), "
+        f"refine rounds per title: mean {np.mean(refine_rounds):.1f}, max {max(refine_rounds)}"
+    )
+    print(
+        f"same resolution picked per rung: {100 * same_resolution / (rungs - close_rungs):.1f}%"
+        f" ({close_rungs} of {rungs} rungs with two resolutions within 1% left out,"
+        f" {100 * (same_resolution + close_same) / rungs:.1f}% counting them)"
+    )
+    if chunk_picks > 0:
+        print(
+            f"same crf picked per chunk for that resolution: {100 * same_crf / chunk_picks:.1f}%"
+        )
+    print(
+        f"bitrate of the adaptive rungs against the exhaustive ones: mean {100 * np.mean(extra_bitrate):+.2f}%,"
+        f" worst {100 * np.max(extra_bitrate):+.2f}%"
+    )
+    print(
+        f"pooled vmaf of the adaptive rungs against the exhaustive ones: mean {np.mean(vmaf_drift):+.2f},"
+        f" worst {np.min(vmaf_drift):+.2f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
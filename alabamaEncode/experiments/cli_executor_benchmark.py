@@ -0,0 +1,82 @@
+"""
+Microbenchmark for run_cli, compares the CPU time we (the parent) spend per MB of child output
+between the buffered record reader and the old byte-by-byte reader.
+Run with `python -m alabamaEncode.experiments.cli_executor_benchmark [megabytes]`
+"""
+
+import subprocess
+import sys
+import time
+
+from alabamaEncode.core.cli_executor import run_cli
+
+# mimics SvtAv1EncApp progress output, one `\r` terminated record per frame
+PROGRESS_LINE = "Encoding frame  1234 12.34 kbps 56.78 fps"
+
+
+def run_cli_legacy(cmd, on_output=None):
+    """
+    The old run_cli implementation, kept here as the baseline
+    """
+    start = time.perf_counter()
+    p = subprocess.Popen(
+        cmd,
+        shell=True,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+
+    output = ""
+    while p.poll() is None:
+        chunk = p.stdout.read(1).decode(errors="ignore")
+        output += chunk
+        if on_output is not None:
+            on_output(chunk)
+
+    p.wait()
+    output += p.stdout.read().decode(errors="ignore")
+    return output, time.perf_counter() - start
+
+
+def get_command(megabytes: int) -> str:
+    return f"yes '{PROGRESS_LINE}' | tr '\\n' '\\r' | head -c {megabytes * 1024 * 1024}"
+
+
+def measure(name, func, megabytes):
+    records = 0
+
+    def on_output(_):
+        nonlocal records
+        records += 1
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    func(get_command(megabytes), on_output)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    print(
+        f"{name:>8}: {cpu / megabytes * 1000:8.2f} ms CPU/MB, "
+        f"wall {wall:6.2f}s, {records} callbacks"
+    )
+    return cpu
+
+
+if __name__ == "__main__":
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+
+    print(f"Streaming {size_mb}MB of encoder-like progress output")
+    legacy = measure("legacy", run_cli_legacy, size_mb)
+    buffered = measure(
+        "buffered",
+        lambda cmd, on_output: run_cli(cmd, on_output=on_output),
+        size_mb,
+    )
+    measure(
+        "ring",
+        lambda cmd, on_output: run_cli(
+            cmd, on_output=on_output, output_limit=64 * 1024
+        ),
+        size_mb,
+    )
+    print(f"buffered reader uses {legacy / max(buffered, 1e-9):.1f}x less CPU")
@@ -10,6 +10,7 @@ from tqdm import tqdm
 from alabamaEncode.encoder.encoder import Encoder
 from alabamaEncode.encoder.rate_dist import EncoderRateDistribution
 from alabamaEncode.encoder.stats import EncodeStats
+from alabamaEncode.metrics.cache import configure_metric_cache
 from alabamaEncode.metrics.impl.vmaf import VmafOptions
 from alabamaEncode.metrics.metric import Metric
 from alabamaEncode.scene.chunk import ChunkObject
@@ -40,6 +41,14 @@ def get_test_files(test_files_count: int = -1):
     return files
 
 
+def configure_test_metric_cache():
+    # METRIC_CACHE env: keep the scores there, re-running an experiment at the same settings skips the scoring
+    return configure_metric_cache(
+        os.environ.get("METRIC_CACHE", ""),
+        budget_bytes=int(os.environ.get("METRIC_CACHE_BUDGET_MB", 1024)) * 1024 * 1024,
+    )
+
+
 def get_test_env() -> str:
     pwd = os.getcwd()
     date = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -61,17 +70,21 @@ def run_test(
     output_path = f"{test_env}{basename}_{version}{enc.get_chunk_file_extension()}"
 
     threads = os.cpu_count()
+    configure_test_metric_cache()
 
     # set the input and output input_path
     enc.chunk = ChunkObject(path=input_file)
     enc.output_path = output_path
     enc.threads = threads
+    # one decode of the encode and the source for all three
     stats = enc.run(
         override_if_exists=False,
-        metric_to_calculate=Metric.VMAF,
-        calcualte_ssim=True,
+        metric_to_calculate=[Metric.VMAF, Metric.PSNR, Metric.SSIM],
         metric_params=VmafOptions(neg=True, threads=threads),
     )
+    # the reports' ssim column is libvmaf's luma only float_ssim, not ffmpeg's all plane one
+    stats.ssim = stats.metrics[Metric.SSIM].mean
+    stats.ssim_db = stats.metrics[Metric.SSIM].mean_db
     stats.version = version
     stats.basename = basename
     return stats
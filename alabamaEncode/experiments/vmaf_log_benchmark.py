@@ -0,0 +1,166 @@
+"""
+Benchmark of the vmaf log ingest, the old json.load + per frame dicts + python loops against the streaming
+float32 readers, on a synthetic libvmaf log of a feature length encode.
+Run with `python -m alabamaEncode.experiments.vmaf_log_benchmark [frames]`
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from alabamaEncode.metrics.impl.vmaf_log import read_vmaf_log, get_score_statistics
+
+# the features libvmaf 2.x logs next to the score with the default model
+FEATURES = [
+    "integer_motion2",
+    "integer_motion",
+    "integer_adm2",
+    "integer_adm_scale0",
+    "integer_adm_scale1",
+    "integer_adm_scale2",
+    "integer_adm_scale3",
+    "integer_vif_scale0",
+    "integer_vif_scale1",
+    "integer_vif_scale2",
+    "integer_vif_scale3",
+]
+
+
+def legacy_statistics(path: str) -> dict:
+    """
+    The old VmafResult json path, kept here as the baseline
+    """
+    log_decoded = json.load(open(path))
+    frames = []
+    for frame in log_decoded["frames"]:
+        frames.append([frame["frameNum"], frame["metrics"]["vmaf"]])
+    frames.sort(key=lambda x: x[0])
+    vmaf_scores = [x[1] for x in frames]
+    vmaf_scores.sort()
+    result = {
+        "percentile_1": vmaf_scores[int(len(vmaf_scores) * 0.01)],
+        "percentile_5": vmaf_scores[int(len(vmaf_scores) * 0.05)],
+        "mean": log_decoded["pooled_metrics"]["vmaf"]["mean"],
+        "harmonic_mean": log_decoded["pooled_metrics"]["vmaf"]["harmonic_mean"],
+        "max": max([x[1] for x in frames]),
+        "min": min([x[1] for x in frames]),
+    }
+    std_dev = 0
+    for frame in frames:
+        std_dev += (frame[1] - result["mean"]) ** 2
+    result["std_dev"] = (std_dev / len(frames)) ** 0.5
+    return result
+
+
+def write_logs(folder: str, frames: int) -> dict:
+    rng = np.random.default_rng(0)
+    scores = np.clip(rng.normal(93, 4, frames), 0, 100).round(6)
+    features = rng.random((frames, len(FEATURES))).round(6)
+    pooled = {
+        "min": float(scores.min()),
+        "max": float(scores.max()),
+        "mean": float(scores.mean()),
+        "harmonic_mean": float(frames / np.sum(1 / (scores + 1)) - 1),
+    }
+
+    paths = {}
+    paths["json"] = os.path.join(folder, "log.json")
+    with open(paths["json"], "w") as f:
+        json.dump(
+            {
+                "version": "3.0.0",
+                "fps": 24.0,
+                "frames": [
+                    {
+                        "frameNum": i,
+                        "metrics": {
+                            **dict(zip(FEATURES, features[i].tolist())),
+                            "vmaf": float(scores[i]),
+                        },
+                    }
+                    for i in range(frames)
+                ],
+                "pooled_metrics": {"vmaf": pooled},
+            },
+            f,
+            indent=4,
+        )
+
+    paths["xml"] = os.path.join(folder, "log.xml")
+    with open(paths["xml"], "w") as f:
+        f.write('<VMAF version="3.0.0">\n  <fyi fps="24.00" />\n  <frames>\n')
+        for i in range(frames):
+            attributes = " ".join(
+                [f'{n}="{v:.6f}"' for n, v in zip(FEATURES, features[i])]
+            )
+            f.write(
+                f'    <frame frameNum="{i}" {attributes} vmaf="{scores[i]:.6f}" />\n'
+            )
+        f.write("  </frames>\n  <pooled_metrics>\n")
+        f.write(
+            '    <metric name="vmaf" '
+            + " ".join([f'{k}="{v:.6f}"' for k, v in pooled.items()])
+            + " />\n"
+        )
+        f.write("  </pooled_metrics>\n</VMAF>\n")
+
+    paths["csv"] = os.path.join(folder, "log.csv")
+    with open(paths["csv"], "w") as f:
+        f.write("Frame," + ",".join(FEATURES) + ",vmaf,\n")
+        for i in range(frames):
+            f.write(
+                f"{i},"
+                + ",".join([f"{v:.6f}" for v in features[i]])
+                + f",{scores[i]:.6f},\n"
+            )
+    return paths
+
+
+def new_statistics(path: str) -> dict:
+    log = read_vmaf_log(path)
+    pooled = log.pooled_metrics["vmaf"]
+    statistics = get_score_statistics(log.scores, mean=pooled["mean"])
+    statistics["harmonic_mean"] = pooled["harmonic_mean"]
+    return statistics
+
+
+def measure(name, func, path) -> dict:
+    start = time.perf_counter()
+    result = func(path)
+    took = time.perf_counter() - start
+    # a second run for the memory, tracemalloc slows allocations down too much to time under it
+    tracemalloc.start()
+    func(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:>12}: {took:6.2f}s, peak {peak / 1024 / 1024:7.1f} MB,"
+        f" log {os.path.getsize(path) / 1024 / 1024:6.1f} MB"
+    )
+    return result
+
+
+if __name__ == "__main__":
+    frame_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    with tempfile.TemporaryDirectory() as temp_dir:
+        print(f"Writing {frame_count} frame logs")
+        log_paths = write_logs(temp_dir, frame_count)
+        baseline = measure("legacy json", legacy_statistics, log_paths["json"])
+        for log_format in ["json", "xml", "csv"]:
+            statistics = measure(
+                f"numpy {log_format}", new_statistics, log_paths[log_format]
+            )
+            for key in baseline:
+                # float32 storage, scores agree to ~1e-5
+                assert abs(statistics[key] - baseline[key]) < 1e-3, (
+                    log_format,
+                    key,
+                    statistics[key],
+                    baseline[key],
+                )
+        print("Statistics of every format match the baseline")
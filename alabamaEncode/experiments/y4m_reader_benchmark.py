@@ -0,0 +1,110 @@
+"""
+Throughput of the y4m reader against the old bytes slicing one, on a synthetic 4k 4:2:0 stream read from a pipe.
+Run with `python -m alabamaEncode.experiments.y4m_reader_benchmark [frames]`
+"""
+
+import shlex
+import subprocess
+import sys
+import time
+
+from alabamaEncode.ffmpeg_source.yuv import Reader
+
+WIDTH, HEIGHT = 3840, 2160
+
+
+class LegacyReader:
+    """
+    The old push based reader (8 bit frame sizes only), kept here as the baseline
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._stream_headers = None
+        self._data = bytes()
+        self._count = 0
+
+    def decode(self, data):
+        self._data += data
+        if self._stream_headers is None:
+            toks = self._data.split(b"\n", 1)
+            if len(toks) == 1:
+                return
+            self._stream_headers = {"W": WIDTH, "H": HEIGHT}
+            self._data = toks[1]
+        while True:
+            size = self._stream_headers["W"] * self._stream_headers["H"] * 3 // 2
+            if len(self._data) < size:
+                return
+            toks = self._data.split(b"\n", 1)
+            if len(toks) == 1 or len(toks[1]) < size:
+                return
+            yuv = toks[1][0:size]
+            self._data = toks[1][size:]
+            self._count += 1
+            self._callback(yuv)
+
+
+def get_command(frames: int, colorspace: str, bytes_per_sample: int) -> str:
+    frame_size = WIDTH * HEIGHT * 3 // 2 * bytes_per_sample
+    script = (
+        "import sys\n"
+        "o = sys.stdout.buffer\n"
+        f"o.write(b'YUV4MPEG2 W{WIDTH} H{HEIGHT} F24:1 Ip C{colorspace}\\n')\n"
+        f"payload = b'FRAME\\n' + bytes({frame_size})\n"
+        f"for _ in range({frames}):\n"
+        "    o.write(payload)\n"
+    )
+    return f"{sys.executable} -c {shlex.quote(script)}"
+
+
+def run_legacy(frames: int) -> float:
+    p = subprocess.Popen(
+        get_command(frames, "420", 1), shell=True, stdout=subprocess.PIPE
+    )
+    count = 0
+
+    def callback(_):
+        nonlocal count
+        count += 1
+
+    reader = LegacyReader(callback)
+    start = time.perf_counter()
+    while True:
+        data = p.stdout.read(1024 * 1024)
+        if not data:
+            break
+        reader.decode(data)
+    took = time.perf_counter() - start
+    p.wait()
+    assert count == frames
+    return took
+
+
+def run_new(frames: int, colorspace: str, bytes_per_sample: int) -> float:
+    p = subprocess.Popen(
+        get_command(frames, colorspace, bytes_per_sample),
+        shell=True,
+        stdout=subprocess.PIPE,
+    )
+    start = time.perf_counter()
+    count = 0
+    for frame in Reader(p.stdout):
+        # touch the planes like an analysis would
+        frame.y[0, 0], frame.u[0, 0], frame.v[0, 0]
+        count += 1
+    took = time.perf_counter() - start
+    p.wait()
+    assert count == frames
+    return took
+
+
+if __name__ == "__main__":
+    frame_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"{frame_count} frames of {WIDTH}x{HEIGHT} 4:2:0")
+    legacy = run_legacy(frame_count)
+    print(f"  legacy 8 bit: {frame_count / legacy:7.1f} fps")
+    new = run_new(frame_count, "420", 1)
+    print(f"     new 8 bit: {frame_count / new:7.1f} fps")
+    new_10 = run_new(frame_count, "420p10", 2)
+    print(f"    new 10 bit: {frame_count / new_10:7.1f} fps")
@@ -11,18 +11,32 @@ class AbortControler:
     def abort(self):
         self.aborted = True
 
-def get_yuv_frame_stream(chunk: ChunkObject, frame_callback, vf: str= "", abort_controler: AbortControler = None):
-    command = chunk.create_chunk_ffmpeg_pipe_command(video_filters=vf, bit_depth=8)
 
-    ffmpeg_process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-
-    yuv_reader = Reader(frame_callback)
-
-    while ffmpeg_process.poll() is None:
-        if abort_controler:
-            if abort_controler.aborted:
+def get_yuv_frame_stream(
+    chunk: ChunkObject,
+    frame_callback,
+    vf: str = "",
+    abort_controler: AbortControler = None,
+    bit_depth: int = 8,
+):
+    """
+    Call frame_callback with every decoded `Frame` of the chunk, its planes are uint16 when bit_depth > 8
+    """
+    command = chunk.create_chunk_ffmpeg_pipe_command(
+        video_filters=vf, bit_depth=bit_depth
+    )
+
+    ffmpeg_process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, shell=True
+    )
+
+    try:
+        for frame in Reader(ffmpeg_process.stdout):
+            if abort_controler and abort_controler.aborted:
                 break
-        data = ffmpeg_process.stdout.read(1024 * 1024)
-        if data:
-            yuv_reader.decode(data)
-
+            frame_callback(frame)
+    finally:
+        if ffmpeg_process.poll() is None:
+            ffmpeg_process.kill()
+        ffmpeg_process.stdout.close()
+        ffmpeg_process.wait()
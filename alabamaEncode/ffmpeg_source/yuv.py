@@ -1,84 +1,184 @@
-from collections import namedtuple
+"""
+y4m reader that reads every frame straight into preallocated buffers and hands out numpy views of the planes,
+nothing gets copied or allocated per frame, 8 and 10/12/16 bit 4:2:0, 4:2:2, 4:4:4 and mono
+"""
 
-# https://github.com/ticapix/python-y4m
+from typing import BinaryIO, Dict, List, Tuple, Optional
+
+import numpy as np
+
+__all__ = ["Y4mHeader", "Frame", "Reader"]
+
+
+class Y4mHeader:
+    """
+    The stream header, `headers` keeps every field like the old reader did: W/H ints, F/A as [num, den]
+    """
+
+    def __init__(self, line: bytes):
+        fields = line.strip().split(b" ")
+        if fields[0] != b"YUV4MPEG2":
+            raise ValueError(f"Not a y4m stream, starts with {fields[0]!r}")
+        self.headers: Dict[str, object] = {}
+        for field in fields[1:]:
+            field = field.decode("ascii")
+            if field != "":
+                self.headers[field[0]] = field[1:]
+        for key in ["W", "H", "F"]:
+            if key not in self.headers:
+                raise ValueError(f"y4m header without {key}")
+        self.headers["W"] = int(self.headers["W"])
+        self.headers["H"] = int(self.headers["H"])
+        self.headers["F"] = [int(n) for n in self.headers["F"].split(":")]
+        if "A" in self.headers:
+            self.headers["A"] = [int(n) for n in self.headers["A"].split(":")]
+        if "C" not in self.headers:
+            self.headers["C"] = "420jpeg"  # man yuv4mpeg
+
+        self.width: int = self.headers["W"]
+        self.height: int = self.headers["H"]
+        self.colorspace: str = self.headers["C"]
+        self.chroma, self.bit_depth = self._parse_colorspace(self.colorspace)
+        self.dtype = np.dtype(np.uint8 if self.bit_depth == 8 else "<u2")
+
+    @staticmethod
+    def _parse_colorspace(colorspace: str) -> Tuple[str, int]:
+        """
+        :return: (420, 422, 444 or mono, bit depth), e.g. 420p10 -> (420, 10), 420jpeg -> (420, 8)
+        """
+        for chroma in ["420", "422", "444"]:
+            if colorspace.startswith(chroma):
+                rest = colorspace[len(chroma) :]
+                if rest.startswith("p") and rest[1:].isdigit():
+                    return chroma, int(rest[1:])
+                # 420jpeg, 420mpeg2, 420paldv are all 8 bit with different chroma siting
+                return chroma, 8
+        if colorspace.startswith("mono"):
+            rest = colorspace[len("mono") :]
+            return "mono", int(rest) if rest.isdigit() else 8
+        raise ValueError(f"Unsupported y4m colorspace {colorspace}")
+
+    def get_plane_shapes(self) -> List[Tuple[int, int]]:
+        """
+        :return: (rows, columns) of Y, U and V, just Y for mono
+        """
+        luma = (self.height, self.width)
+        if self.chroma == "mono":
+            return [luma]
+        if self.chroma == "420":
+            chroma = ((self.height + 1) // 2, (self.width + 1) // 2)
+        elif self.chroma == "422":
+            chroma = (self.height, (self.width + 1) // 2)
+        else:
+            chroma = luma
+        return [luma, chroma, chroma]
+
+    def get_frame_size(self) -> int:
+        """
+        :return: bytes of a frame's payload
+        """
+        samples = sum([rows * columns for rows, columns in self.get_plane_shapes()])
+        return samples * self.dtype.itemsize
+
+    def get_frame_rate(self) -> float:
+        return self.headers["F"][0] / self.headers["F"][1]
+
+
+class Frame:
+    """
+    A frame backed by one of the reader's buffers, the data is overwritten once the reader comes back around
+    to the same buffer, copy whatever has to outlive that
+    """
+
+    def __init__(self, buffer: memoryview, planes: List[np.ndarray], header: Y4mHeader):
+        self.buffer = buffer  # the raw payload, Y then U then V
+        self.planes = planes
+        self.headers = header.headers
+        self.count = -1
+
+    @property
+    def y(self) -> np.ndarray:
+        return self.planes[0]
+
+    @property
+    def u(self) -> Optional[np.ndarray]:
+        return self.planes[1] if len(self.planes) > 1 else None
+
+    @property
+    def v(self) -> Optional[np.ndarray]:
+        return self.planes[2] if len(self.planes) > 2 else None
 
-class Frame(namedtuple('Frame', ['buffer', 'headers', 'count'])):
     def __repr__(self):
-        return '<frame %d: %dx%d>' % (self.count, self.headers['H'], self.headers['W'])
+        return "<frame %d: %dx%d>" % (self.count, self.headers["W"], self.headers["H"])
+
+
+class Reader:
+    """
+    Iterate the frames of a y4m stream, e.g. a `-f yuv4mpegpipe -` ffmpeg's stdout.
+    The stream is read with `readinto` into `buffer_count` preallocated frame buffers used round robin,
+    so the last `buffer_count` frames stay valid at a time.
+    """
+
+    FRAME_MAGIC = b"FRAME\n"
+
+    def __init__(self, stream: BinaryIO, buffer_count: int = 2):
+        self._stream = stream
+        self.header = Y4mHeader(stream.readline())
+        frame_size = self.header.get_frame_size()
 
-class Reader(object):
-    def __init__(self, callback, verbose=False):
-        self._callback = callback
-        self._stream_headers = None
-        self._data = bytes()
+        self._frames: List[Frame] = []
+        for _ in range(max(buffer_count, 1)):
+            data = bytearray(frame_size)
+            planes = []
+            offset = 0
+            for rows, columns in self.header.get_plane_shapes():
+                count = rows * columns
+                planes.append(
+                    np.frombuffer(
+                        data, dtype=self.header.dtype, count=count, offset=offset
+                    ).reshape(rows, columns)
+                )
+                offset += count * self.header.dtype.itemsize
+            self._frames.append(Frame(memoryview(data), planes, self.header))
+        self._magic = bytearray(len(self.FRAME_MAGIC))
         self._count = 0
-        self._verbose = verbose
-
-    def _print(self, *args):
-        if self._verbose:
-            print('Y4M Reader:', ' '.join([str(e) for e in args]))
-
-    def decode(self, data):
-        assert isinstance(data, bytes)
-        self._data += data
-        if self._stream_headers is None:
-            self._decode_stream_headers()
-            if self._stream_headers is not None:
-                self._print('detected stream with headers:', self._stream_headers)
-        if self._stream_headers is not None:
-            frame = self._decode_frame()
-            while frame is not None:
-                self._print(frame, 'decoded')
-                self._callback(frame)
-                frame = self._decode_frame()
-
-    def _frame_size(self):
-        if self._stream_headers['C'].startswith('420'):
-            return self._stream_headers['W'] * self._stream_headers['H'] * 3 // 2
-        elif self._stream_headers['C'].startswith('422'):
-            return self._stream_headers['W'] * self._stream_headers['H'] * 2
-        elif self._stream_headers['C'].startswith('444'):
-            return self._stream_headers['W'] * self._stream_headers['H'] * 3
-        raise f"only support I420, I422, I444 fourcc (not {self._stream_headers['C']})"
-
-    def _decode_frame(self):
-        if len(self._data) < self._frame_size():  # no point trying to parse
-            return None
-        toks = self._data.split(b'\n', 1)
-        if len(toks) == 1:  # need more data
-            self._print('weird: got plenty of data but no frame header found')
-            return None
-        headers = toks[0].split(b' ')
-        # assert headers[0] == b'FRAME', 'expected FRAME (got %r)' % headers[0]
-        frame_headers = self._stream_headers.copy()
-        for header in headers[1:]:
-            header = header.decode('ascii')
-            frame_headers[header[0]] = header[1:]
-        if len(toks[1]) < self._frame_size():  # need more data
+
+    def _read_fully(self, view: memoryview) -> int:
+        read = 0
+        while read < len(view):
+            n = self._stream.readinto(view[read:])
+            if not n:
+                break
+            read += n
+        return read
+
+    def read_frame(self) -> Optional[Frame]:
+        """
+        :return: the next frame, None at the end of the stream
+        """
+        magic = memoryview(self._magic)
+        read = self._read_fully(magic)
+        if read == 0:
             return None
-        yuv = toks[1][0:self._frame_size()]
-        self._data = toks[1][self._frame_size():]
+        if read < len(magic) or not self._magic.startswith(b"FRAME"):
+            raise ValueError(
+                f"Expected a y4m frame header, got {bytes(magic[:read])!r}"
+            )
+        if self._magic != self.FRAME_MAGIC:
+            # frame parameters, rare and ignored, skip to the end of the line
+            if self._magic[-1:] != b"\n":
+                self._stream.readline()
+
+        frame = self._frames[self._count % len(self._frames)]
+        if self._read_fully(frame.buffer) < len(frame.buffer):
+            raise ValueError(f"Truncated y4m frame {self._count}")
+        frame.count = self._count
         self._count += 1
-        return Frame(yuv, frame_headers, self._count - 1)
-
-    def _decode_stream_headers(self):
-        toks = self._data.split(b'\n', 1)
-        if len(toks) == 1:  # buffer all header data until eof
-            return
-        self._stream_headers = {}
-        self._data = toks[1]  # save the beginning of the stream for later
-        headers = toks[0].split(b' ')
-        assert headers[0] == b'YUV4MPEG2', 'unknown type %s' % headers[0]
-        for header in headers[1:]:
-            header = header.decode('ascii')
-            self._stream_headers[header[0]] = header[1:]
-        assert 'W' in self._stream_headers, 'No width header'
-        assert 'H' in self._stream_headers, 'No height header'
-        assert 'F' in self._stream_headers, 'No frame-rate header'
-        self._stream_headers['W'] = int(self._stream_headers['W'])
-        self._stream_headers['H'] = int(self._stream_headers['H'])
-        self._stream_headers['F'] = [int(n) for n in self._stream_headers['F'].split(':')]
-        if 'A' in self._stream_headers:
-            self._stream_headers['A'] = [int(n) for n in self._stream_headers['A'].split(':')]
-        if 'C' not in self._stream_headers:
-            self._stream_headers['C'] = '420jpeg'  # man yuv4mpeg
+        return frame
+
+    def __iter__(self):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
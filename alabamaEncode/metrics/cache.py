@@ -0,0 +1,332 @@
+"""
+Persistent cache of metric results, keyed by what the score depends on: the distorted file's content,
+the reference (source, frame range, filters) and the metric's options. Resumes, integrity re-runs and experiments
+that re-encode at the same settings get the stored result back instead of decoding and scoring again
+"""
+
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import pickle
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Any, Tuple
+
+from alabamaEncode.core.intermediate_cache import normalize_filters
+from alabamaEncode.metrics.options import MetricOptions
+
+__all__ = [
+    "MetricCache",
+    "configure_metric_cache",
+    "get_metric_cache",
+    "get_chunk_descriptor",
+    "get_file_descriptor",
+    "lookup_chunk_result_async",
+    "store_result_async",
+]
+
+# bump when a result class or the key changes shape, old entries then just miss
+CACHE_VERSION = 1
+# files up to this size are hashed whole, bigger ones by HASH_SAMPLES evenly spaced blocks + the size
+HASH_WHOLE_FILE_BYTES = 16 * 1024 * 1024
+HASH_SAMPLES = 64
+HASH_SAMPLE_BYTES = 64 * 1024
+# options that change how a metric runs but not what it scores
+IGNORED_OPTIONS = {"threads", "reference_y4m", "filtered_reference_y4m"}
+
+
+def get_file_hash(path: str) -> str:
+    """
+    A fast content hash, whole files for typical chunks, evenly spaced blocks of bigger ones
+    """
+    st = os.stat(path)
+    return _get_file_hash(os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=256)
+def _get_file_hash(path: str, size: int, mtime_ns: int) -> str:
+    # size & mtime are part of the lru key, a re-encode in place hashes again
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str(size).encode())
+    with open(path, "rb") as f:
+        if size <= HASH_WHOLE_FILE_BYTES:
+            while True:
+                block = f.read(1024 * 1024)
+                if not block:
+                    break
+                h.update(block)
+        else:
+            step = (size - HASH_SAMPLE_BYTES) // (HASH_SAMPLES - 1)
+            for i in range(HASH_SAMPLES):
+                f.seek(i * step)
+                h.update(f.read(HASH_SAMPLE_BYTES))
+    return h.hexdigest()
+
+
+def get_options_descriptor(options: Optional[MetricOptions]) -> dict:
+    """
+    Every option of a MetricOptions (subclass) that matters to the score, class defaults included
+    """
+    if options is None:
+        return {}
+    fields = {}
+    for cls in reversed(type(options).__mro__):
+        for k, v in vars(cls).items():
+            if (
+                not k.startswith("_")
+                and not callable(v)
+                and not isinstance(v, (staticmethod, classmethod, property))
+            ):
+                fields[k] = v
+    fields.update(vars(options))
+    descriptor = {"class": type(options).__name__}
+    for k, v in sorted(fields.items()):
+        if k in IGNORED_OPTIONS:
+            continue
+        if k == "video_filters":
+            v = normalize_filters(v)
+        descriptor[k] = v if v is None or isinstance(v, (bool, int, float)) else str(v)
+    return descriptor
+
+
+def get_file_descriptor(path: str) -> list:
+    st = os.stat(path)
+    return [os.path.realpath(path), st.st_size, st.st_mtime_ns]
+
+
+def get_chunk_descriptor(chunk, video_filters: str = "") -> list:
+    """
+    What the reference frames of a chunk are made of: the source, the frame range and the filter chain
+    """
+    end = chunk.last_frame_index
+    if chunk.end_override != -1 and chunk.length > chunk.end_override:
+        end = chunk.first_frame_index + chunk.end_override
+    return get_file_descriptor(chunk.path) + [
+        chunk.first_frame_index,
+        end,
+        normalize_filters(video_filters),
+    ]
+
+
+class MetricCache:
+    """
+    A folder of pickled results with a byte budget and LRU eviction, one file per key.
+    Workers in other processes may share the folder, entries are written to a temp file and renamed into place.
+    """
+
+    def __init__(self, folder: str, budget_bytes: int):
+        self.folder = folder
+        self.budget_bytes = budget_bytes
+        self.extension = ".pkl"
+
+        self._lock = Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # key -> size
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # wall/cpu time the hits took to compute originally, i.e. the decoding and scoring that got skipped
+        self.seconds_saved = 0.0
+        self.cpu_seconds_saved = 0.0
+
+        os.makedirs(self.folder, exist_ok=True)
+        # pick up what a previous run left behind, least recently used first so they get evicted first
+        existing = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+            elif name.endswith(self.extension):
+                st = os.stat(path)
+                existing.append((st.st_mtime, name[: -len(self.extension)], st))
+        for _, key, st in sorted(existing):
+            self._entries[key] = st.st_size
+            self._size += st.st_size
+        self._evict()
+
+    @staticmethod
+    def get_key(
+        distorted_path: str, reference: list, metric: str, options: dict
+    ) -> str:
+        """
+        :param reference: the reference descriptor, see `get_chunk_descriptor`/`get_file_descriptor`
+        :param metric: the metric and how it's computed, e.g. "vmaf", "ffmpeg_ssim"
+        :param options: see `get_options_descriptor`
+        """
+        key = [
+            CACHE_VERSION,
+            metric,
+            get_file_hash(distorted_path),
+            reference,
+            options,
+        ]
+        return hashlib.sha1(json.dumps(key, default=str).encode()).hexdigest()
+
+    def get_chunk_key(self, chunk, metric: str, options: MetricOptions = None) -> str:
+        """
+        Key of a metric of `chunk.chunk_path` against the chunk's frames of the source
+        """
+        return self.get_key(
+            chunk.chunk_path,
+            get_chunk_descriptor(
+                chunk, options.video_filters if options is not None else ""
+            ),
+            metric,
+            get_options_descriptor(options),
+        )
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.folder, key + self.extension)
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        :return: the stored result, None on a miss
+        """
+        path = self._get_path(key)
+        entry = None
+        size = 0
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                entry = pickle.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            # not there, or evicted by another process since
+            pass
+        except Exception:
+            # torn or from an incompatible version, score again and overwrite it
+            entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            if key not in self._entries:
+                # put there by another process
+                self._entries[key] = size
+                self._size += size
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.seconds_saved += entry["seconds"]
+            self.cpu_seconds_saved += entry["cpu_seconds"]
+        result = entry["result"]
+        if getattr(result, "resources", None) is not None:
+            # nothing ran for this one
+            result.resources = None
+        return result
+
+    def put(self, key: str, result: Any, seconds: float, cpu_seconds: float = 0):
+        """
+        :param seconds: how long computing the result took, counted as saved on every hit
+        """
+        path = self._get_path(key)
+        temp_path = f"{path}.{os.urandom(4).hex()}.tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump(
+                {"result": result, "seconds": seconds, "cpu_seconds": cpu_seconds},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)
+            self._entries[key] = size
+            self._size += size
+            self._evict()
+
+    def _drop(self, key: str):
+        self._size -= self._entries.pop(key)
+        path = self._get_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _evict(self):
+        while self._size > self.budget_bytes and len(self._entries) > 0:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.seconds_saved = 0.0
+            self.cpu_seconds_saved = 0.0
+
+    def get_hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+    def dict(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.get_hit_rate(), 3),
+            "evictions": self.evictions,
+            "seconds_saved": round(self.seconds_saved, 2),
+            "cpu_seconds_saved": round(self.cpu_seconds_saved, 2),
+            "size": self._size,
+            "budget": self.budget_bytes,
+        }
+
+
+_active_cache: Optional[MetricCache] = None
+_active_cache_lock = Lock()
+
+
+def configure_metric_cache(folder: str, budget_bytes: int) -> Optional[MetricCache]:
+    """
+    Set the process-wide metric cache, calling it again with the same settings is a no-op,
+    so every worker can call it with its ctx
+    :param folder: where to keep the results, "" to turn the cache off
+    """
+    global _active_cache
+    with _active_cache_lock:
+        if folder == "":
+            _active_cache = None
+        elif (
+            _active_cache is None
+            or _active_cache.folder != folder
+            or _active_cache.budget_bytes != budget_bytes
+        ):
+            _active_cache = MetricCache(folder, budget_bytes)
+        return _active_cache
+
+
+def get_metric_cache() -> Optional[MetricCache]:
+    return _active_cache
+
+
+async def lookup_chunk_result_async(
+    chunk, metric: str, options: MetricOptions = None
+) -> Tuple[Optional[str], Optional[Any]]:
+    """
+    :return: (key to `store_result_async` the result under, the cached result or None), (None, None) with no cache
+    """
+    metric_cache = get_metric_cache()
+    if metric_cache is None:
+        return None, None
+    key = await asyncio.to_thread(metric_cache.get_chunk_key, chunk, metric, options)
+    return key, await asyncio.to_thread(metric_cache.get, key)
+
+
+async def store_result_async(
+    key: Optional[str], result: Any, seconds: float, cpu_seconds: float = None
+):
+    """
+    :param seconds: how long the calculation took
+    :param cpu_seconds: cpu time it took, the result's resources if not given
+    """
+    metric_cache = get_metric_cache()
+    if metric_cache is None or key is None:
+        return
+    if cpu_seconds is None:
+        resources = getattr(result, "resources", None)
+        cpu_seconds = resources.cpu_time if resources is not None else 0
+    await asyncio.to_thread(metric_cache.put, key, result, seconds, cpu_seconds)
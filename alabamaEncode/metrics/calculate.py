@@ -1,16 +1,28 @@
+import copy
 import os
 import re
+import shlex
+from typing import Tuple, Callable, List
 
 from alabamaEncode.core.bin_utils import get_binary
-from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.core.cli_executor import run_cli, run_sync
+from alabamaEncode.core.intermediate_cache import get_intermediate_cache
 from alabamaEncode.core.path import PathAlabama
 from alabamaEncode.encoder.stats import EncodeStats
 from alabamaEncode.metrics.impl.ssimu2 import Ssimu2Options
 from alabamaEncode.metrics.impl.vmaf import VmafOptions
 from alabamaEncode.metrics.metric import Metric
 from alabamaEncode.metrics.options import MetricOptions
+from alabamaEncode.metrics.subsample import get_select_filter
 from alabamaEncode.scene.chunk import ChunkObject
 
+# a subsampled probe gets rescored until its 95% interval is at most this wide (each side)
+PROBE_TARGET_CONFIDENCE = 0.2
+# ..as long as the target is within this many interval half widths of the score
+PROBE_REFINE_DISTANCE = 2
+# density increase per rescore
+PROBE_REFINE_STEP = 4
+
 
 def calculate_metric(
     options=None,
@@ -18,6 +30,24 @@ def calculate_metric(
     reference_path: PathAlabama = None,
     chunk: ChunkObject = None,
     metric: Metric = Metric.VMAF,
+):
+    return run_sync(
+        calculate_metric_async(
+            options=options,
+            distorted_path=distorted_path,
+            reference_path=reference_path,
+            chunk=chunk,
+            metric=metric,
+        )
+    )
+
+
+async def calculate_metric_async(
+    options=None,
+    distorted_path: PathAlabama = None,
+    reference_path: PathAlabama = None,
+    chunk: ChunkObject = None,
+    metric: Metric = Metric.VMAF,
 ):
     if chunk is None:
         _chunk = ChunkObject()
@@ -32,44 +62,53 @@ def calculate_metric(
 
     match metric:
         case Metric.VMAF:
-            from alabamaEncode.metrics.impl.vmaf import calc_vmaf
+            from alabamaEncode.metrics.impl.vmaf import calc_vmaf_async
 
-            return calc_vmaf(
+            return await calc_vmaf_async(
                 chunk=_chunk,
                 vmaf_options=options if options is not None else VmafOptions(),
             )
         case Metric.SSIMULACRA2:
-            from alabamaEncode.metrics.impl.ssimu2 import calc_ssimu2
+            from alabamaEncode.metrics.impl.ssimu2 import calc_ssimu2_async
 
-            return calc_ssimu2(
+            return await calc_ssimu2_async(
                 chunk=_chunk,
                 ssimu2_options=options if options is not None else Ssimu2Options(),
             )
+        case Metric.PSNR | Metric.SSIM | Metric.CAMBI:
+            from alabamaEncode.metrics.multi_metric import calculate_metrics_async
+
+            results = await calculate_metrics_async(
+                chunk=_chunk, metrics=[metric], options=options
+            )
+            result = results[metric]
+            result.resources = results.resources
+            return result
         case _:
-            raise NotImplementedError(f"Metric {metric} not implemented")
+            raise ValueError(f"Metric {metric} not implemented")
 
 
 def cleanup_input_pipes(output: dict):
-    if os.path.exists(output["ref_pipe"]):
-        os.remove(output["ref_pipe"])
-    if os.path.exists(output["dist_pipe"]):
-        os.remove(output["dist_pipe"])
+    for pipe in output["ref_pipes"] + output["dist_pipes"]:
+        if os.path.exists(pipe):
+            os.remove(pipe)
 
 
-def get_input_pipes(chunk: ChunkObject, options: MetricOptions) -> dict:
+def get_pipe_redirect(pipes: List[str]) -> str:
     """
-    Create two named pipes that will output distorted and reference yuv frames,
-    return the pipe paths and the commands that will feed them
+    :return: the end of a command that feeds its stdout to every pipe, through a tee if there's more than one
     """
+    if len(pipes) == 1:
+        return f" > {pipes[0]}"
+    return f" | tee {' '.join(pipes[1:])} > {pipes[0]}"
 
-    video_filters = options.video_filters
 
-    assert os.path.exists(chunk.path)
-    assert os.path.exists(chunk.chunk_path)
-
-    random_bit = os.urandom(16).hex()
-    pipe_ref_path = f"/tmp/{os.path.basename(chunk.path)}_{random_bit}.pipe"
-    pipe_dist_path = f"/tmp/{os.path.basename(chunk.chunk_path)}_{random_bit}.pipe"
+def get_reference_filters(options: MetricOptions) -> Tuple[str, str]:
+    """
+    :return: (the filter chain that turns source frames into the reference,
+    the -vf that brings the distorted frames to the comparison resolution, or "")
+    """
+    video_filters = options.video_filters
 
     dist_filter = ""
 
@@ -95,30 +134,108 @@ def get_input_pipes(chunk: ChunkObject, options: MetricOptions) -> dict:
         video_filters = ",".join(vf)
 
     video_filters = ",".join([f for f in video_filters.split(",") if f != ""])
+    return video_filters, dist_filter
+
+
+def get_input_pipes(
+    chunk: ChunkObject, options: MetricOptions, select_every: int = 1, copies: int = 1
+) -> dict:
+    """
+    Create two named pipes that will output distorted and reference yuv frames,
+    return the pipe paths and the commands that will feed them
+    :param select_every: feed only every Nth frame on both sides,
+    for metrics that have no temporal features and no subsampling of their own
+    :param copies: how many metrics read the frames, each gets its own pair of pipes ("ref_pipes", "dist_pipes")
+    fed from the same decode
+    """
+
+    assert os.path.exists(chunk.path)
+    assert os.path.exists(chunk.chunk_path)
+
+    random_bit = os.urandom(16).hex()
+    pipe_ref_path = f"/tmp/{os.path.basename(chunk.path)}_{random_bit}.pipe"
+    pipe_dist_path = f"/tmp/{os.path.basename(chunk.chunk_path)}_{random_bit}.pipe"
+    ref_pipes = [pipe_ref_path] + [
+        f"/tmp/{os.path.basename(chunk.path)}_{random_bit}_{i}.pipe"
+        for i in range(1, copies)
+    ]
+    dist_pipes = [pipe_dist_path] + [
+        f"/tmp/{os.path.basename(chunk.chunk_path)}_{random_bit}_{i}.pipe"
+        for i in range(1, copies)
+    ]
+    ref_redirect = get_pipe_redirect(ref_pipes)
+
+    video_filters, dist_filter = get_reference_filters(options)
+
+    has_filtered_ref = options.filtered_reference_y4m != "" and os.path.exists(
+        options.filtered_reference_y4m
+    )
+
+    # every probe of a chunk compares against the same reference, decode it once if we can
+    cached_ref = None
+    intermediate_cache = get_intermediate_cache()
+    if (
+        not has_filtered_ref
+        and intermediate_cache is not None
+        and chunk.first_frame_index != -1
+    ):
+        cached_ref = intermediate_cache.get(
+            chunk, video_filters=video_filters, bit_depth=10
+        )
+
+    ref_select = ""
+    if select_every > 1:
+        select_filter = get_select_filter(select_every)
+        if dist_filter == "":
+            dist_filter = f" -vf {select_filter} "
+        else:
+            dist_filter = f"{dist_filter.rstrip()},{select_filter} "
+        if has_filtered_ref or cached_ref is not None:
+            # these serve finished frames, pick them in a pass of their own
+            ref_select = (
+                f" | {get_binary('ffmpeg')} -v error -nostdin -f yuv4mpegpipe -i -"
+                f" -vf {select_filter} -strict -1 -f yuv4mpegpipe -"
+            )
+        else:
+            video_filters = ",".join(
+                [f for f in [video_filters, select_filter] if f != ""]
+            )
 
     if video_filters != "":
         video_filters = f" -vf {video_filters} "
 
-    ref_pipe_command = (
-        f"{get_binary('ffmpeg')} -v error -nostdin -hwaccel auto {chunk.get_ss_ffmpeg_command_pair()}"
-        f" -pix_fmt yuv420p10le -an -sn -strict -1 {video_filters} -f yuv4mpegpipe - > {pipe_ref_path}"
-    )
+    if has_filtered_ref:
+        # built by the ladder encoder, nothing left to do to it
+        ref_pipe_command = f"cat {shlex.quote(options.filtered_reference_y4m)}{ref_select}{ref_redirect}"
+    elif cached_ref is not None:
+        ref_pipe_command = f"{cached_ref.get_serve_command()}{ref_select}{ref_redirect}"
+    elif options.reference_y4m != "" and os.path.exists(options.reference_y4m):
+        # spooled by Encoder.encode_and_measure, already decoded, only the filters are left
+        ref_pipe_command = (
+            f"{get_binary('ffmpeg')} -v error -nostdin -i {shlex.quote(options.reference_y4m)}"
+            f" -pix_fmt yuv420p10le -an -sn -strict -1 {video_filters} -f yuv4mpegpipe -{ref_redirect}"
+        )
+    else:
+        ref_pipe_command = (
+            f"{get_binary('ffmpeg')} -v error -nostdin -hwaccel auto {chunk.get_ss_ffmpeg_command_pair()}"
+            f" -pix_fmt yuv420p10le -an -sn -strict -1 {video_filters} -f yuv4mpegpipe -{ref_redirect}"
+        )
     dist_pipe_command = (
         f'{get_binary("ffmpeg")} -v error -nostdin -filmgrain 0 -hwaccel auto -i "{chunk.chunk_path}" '
-        f"-pix_fmt yuv420p10le -an -sn -strict -1 {dist_filter} -f yuv4mpegpipe - > {pipe_dist_path}"
+        f"-pix_fmt yuv420p10le -an -sn -strict -1 {dist_filter} -f yuv4mpegpipe -{get_pipe_redirect(dist_pipes)}"
     )
 
     # TODO: WINDOWS SUPPORT
-    run_cli(f"mkfifo {pipe_ref_path}")
-    run_cli(f"mkfifo {pipe_dist_path}")
-
-    # check if both pipes are created
-    assert os.path.exists(pipe_ref_path)
-    assert os.path.exists(pipe_dist_path)
+    for pipe in ref_pipes + dist_pipes:
+        run_cli(f"mkfifo {pipe}")
+        # check if the pipe is created
+        assert os.path.exists(pipe)
 
     return {
         "ref_pipe": pipe_ref_path,
         "dist_pipe": pipe_dist_path,
+        "ref_pipes": ref_pipes,
+        "dist_pipes": dist_pipes,
         "ref_command": ref_pipe_command,
         "dist_command": dist_pipe_command,
     }
@@ -153,3 +270,61 @@ def get_metric_from_stats(
             raise Exception(
                 f"Unknown statistical_representation {statistical_representation}"
             )
+
+
+def rescore_stats(
+    stats: EncodeStats,
+    chunk: ChunkObject,
+    distorted_path: str,
+    options: MetricOptions,
+    metric: Metric = Metric.VMAF,
+    video_filters: str = "",
+) -> EncodeStats:
+    """
+    Score an encode that's already on disk again, e.g. with other options, without encoding it again
+    :param stats: the encode's stats, size, bitrate and timings are kept
+    :param chunk: the chunk the encode is of, for the reference frames
+    :param distorted_path: the encode
+    :return: stats, with the new metric result in place of the old one
+    """
+    local_chunk = copy.deepcopy(chunk)
+    local_chunk.chunk_path = distorted_path
+    options = copy.copy(options)
+    options.video_filters = video_filters
+
+    result = calculate_metric(chunk=local_chunk, options=options, metric=metric)
+
+    stats.metric_results = result
+    stats.metrics = {metric: result}
+    stats.add_resources("metric", result.resources)
+    return stats
+
+
+def refine_close_probe(
+    stats: EncodeStats,
+    target: float,
+    options: MetricOptions,
+    measure: Callable[[MetricOptions], EncodeStats],
+    statistical_representation: str = "mean",
+) -> EncodeStats:
+    """
+    A subsampled probe whose confidence interval reaches (close to) the target could be on either side of it,
+    rescore it with PROBE_REFINE_STEP times the density until it's clearly on one side or tight enough.
+    The interval is of the mean, probes judged by another statistic are left as they are
+    :param target: the target in the probe's own terms, i.e. with any probe offset taken off
+    :param measure: scores the same encode again with the given options, see `rescore_stats`
+    """
+    if statistical_representation != "mean":
+        return stats
+    while options.subsample > 1:
+        confidence_interval = stats.metric_results.confidence_interval
+        score = get_metric_from_stats(stats, statistical_representation)
+        if (
+            confidence_interval <= PROBE_TARGET_CONFIDENCE
+            or abs(score - target) > confidence_interval * PROBE_REFINE_DISTANCE
+        ):
+            break
+        options = copy.copy(options)
+        options.subsample = max(1, options.subsample // PROBE_REFINE_STEP)
+        stats = measure(options)
+    return stats
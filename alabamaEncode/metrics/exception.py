@@ -14,3 +14,9 @@ class Ssimu2Exception(MetricException):
     def __init__(self, message):
         self.message = message
         super().__init__(self.message)
+
+
+class MultiMetricException(MetricException):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
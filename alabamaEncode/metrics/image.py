@@ -1,8 +1,10 @@
 import os
 import re
+import time
 
 from alabamaEncode.core.cli_executor import run_cli
 from alabamaEncode.core.bin_utils import get_binary
+from alabamaEncode.metrics.cache import get_metric_cache, get_file_descriptor
 
 
 class ImageMetrics:
@@ -65,12 +67,28 @@ class ImageMetrics:
 
     @staticmethod
     def vmaf_score(reference_img_path, distorted_img_path):
+        metric_cache = get_metric_cache()
+        cache_key = None
+        if metric_cache is not None:
+            cache_key = metric_cache.get_key(
+                distorted_img_path,
+                get_file_descriptor(reference_img_path),
+                "image_vmaf",
+                {},
+            )
+            cached = metric_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        start = time.time()
+
         cli = f" ffmpeg -hide_banner -i {reference_img_path} -i {distorted_img_path} -lavfi libvmaf -f null -"
 
         result_string = run_cli(cli).get_output()
         try:
             match = re.compile(r"VMAF score: ([0-9]+\.[0-9]+)").search(result_string)
             vmaf_score = float(match.group(1))
+            if cache_key is not None:
+                metric_cache.put(cache_key, vmaf_score, time.time() - start)
             return vmaf_score
         except AttributeError:
             print(
@@ -0,0 +1,30 @@
+"""
+CAMBI, libvmaf's banding detector. Higher is worse, 0 is no visible banding, ~5 starts to be noticeable
+"""
+
+import numpy as np
+
+from alabamaEncode.metrics.impl.vmaf_log import get_score_statistics
+from alabamaEncode.metrics.result import MetricResult
+
+__all__ = ["CambiResult"]
+
+
+class CambiResult(MetricResult):
+    def __init__(self, scores: np.ndarray):
+        """
+        :param scores: per frame cambi of the distorted frames
+        """
+        self.scores = scores
+        self.__dict__.update(get_score_statistics(scores))
+
+    def __str__(self):
+        return f"{self.mean}"
+
+    def __repr__(self):
+        return (
+            f"CambiResult(mean={self.mean},"
+            f" max={self.max},"
+            f" prct_50={self.percentile_50},"
+            f" std_dev={self.std_dev})"
+        )
@@ -1,7 +1,11 @@
 import re
 
+import numpy as np
+
 from alabamaEncode.core.bin_utils import get_binary
 from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.metrics.impl.vmaf_log import get_score_statistics
+from alabamaEncode.metrics.result import MetricResult
 from alabamaEncode.scene.chunk import ChunkObject
 
 
@@ -23,3 +27,44 @@ def get_video_psnr(distorted_path, in_chunk: ChunkObject = None):
         print(f"Failed getting psnr comparing {distorted_path} agains {in_chunk.path}")
         print(null_)
         return 0
+
+
+class PsnrResult(MetricResult):
+    # plane weights of the 4:2:0 frames the metric pipes carry
+    PLANE_WEIGHTS = (4, 1, 1)
+
+    def __init__(self, psnr_y: np.ndarray, psnr_cb: np.ndarray, psnr_cr: np.ndarray):
+        """
+        Per frame psnr of the three planes as libvmaf's psnr feature logs them, combined like ffmpeg's
+        psnr filter "average": from the mse of all samples, the mean from the mse of all frames
+        """
+        weights = np.array(self.PLANE_WEIGHTS, dtype=np.float64) / sum(
+            self.PLANE_WEIGHTS
+        )
+        # mse relative to the peak, the peak cancels out
+        mse = sum(
+            [
+                weight * np.power(10, -plane.astype(np.float64) / 10)
+                for weight, plane in zip(weights, [psnr_y, psnr_cb, psnr_cr])
+            ]
+        )
+        self.psnr_y = float(np.mean(psnr_y))
+        self.psnr_cb = float(np.mean(psnr_cb))
+        self.psnr_cr = float(np.mean(psnr_cr))
+        self.scores = (-10 * np.log10(mse)).astype(np.float32)
+        self.__dict__.update(
+            get_score_statistics(self.scores, mean=float(-10 * np.log10(np.mean(mse))))
+        )
+
+    def __str__(self):
+        return f"{self.mean}"
+
+    def __repr__(self):
+        return (
+            f"PsnrResult(mean={self.mean},"
+            f" y={self.psnr_y},"
+            f" cb={self.psnr_cb},"
+            f" cr={self.psnr_cr},"
+            f" prct_1={self.percentile_1},"
+            f" std_dev={self.std_dev})"
+        )
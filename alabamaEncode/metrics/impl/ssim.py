@@ -1,8 +1,15 @@
+import math
 import os
 import re
+import time
+
+import numpy as np
 
 from alabamaEncode.core.bin_utils import get_binary
 from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.metrics.cache import get_metric_cache, get_chunk_descriptor
+from alabamaEncode.metrics.impl.vmaf_log import get_score_statistics
+from alabamaEncode.metrics.result import MetricResult
 from alabamaEncode.scene.chunk import ChunkObject
 
 
@@ -17,6 +24,21 @@ def get_video_ssim(
         raise FileNotFoundError(
             f"File {in_chunk.path} or {distorted_path} does not exist"
         )
+    metric_cache = get_metric_cache()
+    cache_key = None
+    if metric_cache is not None:
+        cache_key = metric_cache.get_key(
+            distorted_path,
+            get_chunk_descriptor(in_chunk, video_filters),
+            "ffmpeg_ssim",
+            {},
+        )
+        cached = metric_cache.get(cache_key)
+        if cached is not None:
+            ssim_score, ssim_db = cached
+            return (ssim_score, ssim_db) if get_db is True else ssim_score
+    start = time.time()
+
     null_ = in_chunk.create_chunk_ffmpeg_pipe_command(video_filters=video_filters)
 
     null_ += f" | {get_binary('ffmpeg')} -hide_banner -i - -i {distorted_path} -filter_complex ssim -f null -"
@@ -31,6 +53,8 @@ def get_video_ssim(
         match = re.search(r"All:([\d.]+) \(([\d.]+)", result_string)
         ssim_score = float(match.group(1))
         ssim_db = float(match.group(2))
+        if cache_key is not None:
+            metric_cache.put(cache_key, (ssim_score, ssim_db), time.time() - start)
 
         if get_db is True:
             return ssim_score, ssim_db
@@ -40,3 +64,31 @@ def get_video_ssim(
         print(f"Failed getting ssim comparing {distorted_path} agains {in_chunk.path}")
         print(null_)
         return 0
+
+
+class SsimResult(MetricResult):
+    def __init__(self, scores: np.ndarray):
+        """
+        :param scores: per frame ssim, libvmaf's float_ssim, luma only unlike ffmpeg's "All"
+        """
+        self.scores = scores
+        self.__dict__.update(get_score_statistics(scores))
+        self.mean_db = get_ssim_db(self.mean)
+
+    def __str__(self):
+        return f"{self.mean}"
+
+    def __repr__(self):
+        return (
+            f"SsimResult(mean={self.mean},"
+            f" db={self.mean_db},"
+            f" prct_1={self.percentile_1},"
+            f" std_dev={self.std_dev})"
+        )
+
+
+def get_ssim_db(ssim: float) -> float:
+    """
+    ssim in dB the way ffmpeg's ssim filter prints it, capped at 100 for identical frames
+    """
+    return -10 * math.log10(max(1 - ssim, 1e-10))
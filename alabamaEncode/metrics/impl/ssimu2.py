@@ -1,12 +1,20 @@
+import asyncio
+import math
+import time
+
 from alabamaEncode.core.bin_utils import get_binary, register_bin
-from alabamaEncode.core.cli_executor import run_cli_parallel
+from alabamaEncode.core.cli_executor import run_cli_parallel_async, run_sync
+from alabamaEncode.core.ffmpeg import Ffmpeg
 from alabamaEncode.core.path import PathAlabama
+from alabamaEncode.core.resource_usage import ResourceUsage
 
 
+from alabamaEncode.metrics.cache import lookup_chunk_result_async, store_result_async
 from alabamaEncode.metrics.exception import Ssimu2Exception
 from alabamaEncode.metrics.metric import Metric
 from alabamaEncode.metrics.options import MetricOptions
 from alabamaEncode.metrics.result import MetricResult
+from alabamaEncode.metrics.subsample import get_confidence_interval
 from alabamaEncode.scene.chunk import ChunkObject
 
 
@@ -18,12 +26,31 @@ class Ssimu2Options(MetricOptions):
 def calc_ssimu2(
     chunk: ChunkObject,
     ssimu2_options: Ssimu2Options,
+):
+    return run_sync(calc_ssimu2_async(chunk, ssimu2_options))
+
+
+async def calc_ssimu2_async(
+    chunk: ChunkObject,
+    ssimu2_options: Ssimu2Options,
 ):
     assert ssimu2_options is not None
 
+    cache_key, cached = await lookup_chunk_result_async(
+        chunk, "ssimulacra2", ssimu2_options
+    )
+    if cached is not None:
+        return cached
+    start = time.time()
+
     from alabamaEncode.metrics.calculate import get_input_pipes
 
-    owo = get_input_pipes(chunk=chunk, options=ssimu2_options)
+    owo = await asyncio.to_thread(
+        get_input_pipes,
+        chunk=chunk,
+        options=ssimu2_options,
+        select_every=ssimu2_options.subsample,
+    )
 
     ref_pipe = owo["ref_pipe"]
     dist_pipe = owo["dist_pipe"]
@@ -32,27 +59,36 @@ def calc_ssimu2(
 
     main_command = f"{get_binary('ssimulacra2_rs')} video --frame-threads 4 {ref_pipe} {dist_pipe} "
 
-    cli_results = run_cli_parallel(
-        [
-            ref_command,
-            dist_command,
-            main_command,
-        ]
-    )
-
     from alabamaEncode.metrics.calculate import cleanup_input_pipes
 
-    cleanup_input_pipes(owo)
-
-    for c in cli_results:
-        try:
-            c.verify()
-        except RuntimeError as e:
-            raise Ssimu2Exception(
-                f"Could not run ssimu2 command: {e}, {[c.output for c in cli_results]}"
+    try:
+        cli_results = await run_cli_parallel_async(
+            [
+                ref_command,
+                dist_command,
+                main_command,
+            ]
+        )
+    except RuntimeError as e:
+        raise Ssimu2Exception(f"Could not run ssimu2 command: {e}")
+    finally:
+        cleanup_input_pipes(owo)
+
+    result = Ssimu2Result(cli_results[2].output)
+    if ssimu2_options.subsample > 1 and result.std_dev >= 0:
+        frame_count = chunk.get_frame_count()
+        if frame_count <= 0:
+            frame_count = await asyncio.to_thread(
+                Ffmpeg.get_frame_count, PathAlabama(chunk.chunk_path)
             )
-
-    return Ssimu2Result(cli_results[2].output)
+        result.confidence_interval = get_confidence_interval(
+            result.std_dev,
+            math.ceil(frame_count / ssimu2_options.subsample),
+            ssimu2_options.subsample,
+        )
+    result.resources = sum([c.resources for c in cli_results], ResourceUsage())
+    await store_result_async(cache_key, result, time.time() - start)
+    return result
 
 
 class Ssimu2Result(MetricResult):
@@ -1,15 +1,21 @@
-import json
+import asyncio
 import os
-from statistics import mean
+import time
+
+import numpy as np
 
 from alabamaEncode.core.bin_utils import get_binary
 from alabamaEncode.core.bin_utils import register_bin
-from alabamaEncode.core.cli_executor import run_cli, run_cli_parallel
+from alabamaEncode.core.cli_executor import run_cli, run_cli_parallel_async, run_sync
 from alabamaEncode.core.path import PathAlabama
+from alabamaEncode.core.resource_usage import ResourceUsage
+from alabamaEncode.metrics.cache import lookup_chunk_result_async, store_result_async
 from alabamaEncode.metrics.exception import VmafException
+from alabamaEncode.metrics.impl.vmaf_log import read_vmaf_log, get_score_statistics
 from alabamaEncode.metrics.metric import Metric
 from alabamaEncode.metrics.options import MetricOptions
 from alabamaEncode.metrics.result import MetricResult
+from alabamaEncode.metrics.subsample import get_confidence_interval
 from alabamaEncode.scene.chunk import ChunkObject
 
 
@@ -60,12 +66,26 @@ def calc_vmaf(
     chunk: ChunkObject,
     vmaf_options: VmafOptions,
     log_path="",
+):
+    return run_sync(calc_vmaf_async(chunk, vmaf_options, log_path=log_path))
+
+
+async def calc_vmaf_async(
+    chunk: ChunkObject,
+    vmaf_options: VmafOptions,
+    log_path="",
 ):
     assert vmaf_options is not None
 
+    cache_key, cached = await lookup_chunk_result_async(chunk, "vmaf", vmaf_options)
+    if cached is not None:
+        return cached
+    start = time.time()
+
     from alabamaEncode.metrics.calculate import get_input_pipes
 
-    owo = get_input_pipes(chunk=chunk, options=vmaf_options)
+    # probes the source if the chunk has no framerate yet, keep that off the loop
+    owo = await asyncio.to_thread(get_input_pipes, chunk=chunk, options=vmaf_options)
 
     ref_pipe = owo["ref_pipe"]
     dist_pipe = owo["dist_pipe"]
@@ -76,88 +96,89 @@ def calc_vmaf(
         log_path = f"/tmp/{os.path.basename(chunk.chunk_path)}.vmaflog"
 
     vmaf_command = (
-        f'{get_binary("vmaf")} -q --json --output "{log_path}" --model {vmaf_options.get_model()} '
+        f'{get_binary("vmaf")} -q --xml --output "{log_path}" --model {vmaf_options.get_model()} '
         f"--reference {ref_pipe} "
         f"--distorted {dist_pipe}"
         f" --threads {vmaf_options.threads}"
     )
-
-    cli_results = run_cli_parallel(
-        [
-            ref_command,
-            dist_command,
-            vmaf_command,
-        ]
-    )
+    if vmaf_options.subsample > 1:
+        # the decodes stay complete, the motion features need the neighbouring frames
+        vmaf_command += f" --subsample {vmaf_options.subsample}"
 
     from alabamaEncode.metrics.calculate import cleanup_input_pipes
 
-    cleanup_input_pipes(owo)
-
-    for c in cli_results:
-        try:
-            c.verify()
-        except RuntimeError as e:
-            raise VmafException(
-                f"Could not run vmaf command: {e}, {[c.output for c in cli_results]}"
-            )
+    try:
+        cli_results = await run_cli_parallel_async(
+            [
+                ref_command,
+                dist_command,
+                vmaf_command,
+            ]
+        )
+    except RuntimeError as e:
+        raise VmafException(f"Could not run vmaf command: {e}")
+    finally:
+        cleanup_input_pipes(owo)
 
     try:
-        log_decoded = json.load(open(log_path))
-    except (json.decoder.JSONDecodeError, FileNotFoundError):
+        log = read_vmaf_log(log_path)
+    except (ValueError, FileNotFoundError) as e:
         raise VmafException(
-            f"Could not decode vmaf log: {log_path}, {[c.output for c in cli_results]}"
+            f"Could not decode vmaf log: {log_path}, {e}, {[c.output for c in cli_results]}"
         )
 
     os.remove(log_path)
 
     result = VmafResult(
-        pooled_metrics=log_decoded["pooled_metrics"],
-        _frames=log_decoded["frames"],
-        fps=log_decoded["fps"],
+        pooled_metrics=log.pooled_metrics,
+        scores=log.scores,
+        fps=log.fps,
     )
+    if len(log.scores) > 1:
+        result.confidence_interval = get_confidence_interval(
+            float(np.std(log.scores, ddof=1)),
+            len(log.scores),
+            vmaf_options.subsample,
+        )
+    result.resources = sum([c.resources for c in cli_results], ResourceUsage())
+    await store_result_async(cache_key, result, time.time() - start)
     return result
 
 
 class VmafResult(MetricResult):
-    def __init__(self, _frames=None, pooled_metrics=None, fps=None):
+    def __init__(self, _frames=None, pooled_metrics=None, fps=None, scores=None):
+        """
+        :param _frames: the "frames" list of a libvmaf json log
+        :param scores: per frame scores in frame order, takes the place of _frames
+        """
         if pooled_metrics is None:
             pooled_metrics = {}
 
         self.fps = fps
 
         if _frames is not None:
-            frames = []
-            for frame in _frames:
-                if "vmaf" in frame["metrics"]:
-                    frames.append([frame["frameNum"], frame["metrics"]["vmaf"]])
-                else:
-                    frames.append([frame["frameNum"], frame["metrics"]["phonevmaf"]])
-            frames.sort(key=lambda x: x[0])
-            # calc 1 5 10 25 50 percentiles
-            vmaf_scores = [x[1] for x in frames]
-            vmaf_scores.sort()
-            self.percentile_1 = vmaf_scores[int(len(vmaf_scores) * 0.01)]
-            self.percentile_5 = vmaf_scores[int(len(vmaf_scores) * 0.05)]
-            self.percentile_10 = vmaf_scores[int(len(vmaf_scores) * 0.1)]
-            self.percentile_25 = vmaf_scores[int(len(vmaf_scores) * 0.25)]
-            self.percentile_50 = vmaf_scores[int(len(vmaf_scores) * 0.5)]
-
-            if "vmaf" in pooled_metrics:
-                self.mean = pooled_metrics["vmaf"]["mean"]
-                self.harmonic_mean = pooled_metrics["vmaf"]["harmonic_mean"]
-            else:
-                self.mean = mean([x[1] for x in frames])
-                self.harmonic_mean = 1 / mean([1 / x[1] for x in frames if x[1] != 0])
-
-            self.max = max([x[1] for x in frames])
-            self.min = min([x[1] for x in frames])
+            frames = sorted(_frames, key=lambda frame: frame["frameNum"])
+            scores = np.array(
+                [
+                    (
+                        frame["metrics"]["vmaf"]
+                        if "vmaf" in frame["metrics"]
+                        else frame["metrics"]["phonevmaf"]
+                    )
+                    for frame in frames
+                ],
+                dtype=np.float32,
+            )
 
-            self.std_dev = 0
-            for frame in frames:
-                self.std_dev += (frame[1] - self.mean) ** 2
-            self.std_dev /= len(frames)
-            self.std_dev **= 0.5
+        self.scores = scores
+        if scores is not None:
+            pooled = pooled_metrics.get("vmaf", None)
+            statistics = get_score_statistics(
+                scores, mean=pooled["mean"] if pooled else None
+            )
+            if pooled:
+                statistics["harmonic_mean"] = pooled["harmonic_mean"]
+            self.__dict__.update(statistics)
 
     def __str__(self):
         return f"{self.mean}"
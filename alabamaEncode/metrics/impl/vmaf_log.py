@@ -0,0 +1,267 @@
+"""
+Reads libvmaf logs frame by frame into a float32 array instead of loading the whole document,
+a feature length 4k json log is hundreds of MB of dicts otherwise
+"""
+
+import array
+import itertools
+import json
+import re
+from typing import Optional, Dict, List
+
+import numpy as np
+
+__all__ = ["VmafLog", "read_vmaf_log", "get_score_statistics"]
+
+# names the score goes by in the log, phonevmaf when the model was loaded with name=phonevmaf
+VMAF_SCORE_NAMES = ["vmaf", "phonevmaf"]
+# csv rows handed to numpy at once
+CSV_BATCH_ROWS = 65536
+
+
+class VmafLog:
+    def __init__(
+        self,
+        scores: np.ndarray,
+        pooled_metrics: Dict[str, dict],
+        fps: Optional[float],
+        features: Dict[str, np.ndarray] = None,
+    ):
+        """
+        :param scores: per frame vmaf in frame order, float32, empty if the run had no model
+        :param pooled_metrics: libvmaf's pooled metrics, {"vmaf": {"mean": .., "harmonic_mean": ..}}
+        :param features: per frame values of the features asked for, e.g. {"psnr_y": ..}, in frame order
+        """
+        self.scores = scores
+        self.pooled_metrics = pooled_metrics
+        self.fps = fps
+        self.features = features if features is not None else {}
+
+
+def _get_libvmaf_pooled(scores: np.ndarray) -> Dict[str, dict]:
+    """
+    Pooled metrics the way libvmaf computes them, for logs that don't carry them (csv)
+    """
+    if len(scores) == 0:
+        return {}
+    values = scores.astype(np.float64)
+    return {
+        "vmaf": {
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "mean": float(values.mean()),
+            "harmonic_mean": float(len(values) / np.sum(1 / (values + 1)) - 1),
+        }
+    }
+
+
+_XML_ATTRIBUTE = re.compile(r'([\w.]+)="([^"]*)"')
+
+
+def _read_xml(path: str, features: List[str]) -> VmafLog:
+    """
+    libvmaf writes one element per line, so the frames are picked out line by line with a regex,
+    a real xml parser building an element per frame is ~5x slower
+    """
+    frames = array.array("I")
+    scores = array.array("f")
+    columns = {name: array.array("f") for name in features}
+    column_patterns = []
+    pooled_metrics = {}
+    fps = None
+    frame_pattern = None
+    score_name = None
+    closed = False
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("<frame "):
+                if frame_pattern is None:
+                    attributes = dict(_XML_ATTRIBUTE.findall(line))
+                    score_name = next(
+                        (n for n in VMAF_SCORE_NAMES if n in attributes), None
+                    )
+                    if score_name is None and len(features) == 0:
+                        raise ValueError(f"No vmaf score in the frames of {path}")
+                    missing = [name for name in features if name not in attributes]
+                    if len(missing) > 0:
+                        raise ValueError(
+                            f"No {', '.join(missing)} in the frames of {path}"
+                        )
+                    frame_pattern = re.compile(
+                        rf'frameNum="(\d+)".* {score_name}="([^"]*)"'
+                        if score_name is not None
+                        else r'frameNum="(\d+)"'
+                    )
+                    column_patterns = [
+                        (columns[name], re.compile(rf' {name}="([^"]*)"'))
+                        for name in features
+                    ]
+                match = frame_pattern.search(line)
+                if match is None:
+                    raise ValueError(f"Broken frame in {path}: {line}")
+                frames.append(int(match.group(1)))
+                if score_name is not None:
+                    scores.append(float(match.group(2)))
+                for column, pattern in column_patterns:
+                    match = pattern.search(line)
+                    if match is None:
+                        raise ValueError(f"Broken frame in {path}: {line}")
+                    column.append(float(match.group(1)))
+            elif line.startswith("<metric "):
+                attributes = dict(_XML_ATTRIBUTE.findall(line))
+                name = attributes.pop("name", None)
+                if name is not None:
+                    pooled_metrics[name] = {k: float(v) for k, v in attributes.items()}
+            elif line.startswith("<fyi "):
+                attributes = dict(_XML_ATTRIBUTE.findall(line))
+                if "fps" in attributes:
+                    fps = float(attributes["fps"])
+            elif line.startswith("</VMAF>"):
+                closed = True
+
+    if not closed:
+        raise ValueError(f"Truncated vmaf log {path}")
+
+    scores = np.frombuffer(scores, dtype=np.float32)
+    columns = {
+        name: np.frombuffer(column, dtype=np.float32)
+        for name, column in columns.items()
+    }
+    frames = np.frombuffer(frames, dtype=np.uint32)
+    if len(frames) > 1 and np.any(np.diff(frames.astype(np.int64)) < 0):
+        order = np.argsort(frames, kind="stable")
+        if len(scores) > 0:
+            scores = scores[order]
+        columns = {name: column[order] for name, column in columns.items()}
+    if "vmaf" not in pooled_metrics and "phonevmaf" in pooled_metrics:
+        pooled_metrics["vmaf"] = pooled_metrics["phonevmaf"]
+    return VmafLog(scores, pooled_metrics, fps, columns)
+
+
+def _read_csv(path: str, features: List[str]) -> VmafLog:
+    with open(path) as f:
+        header = [name.strip() for name in f.readline().strip().split(",")]
+        score_name = next((n for n in VMAF_SCORE_NAMES if n in header), None)
+        if (score_name is None and len(features) == 0) or "Frame" not in header:
+            raise ValueError(f"No vmaf score column in {path}")
+        missing = [name for name in features if name not in header]
+        if len(missing) > 0:
+            raise ValueError(f"No {', '.join(missing)} column in {path}")
+        names = ([score_name] if score_name is not None else []) + features
+        columns = [header.index("Frame")] + [header.index(name) for name in names]
+
+        frame_batches, column_batches = [], []
+        while True:
+            lines = list(itertools.islice(f, CSV_BATCH_ROWS))
+            if len(lines) == 0:
+                break
+            batch = np.loadtxt(
+                lines, delimiter=",", usecols=columns, dtype=np.float64, ndmin=2
+            )
+            frame_batches.append(batch[:, 0].astype(np.int64))
+            column_batches.append(batch[:, 1:].astype(np.float32))
+
+    if len(column_batches) == 0:
+        return VmafLog(
+            np.empty(0, dtype=np.float32),
+            {},
+            None,
+            {name: np.empty(0, dtype=np.float32) for name in features},
+        )
+    frames = np.concatenate(frame_batches)
+    values = np.concatenate(column_batches)
+    if np.any(np.diff(frames) < 0):
+        values = values[np.argsort(frames, kind="stable")]
+    columns = {name: np.ascontiguousarray(values[:, i]) for i, name in enumerate(names)}
+    scores = (
+        columns.pop(score_name)
+        if score_name is not None
+        else np.empty(0, dtype=np.float32)
+    )
+    return VmafLog(scores, _get_libvmaf_pooled(scores), None, columns)
+
+
+def _read_json(path: str, features: List[str]) -> VmafLog:
+    with open(path) as f:
+        log = json.load(f)
+    frames = sorted(log["frames"], key=lambda frame: frame["frameNum"])
+    scores = np.empty(0, dtype=np.float32)
+    if len(features) == 0 or (
+        len(frames) > 0 and any(n in frames[0]["metrics"] for n in VMAF_SCORE_NAMES)
+    ):
+        scores = np.fromiter(
+            (
+                (
+                    frame["metrics"]["vmaf"]
+                    if "vmaf" in frame["metrics"]
+                    else frame["metrics"]["phonevmaf"]
+                )
+                for frame in frames
+            ),
+            dtype=np.float32,
+            count=len(frames),
+        )
+    columns = {
+        name: np.fromiter(
+            (frame["metrics"][name] for frame in frames),
+            dtype=np.float32,
+            count=len(frames),
+        )
+        for name in features
+    }
+    return VmafLog(scores, log.get("pooled_metrics", {}), log.get("fps", None), columns)
+
+
+def read_vmaf_log(path: str, features: List[str] = None) -> VmafLog:
+    """
+    Read a libvmaf log, the format (xml, csv or json) is sniffed from the content
+    :param features: per frame values to read next to the score, e.g. ["psnr_y", "float_ssim"],
+    the score is optional when asking for some since a run without a model has none
+    :raises ValueError: if the log is empty, truncated or has no vmaf scores (or features asked for)
+    """
+    features = list(features) if features is not None else []
+    with open(path) as f:
+        start = f.read(64).lstrip()
+    if start == "":
+        raise ValueError(f"Empty vmaf log {path}")
+    try:
+        if start.startswith("<"):
+            return _read_xml(path, features)
+        if start.startswith("{"):
+            return _read_json(path, features)
+        return _read_csv(path, features)
+    except (json.JSONDecodeError, KeyError) as e:
+        raise ValueError(f"Could not parse vmaf log {path}: {e}")
+
+
+def get_score_statistics(
+    scores: np.ndarray, mean: Optional[float] = None
+) -> Dict[str, float]:
+    """
+    Percentiles pick the score at int(n * p) of the sorted scores, like the old list based code did
+    :param mean: use this (e.g. libvmaf's pooled mean) as the mean and for the std dev instead of computing it
+    """
+    if len(scores) == 0:
+        raise ValueError("No scores")
+    values = scores.astype(np.float64)
+    n = len(values)
+    ranks = [int(n * p) for p in (0.01, 0.05, 0.1, 0.25, 0.5)]
+    partitioned = np.partition(values, ranks)
+    if mean is None:
+        mean = float(values.mean())
+    non_zero = values[values != 0]
+    return {
+        "percentile_1": float(partitioned[ranks[0]]),
+        "percentile_5": float(partitioned[ranks[1]]),
+        "percentile_10": float(partitioned[ranks[2]]),
+        "percentile_25": float(partitioned[ranks[3]]),
+        "percentile_50": float(partitioned[ranks[4]]),
+        "mean": mean,
+        "harmonic_mean": (
+            float(len(non_zero) / np.sum(1 / non_zero)) if len(non_zero) > 0 else 0
+        ),
+        "max": float(values.max()),
+        "min": float(values.min()),
+        "std_dev": float(np.sqrt(np.mean((values - mean) ** 2))),
+    }
@@ -4,6 +4,8 @@ from enum import Enum
 class Metric(Enum):
     VMAF = 1
     PSNR = 2
+    # libvmaf's float_ssim, luma only, EncodeStats.ssim is ffmpeg's all plane one
     SSIM = 3
     SSIMULACRA2 = 4
     XPSNR = 5
+    CAMBI = 6
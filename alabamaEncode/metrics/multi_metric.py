@@ -0,0 +1,289 @@
+"""
+Every metric of an encode off one decode of each side. libvmaf runs the vmaf model and the psnr, float_ssim and
+cambi feature extractors in a single pass, ssimulacra2 has no libvmaf extractor so it gets its own binary,
+fed the same decoded frames through a tee
+"""
+
+import asyncio
+import copy
+import os
+import time
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+from alabamaEncode.core.bin_utils import get_binary
+from alabamaEncode.core.cli_executor import run_cli_parallel_async, run_sync
+from alabamaEncode.core.resource_usage import ResourceUsage
+from alabamaEncode.metrics.cache import lookup_chunk_result_async, store_result_async
+from alabamaEncode.metrics.exception import MultiMetricException
+from alabamaEncode.metrics.impl.cambi import CambiResult
+from alabamaEncode.metrics.impl.psnr import PsnrResult
+from alabamaEncode.metrics.impl.ssim import SsimResult
+from alabamaEncode.metrics.impl.ssimu2 import Ssimu2Result
+from alabamaEncode.metrics.impl.vmaf import VmafOptions, VmafResult
+from alabamaEncode.metrics.impl.vmaf_log import read_vmaf_log
+from alabamaEncode.metrics.metric import Metric
+from alabamaEncode.metrics.options import MetricOptions
+from alabamaEncode.metrics.result import MetricResult
+from alabamaEncode.metrics.subsample import get_confidence_interval
+from alabamaEncode.scene.chunk import ChunkObject
+
+__all__ = [
+    "MultiMetricResult",
+    "calculate_metrics",
+    "calculate_metrics_async",
+    "get_metric_list",
+]
+
+# libvmaf feature extractor of a metric and the per frame values it logs
+LIBVMAF_FEATURES: Dict[Metric, tuple] = {
+    Metric.PSNR: ("psnr", ["psnr_y", "psnr_cb", "psnr_cr"]),
+    Metric.SSIM: ("float_ssim", ["float_ssim"]),
+    Metric.CAMBI: ("cambi", ["cambi"]),
+}
+LIBVMAF_METRICS = {Metric.VMAF, *LIBVMAF_FEATURES.keys()}
+SUPPORTED_METRICS = LIBVMAF_METRICS | {Metric.SSIMULACRA2}
+
+
+class MultiMetricResult:
+    """
+    The results of one `calculate_metrics` run, by metric
+    """
+
+    def __init__(self):
+        self.results: Dict[Metric, MetricResult] = {}
+        # ResourceUsage of the decodes and every metric process
+        self.resources = None
+
+    def __getitem__(self, metric: Metric) -> MetricResult:
+        return self.results[metric]
+
+    def __contains__(self, metric: Metric) -> bool:
+        return metric in self.results
+
+    def __repr__(self):
+        return (
+            "MultiMetricResult("
+            + ", ".join([f"{m.name}={r}" for m, r in self.results.items()])
+            + ")"
+        )
+
+
+def get_metric_list(metrics) -> List[Metric]:
+    """
+    :param metrics: a Metric, several of them, or None
+    :return: the metrics as a list without repeats, in the order given
+    """
+    if metrics is None:
+        return []
+    if isinstance(metrics, Metric):
+        return [metrics]
+    return list(dict.fromkeys(metrics))
+
+
+def get_libvmaf_command(
+    metrics: List[Metric],
+    options: MetricOptions,
+    ref_pipe: str,
+    dist_pipe: str,
+    log_path: str,
+) -> str:
+    command = (
+        f'{get_binary("vmaf")} -q --xml --output "{log_path}" '
+        f"--reference {ref_pipe} "
+        f"--distorted {dist_pipe}"
+        f" --threads {options.threads}"
+    )
+    if Metric.VMAF in metrics:
+        vmaf_options = options if isinstance(options, VmafOptions) else VmafOptions()
+        command += f" --model {vmaf_options.get_model()}"
+    else:
+        # features only
+        command += " --no_prediction"
+    for metric in metrics:
+        if metric in LIBVMAF_FEATURES:
+            command += f" --feature {LIBVMAF_FEATURES[metric][0]}"
+    if options.subsample > 1:
+        command += f" --subsample {options.subsample}"
+    return command
+
+
+def get_libvmaf_results(
+    metrics: List[Metric], log_path: str, subsample: int
+) -> Dict[Metric, MetricResult]:
+    features = [
+        name
+        for metric in metrics
+        if metric in LIBVMAF_FEATURES
+        for name in LIBVMAF_FEATURES[metric][1]
+    ]
+    log = read_vmaf_log(log_path, features=features)
+
+    results = {}
+    for metric in metrics:
+        match metric:
+            case Metric.VMAF:
+                if len(log.scores) == 0:
+                    raise ValueError(f"No vmaf score in {log_path}")
+                result = VmafResult(
+                    pooled_metrics=log.pooled_metrics, scores=log.scores, fps=log.fps
+                )
+            case Metric.PSNR:
+                result = PsnrResult(
+                    log.features["psnr_y"],
+                    log.features["psnr_cb"],
+                    log.features["psnr_cr"],
+                )
+            case Metric.SSIM:
+                result = SsimResult(log.features["float_ssim"])
+            case Metric.CAMBI:
+                result = CambiResult(log.features["cambi"])
+            case _:
+                continue
+        result.fps = log.fps
+        scores = result.scores
+        if len(scores) > 1:
+            result.confidence_interval = get_confidence_interval(
+                float(np.std(scores, ddof=1)), len(scores), subsample
+            )
+        results[metric] = result
+    return results
+
+
+def calculate_metrics(
+    chunk: ChunkObject, metrics: Iterable[Metric], options: MetricOptions = None
+) -> MultiMetricResult:
+    return run_sync(calculate_metrics_async(chunk, metrics, options))
+
+
+def get_cache_entry(metric: Metric, options: MetricOptions) -> tuple:
+    """
+    :return: (name, options) a metric's result is cached under, vmaf and ssimulacra2 share theirs with calc_vmaf
+    and calc_ssimu2
+    """
+    if metric == Metric.SSIMULACRA2 and options.subsample > 1:
+        # scores every frame here
+        options = copy.copy(options)
+        options.subsample = 1
+    match metric:
+        case Metric.VMAF:
+            return "vmaf", options
+        case Metric.SSIMULACRA2:
+            return "ssimulacra2", options
+        case _:
+            return f"libvmaf_{metric.name.lower()}", options
+
+
+async def calculate_metrics_async(
+    chunk: ChunkObject, metrics: Iterable[Metric], options: MetricOptions = None
+) -> MultiMetricResult:
+    """
+    Decode the reference and the distorted chunk once and compute every metric off those frames,
+    metrics the metric cache already has are left out of the pass
+    :param chunk: chunk with the reference (path & seeking) and the distorted file in chunk_path
+    :param options: used for every metric, VmafOptions picks the vmaf model;
+    subsample applies to the libvmaf metrics, ssimulacra2 scores every frame
+    :raises MultiMetricException: for metrics with no single pass implementation, e.g. XPSNR
+    """
+    metrics = get_metric_list(metrics)
+    if len(metrics) == 0:
+        raise ValueError("No metrics to calculate")
+    unsupported = [m for m in metrics if m not in SUPPORTED_METRICS]
+    if len(unsupported) > 0:
+        raise MultiMetricException(
+            f"Metrics {', '.join([m.name for m in unsupported])} not implemented in a single pass"
+        )
+    if options is None:
+        options = VmafOptions()
+
+    result = MultiMetricResult()
+    cache_keys = {}
+    for metric in metrics:
+        cache_keys[metric], cached = await lookup_chunk_result_async(
+            chunk, *get_cache_entry(metric, options)
+        )
+        if cached is not None:
+            result.results[metric] = cached
+    missing = [m for m in metrics if m not in result.results]
+
+    if len(missing) > 0:
+        start = time.time()
+        calculated = await _calculate_metrics_async(chunk, missing, options)
+        # one pass for all of them, each gets its share
+        seconds = (time.time() - start) / len(missing)
+        cpu_seconds = calculated.resources.cpu_time / len(missing)
+        for metric in missing:
+            await store_result_async(
+                cache_keys[metric], calculated[metric], seconds, cpu_seconds
+            )
+        result.results.update(calculated.results)
+        result.resources = calculated.resources
+
+    # keep the order they were asked for
+    result.results = {m: result.results[m] for m in metrics}
+    return result
+
+
+async def _calculate_metrics_async(
+    chunk: ChunkObject, metrics: List[Metric], options: MetricOptions
+) -> MultiMetricResult:
+    libvmaf_metrics = [m for m in metrics if m in LIBVMAF_METRICS]
+    calculate_ssimu2 = Metric.SSIMULACRA2 in metrics
+
+    from alabamaEncode.metrics.calculate import get_input_pipes, cleanup_input_pipes
+
+    pipes = await asyncio.to_thread(
+        get_input_pipes,
+        chunk=chunk,
+        options=options,
+        copies=int(len(libvmaf_metrics) > 0) + int(calculate_ssimu2),
+    )
+
+    commands = [pipes["ref_command"], pipes["dist_command"]]
+    log_path = None
+    if len(libvmaf_metrics) > 0:
+        log_path = (
+            f"/tmp/{os.path.basename(chunk.chunk_path)}.{os.urandom(4).hex()}.vmaflog"
+        )
+        commands.append(
+            get_libvmaf_command(
+                libvmaf_metrics,
+                options,
+                pipes["ref_pipes"][0],
+                pipes["dist_pipes"][0],
+                log_path,
+            )
+        )
+    if calculate_ssimu2:
+        commands.append(
+            f"{get_binary('ssimulacra2_rs')} video --frame-threads 4 "
+            f"{pipes['ref_pipes'][-1]} {pipes['dist_pipes'][-1]}"
+        )
+
+    try:
+        cli_results = await run_cli_parallel_async(commands)
+    except RuntimeError as e:
+        if log_path is not None and os.path.exists(log_path):
+            os.remove(log_path)
+        raise MultiMetricException(f"Could not run metric commands: {e}")
+    finally:
+        cleanup_input_pipes(pipes)
+
+    result = MultiMetricResult()
+    if log_path is not None:
+        try:
+            libvmaf_results = await asyncio.to_thread(
+                get_libvmaf_results, libvmaf_metrics, log_path, options.subsample
+            )
+        except (ValueError, FileNotFoundError) as e:
+            raise MultiMetricException(
+                f"Could not decode vmaf log: {log_path}, {e}, {[c.output for c in cli_results]}"
+            )
+        os.remove(log_path)
+        result.results.update(libvmaf_results)
+    if calculate_ssimu2:
+        result.results[Metric.SSIMULACRA2] = Ssimu2Result(cli_results[-1].output)
+
+    result.resources = sum([c.resources for c in cli_results], ResourceUsage())
+    return result
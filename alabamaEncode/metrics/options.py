@@ -8,6 +8,12 @@ class MetricOptions(ABC):
     denoise_reference = False
     video_filters = ""
     threads = 1
+    # score every Nth frame only, 1 scores all of them
+    subsample = 1
+    # y4m of the chunk's unfiltered source frames, if set the reference is built from it instead of the source
+    reference_y4m = ""
+    # y4m of the finished reference (filtered, scaled, denoised), served to the metric as is
+    filtered_reference_y4m = ""
 
     def __init__(
         self,
@@ -17,3 +17,7 @@ class MetricResult(ABC):
     mean = -1
     harmonic_mean = -1
     std_dev = -1
+    # half width of the 95% confidence interval of the mean when only a sample of the frames got scored, 0 if all
+    confidence_interval = 0
+    # ResourceUsage of the processes that calculated the metric, if known
+    resources = None
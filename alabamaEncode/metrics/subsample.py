@@ -0,0 +1,35 @@
+"""
+Temporal subsampling of metric runs. Rate control only needs a probe's pooled score to a few tenths,
+scoring every Nth frame gets there for a fraction of the cost, the spread of the scored frames tells how close
+"""
+
+import math
+
+__all__ = ["get_select_filter", "get_confidence_interval"]
+
+# z of a two sided 95% interval
+Z_95 = 1.96
+
+
+def get_select_filter(subsample: int) -> str:
+    """
+    :return: ffmpeg filter keeping frames 0, N, 2N.. so both sides of a comparison pick the same ones
+    """
+    return f"framestep={subsample}"
+
+
+def get_confidence_interval(
+    std_dev: float, scored_frames: int, subsample: int
+) -> float:
+    """
+    Half width of the 95% interval of the mean of all frames, estimated from the scored ones.
+    A systematic sample is treated as a random one of 1/subsample of the frames, frame scores are correlated
+    over time so it's on the pessimistic side.
+    :return: 0 if every frame was scored
+    """
+    if subsample <= 1:
+        return 0
+    if scored_frames < 2:
+        return math.inf
+    finite_population = math.sqrt(1 - 1 / subsample)
+    return Z_95 * std_dev / math.sqrt(scored_frames) * finite_population
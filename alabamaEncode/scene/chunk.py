@@ -1,10 +1,17 @@
 import os.path
+import shlex
+from typing import List, Tuple
 
 from tqdm import tqdm
 
+from alabamaEncode.core.bin_utils import get_binary
+from alabamaEncode.core.containers import read_container
 from alabamaEncode.core.ffmpeg import Ffmpeg
+from alabamaEncode.core.integrity_manifest import IntegrityManifest
+from alabamaEncode.core.intermediate_cache import get_intermediate_cache
 from alabamaEncode.core.kv import AlabamaKv
 from alabamaEncode.core.path import PathAlabama
+from alabamaEncode.core.source_index import load_source_index
 
 
 class WrongFrameCountError(Exception):
@@ -20,6 +27,11 @@ class FfmpegDecodeFailException(Exception):
         super().__init__("Ffmpeg failed to decode the video")
 
 
+class CorruptContainerError(Exception):
+    def __init__(self, reason: str):
+        super().__init__(f"The container is broken: {reason}")
+
+
 class ChunkObject:
     """
     Ffmpeg based video chunk object
@@ -114,28 +126,85 @@ class ChunkObject:
 
     def get_ss_ffmpeg_command_pair(self) -> str:
         """
-        :return: an '-ss 12 clip.mp4 -t 2' ffmpeg command from start frame index and end frame index
+        :return: an '-ss 12 clip.mp4 -t 2' ffmpeg command from start frame index and end frame index,
+        or '-ss 12 clip.mp4 -frames:v 48' if the source has been indexed
         """
+        argv = self.get_ss_ffmpeg_argv()
+        if len(argv) == 2:
+            # case where we don't have a start or end frame index so include the whole video
+            return f' -i "{self.path}" '
 
-        # case where we don't have a start or end frame index so include the whole video
+        return f' {argv[0]} {argv[1]} -i "{self.path}" {argv[4]} {argv[5]} '
+
+    def get_ss_ffmpeg_argv(self) -> List[str]:
+        """
+        :return: the argv form of `get_ss_ffmpeg_command_pair`, ['-ss', '12', '-i', 'clip.mp4', '-t', '2']
+        """
         if self.first_frame_index == -1 or self.last_frame_index == -1:
-            return f' -i "{self.path}" '
+            return ["-i", self.path]
+
+        frame_window = self._get_frame_window()
+        if frame_window is not None:
+            seek_time, frame_count = frame_window
+            return [
+                "-ss",
+                f"{seek_time:.6f}",
+                "-i",
+                self.path,
+                "-frames:v",
+                str(frame_count),
+            ]
+
+        start_time, duration = self._get_seek_window()
+        return ["-ss", str(start_time), "-i", self.path, "-t", str(duration)]
+
+    def _get_end_frame_index(self) -> int:
+        # if we override the end, we end at "start frame # + override"
+        if self.end_override != -1 and self.length > self.end_override:
+            return self.first_frame_index + self.end_override
+        return self.last_frame_index
+
+    def _get_frame_window(self) -> [Tuple[float, int] | None]:
+        """
+        Exact seek using the source index, ffmpeg jumps to the keyframe before the seek point and drops
+        everything up to it, `-frames:v` then cuts at the exact frame count
+        :return: (seek time, frame count), None if the source isn't indexed
+        """
+        index = load_source_index(self.path)
+        if index is None or self.first_frame_index >= index.frame_count:
+            return None
+        return (
+            index.seek_time(self.first_frame_index),
+            self._get_end_frame_index() - self.first_frame_index,
+        )
 
+    def _get_seek_window(self) -> Tuple[float, float]:
+        """
+        :return: (start time, duration) in seconds, from the frame rate
+        """
         # get framerate
         if self.framerate == -1:
             self.framerate = Ffmpeg.get_video_frame_rate(PathAlabama(self.path))
 
-        # if we override the end, we end at "start frame # + override"
-        local_overriden_end = self.last_frame_index
-        if self.end_override != -1 and self.length > self.end_override:
-            local_overriden_end = self.first_frame_index + self.end_override
-
         # get the start time and duration
-        end_thingy = float(local_overriden_end) / self.framerate
+        end_thingy = float(self._get_end_frame_index()) / self.framerate
         start_time = float(self.first_frame_index) / self.framerate
         duration = end_thingy - start_time
 
-        return f' -ss {str(start_time)} -i "{self.path}" -t {str(duration)} '
+        return start_time, duration
+
+    def _get_cached_intermediate(self, video_filters, bit_depth, use_cache=True):
+        """
+        :return: the cached filtered frames of this chunk, None to decode live
+        """
+        cache = get_intermediate_cache()
+        if not use_cache or cache is None or self.first_frame_index == -1:
+            return None
+        return cache.get(
+            self,
+            video_filters=video_filters if video_filters is not None else "",
+            bit_depth=bit_depth,
+        )
 
     def get_width(self) -> int:
         if self.width == -1:
@@ -147,14 +216,23 @@ class ChunkObject:
             self.height = Ffmpeg.get_height(PathAlabama(self.path))
         return self.height
 
-    def create_chunk_ffmpeg_pipe_command(self, video_filters="", bit_depth=10) -> str:
+    def create_chunk_ffmpeg_pipe_command(
+        self, video_filters="", bit_depth=10, use_intermediate_cache=True
+    ) -> str:
         """
         :param video_filters: ffmpeg vf filters, e.g., scaling tonemapping
         :param bit_depth: bit depth of the output stream 8 or 10
+        :param use_intermediate_cache: serve the frames from the intermediate cache if one is configured
         :return: a 'ffmpeg ... |' command string that pipes a y4m stream into stdout
         """
         if video_filters is None:
             video_filters = ""
+
+        cached = self._get_cached_intermediate(
+            video_filters, bit_depth, use_intermediate_cache
+        )
+        if cached is not None:
+            return cached.get_serve_command()
         end_command = (
             f"ffmpeg -threads 1 -v error -nostdin -hwaccel auto {self.get_ss_ffmpeg_command_pair()} "
             f"-pix_fmt yuv420p10le "
@@ -170,12 +248,65 @@ class ChunkObject:
 
         return end_command
 
+    def create_chunk_ffmpeg_pipe_argv(
+        self, video_filters="", bit_depth=10, use_intermediate_cache=True
+    ) -> List[str]:
+        """
+        argv form of `create_chunk_ffmpeg_pipe_command`, for running without a shell
+        :param video_filters: ffmpeg vf filters, e.g., scaling tonemapping
+        :param bit_depth: bit depth of the output stream 8 or 10
+        :param use_intermediate_cache: serve the frames from the intermediate cache if one is configured
+        :return: ffmpeg argv that writes a y4m stream to stdout
+        """
+        cached = self._get_cached_intermediate(
+            video_filters, bit_depth, use_intermediate_cache
+        )
+        if cached is not None:
+            return cached.get_serve_argv()
+
+        argv = [
+            get_binary("ffmpeg"),
+            "-threads",
+            "1",
+            "-v",
+            "error",
+            "-nostdin",
+            "-hwaccel",
+            "auto",
+            *self.get_ss_ffmpeg_argv(),
+            "-pix_fmt",
+            "yuv420p" if bit_depth == 8 else "yuv420p10le",
+            "-an",
+            "-sn",
+            "-strict",
+            "-1",
+        ]
+
+        if video_filters is not None and video_filters != "":
+            if "-vf" in video_filters:
+                argv += shlex.split(video_filters)
+            else:
+                argv += ["-vf", video_filters]
+
+        argv += ["-f", "yuv4mpegpipe", "-"]
+
+        return argv
+
     def log_prefix(self):
         return f"[{self.chunk_index}] "
 
-    def verify_integrity(self, length_of_sequence=-1, quiet=False) -> bool:
+    def verify_integrity(
+        self,
+        length_of_sequence=-1,
+        quiet=False,
+        paranoid=False,
+        manifest: IntegrityManifest = None,
+    ) -> bool:
         """
-        checks the integrity of a chunk
+        checks the integrity of a chunk, ivf/mkv chunks are checked by walking their frame headers,
+        anything else goes through ffmpeg
+        :param paranoid: also decode the whole chunk with ffmpeg
+        :param manifest: skip the check if the file is unchanged since it last passed, record it if it passes now
         :return: True if invalid
         """
         self.chunk_done = False
@@ -183,19 +314,36 @@ class ChunkObject:
         if not os.path.exists(self.chunk_path):
             return True
 
+        is_last_chunk = (
+            length_of_sequence != -1 and length_of_sequence == self.chunk_index + 1
+        )
+        if manifest is not None and manifest.is_verified(
+            self.chunk_path,
+            expected_frame_count=self.last_frame_index - self.first_frame_index,
+            allow_frame_mismatch=is_last_chunk,
+            paranoid=paranoid,
+        ):
+            self.size_kB = self.get_filesize() / 1000
+            self.chunk_done = True
+            return False
+
         try:
             path = PathAlabama(self.chunk_path)
-            if Ffmpeg.check_for_invalid(path):
+            summary = read_container(self.chunk_path)
+            if summary is not None and not summary.valid:
+                raise CorruptContainerError(summary.error)
+
+            if (paranoid or summary is None) and Ffmpeg.check_for_invalid(path):
                 raise FfmpegDecodeFailException()
 
-            actual_frame_count = Ffmpeg.get_frame_count(path)
+            if summary is not None:
+                actual_frame_count = summary.frame_count
+            else:
+                actual_frame_count = Ffmpeg.get_frame_count(path)
             expected_frame_count = self.last_frame_index - self.first_frame_index
 
             if actual_frame_count != expected_frame_count:
-                if (
-                    length_of_sequence != -1
-                    and length_of_sequence == self.chunk_index + 1
-                ):
+                if is_last_chunk:
                     if not quiet:
                         print(
                             f"{self.log_prefix()}Frame count mismatch, but it's the last chunk, so it's ok"
@@ -206,31 +354,51 @@ class ChunkObject:
                         expected_frame_count=expected_frame_count,
                     )
         except Exception as e:
-            if isinstance(e, WrongFrameCountError) or isinstance(
-                e, FfmpegDecodeFailException
+            if isinstance(
+                e,
+                (
+                    WrongFrameCountError,
+                    FfmpegDecodeFailException,
+                    CorruptContainerError,
+                ),
             ):
                 if not quiet:
                     tqdm.write(
                         f"{self.log_prefix()} failed the integrity because: {e} 🤕"
                     )
             return True
+        if manifest is not None:
+            manifest.record(
+                self.chunk_path,
+                frame_count=actual_frame_count,
+                decoded=paranoid or summary is None,
+            )
         self.size_kB = self.get_filesize() / 1000
         self.chunk_done = True
         return False
 
-    def is_done(self, quiet=False, kv: AlabamaKv = None, length_of_sequence=-1) -> bool:
+    def is_done(
+        self,
+        quiet=False,
+        kv: AlabamaKv = None,
+        length_of_sequence=-1,
+        paranoid=False,
+        manifest: IntegrityManifest = None,
+    ) -> bool:
         """
         checks if the chunk is done
         :param quiet log what's wrong with the chunk to stdout
-        :param kv used to cache the integrity calculation
+        :param kv used to cache the integrity calculation, when there is no manifest
         :param length_of_sequence pass to integ check
+        :param paranoid pass to integ check
+        :param manifest pass to integ check, it checks the file didn't change since it passed, the kv can't
         :return: True if done
         """
 
         if self.chunk_done is True:
             return self.chunk_done
 
-        if kv:
+        if kv and manifest is None:
             valid = kv.get("chunk_integrity", self.chunk_index)
 
             # do an additional check if the chunk file exists
@@ -241,7 +409,12 @@ class ChunkObject:
                 # print(f"Chunk {chunk.chunk_index} is valid from cache")
                 return self.chunk_done
 
-        self.verify_integrity(quiet=quiet, length_of_sequence=length_of_sequence)
+        self.verify_integrity(
+            quiet=quiet,
+            length_of_sequence=length_of_sequence,
+            paranoid=paranoid,
+            manifest=manifest,
+        )
         return self.chunk_done
 
 
@@ -1,14 +1,17 @@
 import os
 import tempfile
 import time
-from typing import List
-
-from tqdm import tqdm
+from concurrent.futures import Future
+from typing import List, Optional
 
 from alabamaEncode.core.bin_utils import get_binary
 from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.core.containers import read_container
 from alabamaEncode.core.ffmpeg import Ffmpeg
+from alabamaEncode.core.ivf import IvfIndex, concat_ivf
 from alabamaEncode.core.path import PathAlabama
+from alabamaEncode.scene.mux_plan import MuxPlan
+from alabamaEncode.scene.source_tracks import SourceTracks
 
 
 class VideoConcatenator:
@@ -27,7 +30,12 @@ class VideoConcatenator:
         audio_only=False,
         temp_dir="",
         copy_included_subs=True,
+        source_tracks: Optional[Future] = None,
     ):
+        """
+        :param source_tracks: future of the audio & subs prepared by `start_source_tracks`,
+        they get copied in instead of encoded during the mux
+        """
         self.files = files
         self.output = output
         self.file_with_audio = file_with_audio
@@ -41,6 +49,7 @@ class VideoConcatenator:
         self.audio_only = audio_only
         self.temp_dir = temp_dir
         self.copy_included_subs = copy_included_subs
+        self.source_tracks = source_tracks
 
         if not self.output:
             print("If muxing please provide an output path")
@@ -49,7 +58,9 @@ class VideoConcatenator:
         if self.temp_dir == "":
             self.temp_dir = os.path.dirname(self.output) + "/"
 
-        self.final_files = []
+        self.vid_output = ""
+        self.vid_index: Optional[IvfIndex] = None
+        self.concat_file_path = ""
 
     def find_files_in_dir(self, folder_path, extension):
         """
@@ -74,102 +85,55 @@ class VideoConcatenator:
         end = time.time()
         print(f"Concat took {end - start} seconds")
 
-    def extract_subs(self, start_offset="", end_offset=""):
-        og_file = PathAlabama(self.file_with_audio)
-        tracks = Ffmpeg.get_tracks(og_file)
-        extracted_subs = []
-        sub_counter = 0
-        for track in tqdm(
-            [track for track in tracks if track["codec_type"] == "subtitle"],
-            desc="Extracting Subs",
-        ):
-            tag_lang = ""
-            if "language" in track["tags"]:
-                tag_lang = track["tags"]["language"]
-            tag_title = ""
-            if "title" in track["tags"]:
-                tag_title = track["tags"]["title"]
-
-            out_path = f"{self.temp_dir}{tag_lang}.vtt"
-            counter = 1
-            while os.path.exists(out_path):
-                out_path = f"{self.temp_dir}{tag_lang}_{counter}.vtt"
-                counter += 1
+    def concat_video_track(self) -> str:
+        """
+        Get the chunks into a single video input for the mux. ivf chunks get concatenated natively,
+        anything else is handed to ffmpeg's concat demuxer inside the mux itself
+        :return: the ffmpeg input args of the video
+        """
+        if len(self.files) > 0 and all([f.endswith(".ivf") for f in self.files]):
             try:
-                a = (
-                    f'{get_binary("ffmpeg")} -v error -y -stats {start_offset} -i {og_file.get_safe()} {end_offset} '
-                    f'-map 0:s:{sub_counter} "{out_path}"'
-                )
-                run_cli(a)
-            except Exception as e:
-                # print(e)
-                pass
-
-            if os.path.exists(out_path):
-                extracted_subs.append((out_path, tag_lang, tag_title, sub_counter))
-            # else:
-            #     print(f"Failed extracing {tag_lang}_{counter} sub")
-            #     pass
-
-            sub_counter += 1
-
-        return extracted_subs
-
-    def concat_video_track(self):
-        concat_file_path = self.temp_dir + "concat.txt"
+                self.concat_ivf_track()
+                return f'-i "{self.vid_output}"'
+            except ValueError as e:
+                print(f"Native ivf concat failed: {e}, falling back to ffmpeg")
 
-        with open(concat_file_path, "w") as f:
+        self.concat_file_path = self.temp_dir + "concat.txt"
+        with open(self.concat_file_path, "w") as f:
             for file in self.files:
                 f.write(f"file '{file}'\n")
+        return f'-f concat -safe 0 -i "{self.concat_file_path}"'
 
-        self.vid_output = f"{self.temp_dir}vid.mkv"
+    def concat_ivf_track(self):
+        """
+        Concat ivf chunks without ffmpeg, the index it leaves behind stands in for the integrity check
+        """
+        self.vid_output = f"{self.temp_dir}vid.ivf"
         print("Concating Video")
-        if not os.path.exists(self.vid_output):
-            os.system(
-                f'{get_binary("ffmpeg")} -y -stats -v error -f concat '
-                f'-safe 0 -i "{concat_file_path}" -c:v copy -map_metadata -1 -vsync cfr "{self.vid_output}"'
-            )
-        if Ffmpeg.check_for_invalid(PathAlabama(self.vid_output)):
-            raise Exception("Concating chunks failed")
-
-        os.remove(concat_file_path)
-
-        self.final_files += [f'-i "{self.vid_output}"']
-
-    def encode_audio_tracks(self):
-        print("Encoding a audio track")
-        self.audio_output = f"{self.temp_dir}audio.mkv"
-
-        vec = [
-            get_binary("ffmpeg"),
-            "-y",
-            "-stats",
-            "-v error",
-        ]
-
-        if self.start_offset != -1:
-            vec += [f"-ss {self.start_offset}"]
-
-        vec += [f'-i "{self.file_with_audio}"']
-
-        if self.end_offset != -1:
-            vec += [f"-t {Ffmpeg.get_video_length(PathAlabama(self.vid_output))}"]
-
-        vec += [
-            "-map",
-            "0:a:0",
-            self.audio_param_override,
-            "-map_metadata -1",
-            f'"{self.audio_output}"',
-        ]
-
-        encode_audio = " ".join(vec)
-        if not os.path.exists(self.audio_output):
-            os.system(encode_audio)
-        if Ffmpeg.check_for_invalid(PathAlabama(self.audio_output)):
-            raise Exception("Audio Track encoding Failed")
+        self.vid_index = IvfIndex.load(self.vid_output)
+        if self.vid_index is None:
+            self.vid_index = concat_ivf(self.files, self.vid_output)
+
+    def get_video_track_length(self) -> float:
+        if self.vid_index is not None:
+            return self.vid_index.get_duration()
+        # frame counts from the container headers, ffprobe only for the frame rate
+        frame_count = 0
+        for file in self.files:
+            summary = read_container(file)
+            if summary is None or not summary.valid:
+                return sum(
+                    [Ffmpeg.get_video_length(PathAlabama(file)) for file in self.files]
+                )
+            frame_count += summary.frame_count
+        return frame_count / Ffmpeg.get_video_frame_rate(PathAlabama(self.files[0]))
 
-        self.final_files += [f'-i "{self.audio_output}"']
+    def remove_intermediates(self):
+        if self.vid_index is not None:
+            os.remove(self.vid_output)
+            os.remove(IvfIndex.get_path(self.vid_output))
+        if self.concat_file_path and os.path.exists(self.concat_file_path):
+            os.remove(self.concat_file_path)
 
     def has_audio_track(self) -> bool:
         has_audio_track = False
@@ -181,191 +145,158 @@ class VideoConcatenator:
 
         return has_audio_track
 
-    def _concat_videos(self):
-        if os.path.exists(self.output):
-            print(f"File {self.output} already exists")
-            return
-
-        self.concat_video_track()
-
-        has_audio_track = self.has_audio_track()
-
-        if self.audio_only:
-            if not has_audio_track:
-                print("No audio track found, not encoding")
-                return
-
-            print("Encoding a audio track only")
-
-            print("Encoding a audio track")
+    def get_source_input(self) -> str:
+        """
+        :return: ffmpeg input args of the source, cut to the encoded part
+        """
+        source_input = ""
+        if self.start_offset != -1:
+            source_input += f"-ss {self.start_offset} "
+        source_input += f'-i "{self.file_with_audio}"'
+        if self.end_offset != -1:
+            source_input += f" -t {self.get_video_track_length()}"
+        return source_input
 
-            vec = [
-                get_binary("ffmpeg"),
-                "-y",
-                "-stats",
-                "-v error",
-            ]
+    def encode_audio_only(self):
+        if not self.has_audio_track():
+            print("No audio track found, not encoding")
+            return
 
-            if self.start_offset != -1:
-                vec += [f"-ss {self.start_offset}"]
+        print("Encoding a audio track only")
+        run_cli(
+            f"{get_binary('ffmpeg')} -y -stats -v error {self.get_source_input()} "
+            f'-map 0:a:0 {self.audio_param_override} -map_metadata -1 "{self.output}"'
+        ).verify(fail_message="Audio track encoding failed")
 
-            vec += ["-i", f'"{self.file_with_audio}"']
+    def get_mux_plan(self) -> MuxPlan:
+        """
+        The concatenated video, plus the encoded audio and the subtitles when muxing audio, as one ffmpeg run
+        """
+        plan = MuxPlan(self.output)
+        plan.add_video(plan.add_input(self.concat_video_track()))
 
-            if self.end_offset != -1:
-                vec += [f"-t {Ffmpeg.get_video_length(PathAlabama(self.vid_output))}"]
+        if not self.mux_audio:
+            print("Skipping audio")
+            return plan
+        source_tracks = self.wait_for_source_tracks()
+        if source_tracks is not None:
+            self.add_prepared_tracks(plan, source_tracks)
+            return plan
 
-            vec += [
-                "-map",
-                "0:a:0",
-                self.audio_param_override,
-                "-map_metadata -1",
-                f'"{self.output}"',
-            ]
+        tracks = Ffmpeg.get_tracks(PathAlabama(self.file_with_audio))
+        has_audio_track = any([track["codec_type"] == "audio" for track in tracks])
+        if not has_audio_track:
+            print("No audio track found, not encoding")
+            return plan
 
-            encode_audio = " ".join(vec)
-            os.system(encode_audio)
-            if Ffmpeg.check_for_invalid(PathAlabama(self.output)):
-                print("Invalid file found, exiting")
-                return
-            os.remove(self.vid_output)
-            return
+        source = plan.add_input(self.get_source_input())
+        plan.add_audio(source, 0, self.audio_param_override)
 
-        start_offset_command = ""
-        if self.start_offset != -1:
-            start_offset_command = f"-ss {self.start_offset}"
+        if not self.add_external_subs(plan) and self.copy_included_subs:
+            self.add_included_subs(plan, source, tracks)
 
-        end_offset_command = ""
-        if self.end_offset != -1:
-            end_offset_command = (
-                f"-t {Ffmpeg.get_video_length(PathAlabama(self.vid_output))}"
-            )
+        self.set_metadata(plan)
+        return plan
 
-        if not self.mux_audio or not has_audio_track:
-            if not has_audio_track:
-                print("No audio track found, not encoding")
-            print("Skipping audio")
-            os.system(
-                f"{get_binary('ffmpeg')} -y -stats -v error -i {self.vid_output} -c copy {self.output}"
+    def wait_for_source_tracks(self) -> Optional[SourceTracks]:
+        """
+        :return: None if nothing was prepared in the background or that failed, the mux encodes them itself then
+        """
+        if self.source_tracks is None:
+            return None
+        print("Waiting for the audio & subs")
+        start = time.time()
+        try:
+            source_tracks = self.source_tracks.result()
+        except Exception as e:
+            print(
+                f"Preparing audio & subs in the background failed: {e}, encoding them now"
             )
-            os.remove(self.vid_output)
-            if Ffmpeg.check_for_invalid(PathAlabama(self.output)):
-                os.remove(self.output)
-                raise Exception("VIDEO CONCAT FAILED")
+            return None
+        print(
+            f"Audio & subs took {source_tracks.encode_time:.2f}s in the background,"
+            f" waited {time.time() - start:.2f}s for them"
+        )
+        return source_tracks
+
+    def add_prepared_tracks(self, plan: MuxPlan, source_tracks: SourceTracks):
+        if source_tracks.audio_path == "":
             return
+        plan.add_audio(
+            plan.add_input(f'-i "{source_tracks.audio_path}"'), 0, "-c:a copy"
+        )
+        if not self.add_external_subs(plan) and source_tracks.subtitle_path != "":
+            subs = plan.add_input(f'-i "{source_tracks.subtitle_path}"')
+            self.add_included_subs(
+                plan, subs, Ffmpeg.get_tracks(PathAlabama(source_tracks.subtitle_path))
+            )
+        self.set_metadata(plan)
 
-        self.encode_audio_tracks()
-        print("Muxing audio into the output")
-
-        title_bit = f' -metadata description="encoded by {self.encoder_name}" '
-        if self.title:
-            title_bit += f' -metadata title="{self.title}"'
-
-        if self.subs_file is None or self.subs_file[0] == "":
-            vec = [
-                get_binary("ffmpeg"),
-                "-y",
-                "-stats",
-                "-v error",
-                f'-i "{self.vid_output}"',
-                f'-i "{self.audio_output}"',
+    def add_external_subs(self, plan: MuxPlan) -> bool:
+        """
+        :return: False if there are no external subs
+        """
+        external_subs = [sub for sub in (self.subs_file or []) if sub != ""]
+        if len(external_subs) == 0:
+            return False
+        for sub in external_subs:
+            sub_input = f'-i "{sub}"'
+            if self.start_offset != -1:
+                sub_input = f"-ss {self.start_offset} {sub_input}"
+            sub_tracks = [
+                track
+                for track in Ffmpeg.get_tracks(PathAlabama(sub))
+                if track["codec_type"] == "subtitle"
             ]
+            codec_name = sub_tracks[0].get("codec_name", "") if sub_tracks else "subrip"
+            if not plan.add_subtitle(plan.add_input(sub_input), 0, codec_name):
+                print(f"Can't put {sub} ({codec_name}) into {plan.container}")
+        return True
 
-            sub_tracks = []
-            if self.copy_included_subs:
-                sub_tracks = self.extract_subs(
-                    start_offset=start_offset_command, end_offset=end_offset_command
+    @staticmethod
+    def add_included_subs(plan: MuxPlan, input_index: int, tracks: List[dict]):
+        """
+        :param tracks: probed tracks of the input, only the subtitles get added
+        """
+        sub_tracks = [track for track in tracks if track["codec_type"] == "subtitle"]
+        for i, track in enumerate(sub_tracks):
+            tags = track.get("tags", {})
+            codec_name = track.get("codec_name", "")
+            if not plan.add_subtitle(
+                input_index,
+                i,
+                codec_name,
+                language=tags.get("language", ""),
+                title=tags.get("title", ""),
+            ):
+                print(
+                    f"Can't put subtitle track {i} ({codec_name}) into {plan.container}, leaving it out"
                 )
 
-                for out_path, tag_lang, tag_title, track_index in sub_tracks:
-                    vec += [
-                        f'-i "{out_path}"',
-                    ]
-
-            if self.encoder_name:
-                vec += [f' -metadata description="encoded by {self.encoder_name}"']
-
-            if self.title:
-                vec += [f' -metadata title="{self.title}"']
-
-            if self.copy_included_subs and len(sub_tracks) > 0:
-                stream_index = 2
-                for out_path, tag_lang, tag_title, track_index in sub_tracks:
-                    vec += [
-                        f"-map {stream_index}:s",
-                        f'-metadata:s:s:{track_index} language="{tag_lang}"',
-                        f'-metadata:s:s:{track_index} title="{tag_title}"',
-                    ]
-                    stream_index += 1
-
-            vec += ["-map 0:v", "-map 1:a"]
-
-            if "mp4" in self.output:
-                vec += ["-c:s mov_text", "-movflags +faststart"]
-
-            vec += [
-                "-map_chapters -1",
-                "-c:v copy",
-                "-c:a copy",
-                "-vsync cfr",
-                "-fflags +bitexact",
-                "-flags:v +bitexact",
-                "-flags:a +bitexact",
-                f'"{self.output}"',
-            ]
+    def set_metadata(self, plan: MuxPlan):
+        if self.encoder_name:
+            plan.set_metadata("description", f"encoded by {self.encoder_name}")
+        if self.title:
+            plan.set_metadata("title", self.title)
 
-            final_command = " ".join(vec)
-            print(final_command)
-            # print(f"running: {final_command}")
-            out = run_cli(final_command).verify().get_output()
-            if (
-                "Subtitle encoding currently only possible from text to text or bitmap to bitmap"
-                in str(out)
-            ):
-                print("Subtitle encoding failed, trying again")
-                for a in vec:
-                    if "mov_text" in a or "map 2:s" in a:
-                        vec.remove(a)
-                final_command = " ".join(vec)
-                # print(f"running: {final_command}")
-                print(final_command)
-                run_cli(final_command).verify()
-        else:
-            subs_i = ""
-            subs_map = ""
-            if len(self.subs_file) > 0 and self.subs_file[0] != "":
-                if start_offset_command != "":
-                    # offset each track using -itsoffset {offset} -ss {offset}
-                    print("Offseting subs")
-                    for sub in self.subs_file:
-                        temp_sub = f"{sub}.temp.vtt"
-                        encode_sub = (
-                            f'{get_binary("ffmpeg")} -y -v error -itsoffset {self.start_offset} '
-                            f'-ss {self.start_offset} -i "{sub}" "{temp_sub}"'
-                        )
-                        # print(f"running: {encode_sub}")
-
-                for track_index, sub in enumerate(self.subs_file):
-                    if start_offset_command != "":
-                        subs_i += f' -i "{sub}.temp.vtt" '
-                    else:
-                        subs_i += f' -i "{sub}" '
-                    subs_map += f"-map {track_index+2} "
-
-            final_command = (
-                f'{get_binary("ffmpeg")} -y -stats -v error -i "{self.vid_output}" -i "{self.audio_output}" '
-                f'{subs_i} {start_offset_command} -i "{self.file_with_audio}" {end_offset_command} '
-                f"{title_bit} -map 0:v -map 1:a {subs_map} -movflags +faststart -map_chapters -1 "
-                f'-c:v copy -c:a copy -vsync cfr "{self.output}"'
-            )
-            # print(f"running: {final_command}")
-            os.system(final_command)
+    def _concat_videos(self):
+        if os.path.exists(self.output):
+            print(f"File {self.output} already exists")
+            return
 
-        os.remove(self.vid_output)
-        os.remove(self.audio_output)
+        if self.audio_only:
+            self.encode_audio_only()
+            return
 
-        if Ffmpeg.check_for_invalid(PathAlabama(self.output)):
-            os.remove(self.output)
-            raise Exception("VIDEO CONCAT FAILED")
+        plan = self.get_mux_plan()
+        print("Muxing the output")
+        try:
+            run_cli(plan.get_command()).verify(fail_message="VIDEO CONCAT FAILED")
+        except Exception as e:
+            if os.path.exists(self.output):
+                os.remove(self.output)
+            raise e
+        self.remove_intermediates()
 
 
 def test():
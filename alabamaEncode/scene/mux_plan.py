@@ -0,0 +1,117 @@
+"""
+Plans the final mux as a single ffmpeg run: the concatenated video, the source's audio (encoded on the fly) and every
+subtitle stream go in together, and whether a subtitle can be carried and how is decided up front from the probed
+tracks instead of failing and retrying the mux
+"""
+
+import os
+import shlex
+from typing import List, Optional
+
+from alabamaEncode.core.bin_utils import get_binary
+
+__all__ = ["MuxPlan", "get_subtitle_codec", "get_container"]
+
+TEXT_SUBTITLE_CODECS = {"subrip", "srt", "ass", "ssa", "webvtt", "mov_text", "text"}
+
+
+def get_container(path: str) -> str:
+    return os.path.splitext(path)[1].lower().lstrip(".")
+
+
+def get_subtitle_codec(codec_name: str, container: str) -> Optional[str]:
+    """
+    :param codec_name: ffprobe codec_name of the subtitle stream
+    :return: what to pass to -c:s for it, None if the container can't hold it
+    """
+    is_text = codec_name in TEXT_SUBTITLE_CODECS
+    if container in ("mp4", "m4v", "mov"):
+        if codec_name == "mov_text":
+            return "copy"
+        # bitmap subs (pgs, vobsub, dvb) don't go into mp4 at all
+        return "mov_text" if is_text else None
+    if container == "webm":
+        if codec_name == "webvtt":
+            return "copy"
+        return "webvtt" if is_text else None
+    # matroska takes anything
+    return "copy"
+
+
+class MuxPlan:
+    """
+    Inputs and output streams of the mux, `get_command` turns them into one ffmpeg invocation
+    """
+
+    def __init__(self, output: str):
+        self.output = output
+        self.container = get_container(output)
+        self.inputs: List[str] = []
+        # per output stream: -map, codec and metadata args
+        self.streams: List[List[str]] = []
+        self.metadata: List[str] = []
+        self.subtitle_count = 0
+
+    def add_input(self, input_args: str) -> int:
+        """
+        :param input_args: everything belonging to the input, e.g. '-ss 10 -i "a.mkv" -t 20'
+        :return: the index of the input
+        """
+        self.inputs.append(input_args)
+        return len(self.inputs) - 1
+
+    def add_video(self, input_index: int):
+        self.streams.append([f"-map {input_index}:v:0", "-c:v copy"])
+
+    def add_audio(self, input_index: int, stream_index: int, codec_args: str):
+        self.streams.append([f"-map {input_index}:a:{stream_index}", codec_args])
+
+    def add_subtitle(
+        self,
+        input_index: int,
+        stream_index: int,
+        codec_name: str,
+        language: str = "",
+        title: str = "",
+    ) -> bool:
+        """
+        :return: False if the output container can't take the stream, it's left out then
+        """
+        codec = get_subtitle_codec(codec_name, self.container)
+        if codec is None:
+            return False
+        output_index = self.subtitle_count
+        args = [
+            f"-map {input_index}:s:{stream_index}",
+            f"-c:s:{output_index} {codec}",
+        ]
+        if language:
+            args.append(
+                f"-metadata:s:s:{output_index} language={shlex.quote(language)}"
+            )
+        if title:
+            args.append(f"-metadata:s:s:{output_index} title={shlex.quote(title)}")
+        self.streams.append(args)
+        self.subtitle_count += 1
+        return True
+
+    def set_metadata(self, key: str, value: str):
+        self.metadata.append(f"-metadata {key}={shlex.quote(value)}")
+
+    def get_command(self) -> str:
+        vec = [get_binary("ffmpeg"), "-y", "-stats", "-v error"]
+        vec += self.inputs
+        for stream in self.streams:
+            vec += stream
+        vec += ["-map_metadata -1", "-map_chapters -1"]
+        vec += self.metadata
+        if self.container in ("mp4", "m4v", "mov"):
+            vec += ["-movflags +faststart"]
+        vec += [
+            "-vsync cfr",
+            "-fflags +bitexact",
+            "-flags:v +bitexact",
+            "-flags:a +bitexact",
+            shlex.quote(self.output),
+        ]
+        return " ".join(vec)
@@ -1,10 +1,12 @@
 import copy
 import os
 import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List
 
 from tqdm.asyncio import tqdm
 
+from alabamaEncode.core.integrity_manifest import IntegrityManifest
 from alabamaEncode.core.kv import AlabamaKv
 from alabamaEncode.scene.chunk import ChunkObject
 
@@ -93,10 +95,16 @@ class ChunkSequence:
 
         return copy.deepcopy(chunks)
 
-    def sequence_integrity_check(self, kv: AlabamaKv = None) -> bool:
+    def sequence_integrity_check(
+        self, kv: AlabamaKv = None, paranoid=False, workers=-1
+    ) -> bool:
         """
-        checks the integrity of the chunks, and removes any that are invalid, and see if all are done
+        checks the integrity of the chunks, and removes any that are invalid, and see if all are done.
+        Chunks are checked on a thread pool, and every chunk that passes is written to an
+        IntegrityManifest next to the chunks, so on the next resume an unchanged chunk costs one stat
         :param kv: AlabamaKv object, for checking if a chunk is valid from cache
+        :param paranoid: decode every chunk with ffmpeg instead of only walking the container headers
+        :param workers: size of the pool, -1 for one per core (capped at 16)
         :return: true if there are broken chunks / not all chunks are done
         """
 
@@ -104,24 +112,49 @@ class ChunkSequence:
         total_chunks = len(self.chunks)
         invalid_chunks: List[ChunkObject or None] = []
 
-        for chunk in tqdm(seq_chunks, desc="Checking files", unit="file"):
-            if not chunk.is_done(kv=kv, length_of_sequence=total_chunks):
-                invalid_chunks.append(chunk)
+        if workers == -1:
+            workers = min(16, os.cpu_count() or 1)
+
+        manifest = None
+        if total_chunks > 0:
+            manifest = IntegrityManifest(os.path.dirname(seq_chunks[0].chunk_path))
+
+        def check(chunk: ChunkObject) -> bool:
+            return chunk.is_done(
+                kv=kv,
+                length_of_sequence=total_chunks,
+                paranoid=paranoid,
+                manifest=manifest,
+            )
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(check, chunk): chunk for chunk in seq_chunks}
+            with tqdm(total=total_chunks, desc="Checking files", unit="file") as bar:
+                for future in as_completed(futures):
+                    if not future.result():
+                        invalid_chunks.append(futures[future])
+                    bar.update()
 
         del_count = 0
 
         invalid_chunks: List[ChunkObject] = [
             chunk for chunk in invalid_chunks if chunk is not None
         ]
+        invalid_chunks.sort(key=lambda c: c.chunk_index)
 
         if len(invalid_chunks) > 0:
             for c in invalid_chunks:
+                manifest.forget(c.chunk_path)
                 if os.path.exists(c.chunk_path):
                     os.remove(c.chunk_path)
                     print(f"Deleted invalid file {c.chunk_path}")
                     del_count += 1
+            manifest.save()
             return True
 
+        if manifest is not None:
+            manifest.save()
+
         if del_count > 0:
             print(f"Deleted {del_count} invalid files 😂")
 
@@ -0,0 +1,127 @@
+"""
+Audio and subtitles only depend on the source and the offsets, so they get prepared in the background as soon as
+the scenes are known, at low priority next to the chunk encodes, and the final mux only has to copy them in
+"""
+
+import os
+import shlex
+import shutil
+import time
+from concurrent.futures import Future
+
+from alabamaEncode.core.background import KeyedBackgroundTasks
+from alabamaEncode.core.bin_utils import get_binary
+from alabamaEncode.core.cli_executor import run_cli
+from alabamaEncode.core.ffmpeg import Ffmpeg
+from alabamaEncode.core.path import PathAlabama
+
+__all__ = ["SourceTracks", "prepare_source_tracks", "start_source_tracks"]
+
+# ffmpeg threads of the background job, the chunk encodes get the rest of the machine
+SOURCE_TRACKS_THREADS = 2
+
+
+class SourceTracks:
+    """
+    What `prepare_source_tracks` left in the temp folder, empty paths for tracks the source doesn't have
+    """
+
+    def __init__(
+        self, audio_path: str = "", subtitle_path: str = "", encode_time: float = 0
+    ):
+        self.audio_path = audio_path
+        self.subtitle_path = subtitle_path
+        self.encode_time = encode_time
+
+
+def prepare_source_tracks(
+    file_with_audio: str,
+    temp_dir: str,
+    audio_param_override: str,
+    start_offset=-1,
+    length=-1,
+    copy_included_subs=True,
+) -> SourceTracks:
+    """
+    Encode the first audio track and copy out the subtitle streams in one run over the source.
+    The results are written under temp names and moved in place once complete, so a resumed job reuses them.
+    :param length: seconds to cut the tracks to, -1 to keep everything after start_offset
+    :param copy_included_subs: extract the source's subtitles, off when external subs get muxed instead
+    """
+    start = time.time()
+    audio_path = os.path.join(temp_dir, "audio.mka")
+    subtitle_path = os.path.join(temp_dir, "subs.mks")
+
+    tracks = Ffmpeg.get_tracks(PathAlabama(file_with_audio))
+    has_audio = any([track["codec_type"] == "audio" for track in tracks])
+    has_subs = copy_included_subs and any(
+        [track["codec_type"] == "subtitle" for track in tracks]
+    )
+    if not has_audio:
+        print("No audio track found, not encoding")
+        return SourceTracks()
+
+    outputs = []
+    command = ""
+    if shutil.which("nice") is not None:
+        command += "nice -n 19 "
+    command += f"{get_binary('ffmpeg')} -y -v error -threads {SOURCE_TRACKS_THREADS}"
+    if start_offset != -1:
+        command += f" -ss {start_offset}"
+    command += f" -i {shlex.quote(file_with_audio)}"
+    if length != -1:
+        command += f" -t {length}"
+
+    if not os.path.exists(audio_path):
+        outputs.append((f"{audio_path}.temp.mka", audio_path))
+        command += (
+            f" -map 0:a:0 -threads {SOURCE_TRACKS_THREADS} {audio_param_override}"
+            f" -map_metadata -1 {shlex.quote(outputs[-1][0])}"
+        )
+    if has_subs and not os.path.exists(subtitle_path):
+        outputs.append((f"{subtitle_path}.temp.mks", subtitle_path))
+        # global metadata goes, the per stream language and title tags stay
+        command += (
+            f" -map 0:s -c:s copy -map_metadata:g -1 -map_chapters -1"
+            f" {shlex.quote(outputs[-1][0])}"
+        )
+
+    if len(outputs) > 0:
+        run_cli(command).verify(
+            fail_message="Audio & subtitle preparation failed",
+            files=[temp_path for temp_path, _ in outputs],
+        )
+        for temp_path, path in outputs:
+            os.replace(temp_path, path)
+
+    return SourceTracks(
+        audio_path=audio_path,
+        subtitle_path=subtitle_path if has_subs else "",
+        encode_time=time.time() - start,
+    )
+
+
+_source_tracks_tasks = KeyedBackgroundTasks()
+
+
+def start_source_tracks(ctx, sequence) -> Future:
+    """
+    Start `prepare_source_tracks` for a job in the background, calling it again for the same temp folder
+    returns the same future unless the previous run failed
+    :return: future of the `SourceTracks`
+    """
+
+    def work():
+        length = -1
+        if ctx.end_offset != -1:
+            length = sum([chunk.get_lenght() for chunk in sequence.chunks])
+        return prepare_source_tracks(
+            file_with_audio=ctx.input_file,
+            temp_dir=ctx.temp_folder,
+            audio_param_override=ctx.audio_params,
+            start_offset=ctx.start_offset,
+            length=length,
+            copy_included_subs=ctx.sub_file == "",
+        )
+
+    return _source_tracks_tasks.start(ctx.temp_folder, work)
@@ -287,6 +287,82 @@ def read_args(ctx):
         dest="dry_run",
     )
 
+    parser.add_argument(
+        "--paranoid_integrity_check",
+        help="Decode every chunk with ffmpeg when checking integrity, "
+        "instead of only walking the container's frame headers",
+        action="store_true",
+        dest="paranoid_integrity_check",
+    )
+
+    parser.add_argument(
+        "--no_source_index",
+        help="Don't index the source's frames, chunks then seek by frame rate instead of by exact frame",
+        action="store_false",
+        dest="source_index",
+    )
+
+    parser.add_argument(
+        "--streaming_output",
+        help="Publish finished chunks as CMAF segments with live HLS/DASH playlists in <output folder>/stream "
+        "while the encode runs, AV1 ivf chunks only",
+        action="store_true",
+        dest="streaming_output",
+    )
+
+    parser.add_argument(
+        "--intermediate_cache",
+        help="Folder to keep each chunk's decoded + filtered frames in, so probes and vmaf references"
+        " don't decode the source again, e.g. /dev/shm/alabama_cache. Off if not set",
+        type=str,
+        default=ctx.intermediate_cache_folder,
+        dest="intermediate_cache_folder",
+    )
+
+    parser.add_argument(
+        "--intermediate_cache_budget",
+        help="Max size of the intermediate cache in MB, least recently used chunks are evicted",
+        type=int,
+        default=ctx.intermediate_cache_budget_mb,
+        dest="intermediate_cache_budget_mb",
+    )
+
+    parser.add_argument(
+        "--intermediate_cache_container",
+        help="y4m: raw frames, fastest, for tmpfs. ffv1: lossless, ~3x smaller, for a fast disk",
+        type=str,
+        choices=["y4m", "ffv1"],
+        default=ctx.intermediate_cache_container,
+        dest="intermediate_cache_container",
+    )
+
+    parser.add_argument(
+        "--metric_cache",
+        help="Folder to keep metric results in, so encodes scored before (resumes, re-runs, experiments)"
+        " aren't decoded and scored again, e.g. /var/cache/alabama_metrics. Off if not set",
+        type=str,
+        default=ctx.metric_cache_folder,
+        dest="metric_cache_folder",
+    )
+
+    parser.add_argument(
+        "--metric_cache_budget",
+        help="Max size of the metric cache in MB, least recently used results are evicted",
+        type=int,
+        default=ctx.metric_cache_budget_mb,
+        dest="metric_cache_budget_mb",
+    )
+
+    parser.add_argument(
+        "--spool_budget",
+        help="Max MB of raw decoded frames probes and multi-res ladders may spool to /dev/shm at once, so the"
+        " metric reuses the encoder's decode. Past it the source is decoded again for the metric."
+        " Off (0) by default",
+        type=int,
+        default=ctx.spool_budget_mb,
+        dest="spool_budget_mb",
+    )
+
     parser.add_argument(
         "--title", help="Title of the video", type=str, default=ctx.title, dest="title"
     )
@@ -430,6 +506,34 @@ def read_args(ctx):
         dest="probe_count",
     )
 
+    parser.add_argument(
+        "--probe_batch_size",
+        type=int,
+        default=ctx.probe_batch_size,
+        help="Run up to this many probe encodes of a chunk in parallel, all fed from a single decode of it. "
+        "Worth it when cores sit idle, e.g. few chunks or the tail of a job, 1 probes one after another",
+        action=range_action(1, 16),
+        dest="probe_batch_size",
+    )
+
+    parser.add_argument(
+        "--probe_subsample",
+        type=int,
+        default=ctx.probe_subsample,
+        help="Score only every Nth frame of a probe, probes that land close to the target get rescored denser. "
+        "Final encodes are always scored in full",
+        action=range_action(1, 32),
+        dest="probe_subsample",
+    )
+
+    parser.add_argument(
+        "--multires_exhaustive_sampling",
+        action="store_false",
+        help="Encode every crf of every resolution for the multi-res convex hull, instead of a coarse grid "
+        "refined around the trellis's picks",
+        dest="multires_adaptive_sampling",
+    )
+
     parser.add_argument(
         "--probe_speed_override",
         type=int,
@@ -594,6 +698,15 @@ def read_args(ctx):
     ctx.prototype_encoder.grain_synth = args.grain
     ctx.log_level = args.log_level
     ctx.dry_run = args.dry_run
+    ctx.paranoid_integrity_check = args.paranoid_integrity_check
+    ctx.source_index = args.source_index
+    ctx.streaming_output = args.streaming_output
+    ctx.intermediate_cache_folder = args.intermediate_cache_folder
+    ctx.intermediate_cache_budget_mb = args.intermediate_cache_budget_mb
+    ctx.intermediate_cache_container = args.intermediate_cache_container
+    ctx.metric_cache_folder = args.metric_cache_folder
+    ctx.metric_cache_budget_mb = args.metric_cache_budget_mb
+    ctx.spool_budget_mb = args.spool_budget_mb
     ctx.ssim_db_target = args.ssim_db_target
     ctx.simple_denoise = args.simple_denoise
     ctx.vmaf = args.vmaf_target
@@ -640,6 +753,9 @@ def read_args(ctx):
     ctx.auto_accept_autocrop = args.auto_accept_autocrop
     ctx.resolution_preset = args.resolution_preset
     ctx.probe_count = args.probe_count
+    ctx.probe_batch_size = args.probe_batch_size
+    ctx.probe_subsample = args.probe_subsample
+    ctx.multires_adaptive_sampling = args.multires_adaptive_sampling
     ctx.vmaf_reference_display = args.vmaf_reference_display
     ctx.probe_speed_override = args.probe_speed_override
     ctx.crf_map = args.flag4